@@ -0,0 +1,497 @@
+"""
+End-to-end performance benchmark of the nnU-Net pipeline on a synthetic dataset. Runs on CPU, so it can be used in CI
+to catch performance regressions. Everything (data, splits, network initialization, augmentation) is seeded.
+
+nnunetv2.paths reads the nnUNet_raw/nnUNetv2_preprocessed/nnUNet_results environment variables on import. The
+benchmark works in its own folder, so we set them before ANY nnunetv2 module that uses them is imported. That's why
+most imports in here are inside the functions. Don't move them to the top.
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from time import perf_counter, time
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+import torch
+
+BENCHMARK_DATASET_ID = 980
+BENCHMARK_DATASET_NAME = f'Dataset{BENCHMARK_DATASET_ID:03d}_SyntheticBenchmark'
+
+# all stages in the order in which they are run
+BENCHMARK_STAGES = ('fingerprint_extraction', 'planning', 'preprocessing', 'dataloader', 'train_step',
+                    'sliding_window_prediction', 'export', 'evaluation', 'postprocessing_determination')
+
+
+def set_seeds(seed: int) -> None:
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def _time_it(fn: Callable, *args, **kwargs) -> Tuple[float, object]:
+    start = perf_counter()
+    ret = fn(*args, **kwargs)
+    return perf_counter() - start, ret
+
+
+def _stage_result(times: List[float], num_items: int = None, unit: str = None) -> dict:
+    """
+    seconds is the total time of the stage. If the stage processes several items (batches, cases, ...) we also
+    report the throughput in items per second
+    """
+    res = {'seconds': float(np.sum(times))}
+    if len(times) > 1:
+        res['median_seconds_per_item'] = float(np.median(times))
+    if num_items is not None:
+        res['num_items'] = num_items
+        res['unit'] = unit
+        res['items_per_second'] = num_items / res['seconds'] if res['seconds'] > 0 else float('inf')
+    return res
+
+
+def _read_proc_status_kb(field: str) -> int:
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise RuntimeError(f'{field} not found in /proc/self/status')
+
+
+def _preprocess_case_peak_memory(image_files: List[str], seg_file: str, plans_file: str, configuration: str,
+                              dataset_json_file: str) -> dict:
+    """
+    Runs in a fresh process. Measures how much memory (MB) preprocessing this case needs on top of the interpreter,
+    imports and setup, which is what a preprocessing worker needs per case.
+
+    On linux the peak RSS (VmHWM) is reset right before preprocessing (/proc/self/clear_refs) and compared to the RSS
+    at that moment, so everything that was allocated before does not count. Elsewhere we fall back to the peak of
+    the allocations traced by tracemalloc (numpy arrays, but not memory allocated by SimpleITK)
+    """
+    import tracemalloc
+    from batchgenerators.utilities.file_and_folder_operations import load_json
+    from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+    plans_manager = PlansManager(plans_file)
+    configuration_manager = plans_manager.get_configuration(configuration)
+    preprocessor = configuration_manager.preprocessor_class(verbose=False)
+    dataset_json = load_json(dataset_json_file)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            # 5 resets the peak RSS
+            f.write('5')
+        rss_before = _read_proc_status_kb('VmRSS')
+    except OSError:
+        rss_before = None
+
+    if rss_before is not None:
+        preprocessor.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json)
+        return {'peak_mb': (_read_proc_status_kb('VmHWM') - rss_before) / 1024, 'method': 'VmHWM'}
+    tracemalloc.start()
+    preprocessor.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'peak_mb': peak / 1024 ** 2, 'method': 'tracemalloc'}
+
+
+def default_memory_case_shape(shape: Tuple[int, ...], min_voxels: int = 2 ** 23) -> Tuple[int, ...]:
+    """
+    shape scaled up (same aspect ratio) to at least min_voxels. The regular benchmark cases are too small to say
+    anything about the memory consumption of preprocessing
+    """
+    factor = max(1., (min_voxels / np.prod(shape)) ** (1 / len(shape)))
+    return tuple(int(np.ceil(s * factor)) for s in shape)
+
+
+def get_machine_info() -> dict:
+    return {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'torch_num_threads': torch.get_num_threads(),
+    }
+
+
+def run_benchmark(work_dir: str,
+                  shape: Tuple[int, ...] = (48, 64, 64),
+                  spacing: Tuple[float, ...] = (1., 1., 1.),
+                  num_classes: int = 3,
+                  num_channels: int = 1,
+                  num_cases: int = 10,
+                  configuration: str = '3d_fullres',
+                  num_processes: int = 2,
+                  num_processes_DA: int = 2,
+                  num_dataloader_batches: int = 20,
+                  num_train_steps: int = 5,
+                  num_prediction_cases: int = 2,
+                  tile_batch_size: int = 2,
+                  seed: int = 1234,
+                  stages: Union[List[str], Tuple[str, ...]] = BENCHMARK_STAGES,
+                  memory_case_shape: Tuple[int, ...] = None) -> dict:
+    """
+    Generates a synthetic dataset in work_dir and runs the selected stages on it (on CPU). Later stages need the
+    output of earlier ones, so stages that are not selected are still run if needed, they are just not timed.
+
+    Anisotropic data can be generated with the spacing, for example spacing=(5, 1, 1).
+
+    The peak memory of preprocessing is measured on a separate, larger case of memory_case_shape (default:
+    default_memory_case_shape(shape)) in a fresh process.
+
+    Returns a dict with machine info, the benchmark config and the time (+ throughput) of each stage
+    """
+    for s in stages:
+        assert s in BENCHMARK_STAGES, f'unknown stage {s}. Available stages: {BENCHMARK_STAGES}'
+    work_dir = os.path.abspath(work_dir)
+    os.environ['nnUNet_raw'] = os.path.join(work_dir, 'nnUNet_raw')
+    os.environ['nnUNetv2_preprocessed'] = os.path.join(work_dir, 'nnUNet_preprocessed')
+    os.environ['nnUNet_results'] = os.path.join(work_dir, 'nnUNet_results')
+    os.environ['nnUNet_n_proc_DA'] = str(num_processes_DA)
+    import nnunetv2.paths
+    if nnunetv2.paths.nnUNet_raw != os.environ['nnUNet_raw']:
+        raise RuntimeError('nnunetv2.paths was imported before the benchmark could set its own paths. Run the '
+                           'benchmark in a fresh python process (nnUNetv2_benchmark)')
+
+    from batchgenerators.utilities.file_and_folder_operations import join, load_json, maybe_mkdir_p
+    from nnunetv2.batch_running.benchmarking.synthetic_dataset import generate_synthetic_dataset
+    from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder
+    from nnunetv2.experiment_planning.plan_and_preprocess_api import extract_fingerprint_dataset, \
+        plan_experiment_dataset, preprocess_dataset
+    from nnunetv2.inference.export_prediction import export_prediction_from_logits
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    from nnunetv2.postprocessing.remove_connected_components import determine_postprocessing
+    from nnunetv2.training.dataloading.utils import unpack_dataset
+    from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+    from nnunetv2.utilities.utils import get_filenames_of_train_images_and_targets
+
+    device = torch.device('cpu')
+    results = {}
+    set_seeds(seed)
+
+    generate_synthetic_dataset(nnunetv2.paths.nnUNet_raw, BENCHMARK_DATASET_NAME, num_cases, shape, spacing,
+                               num_classes, num_channels, seed=seed)
+
+    t, _ = _time_it(extract_fingerprint_dataset, BENCHMARK_DATASET_ID, num_processes=num_processes,
+                    check_dataset_integrity=False, clean=True, verbose=False)
+    results['fingerprint_extraction'] = _stage_result([t], num_cases, 'cases')
+
+    t, _ = _time_it(plan_experiment_dataset, BENCHMARK_DATASET_ID)
+    results['planning'] = _stage_result([t])
+
+    preprocessed_folder = join(nnunetv2.paths.nnUNet_preprocessed, BENCHMARK_DATASET_NAME)
+    plans = load_json(join(preprocessed_folder, 'nnUNetPlans.json'))
+    if configuration not in plans['configurations'].keys():
+        raise RuntimeError(f'The planner did not create configuration {configuration} for this dataset. Available: '
+                           f'{list(plans["configurations"].keys())}')
+    t, _ = _time_it(preprocess_dataset, BENCHMARK_DATASET_ID, configurations=(configuration,),
+                    num_processes=(num_processes,))
+    results['preprocessing'] = _stage_result([t], num_cases, 'cases')
+    # memory is what gets preprocessing workers killed, so we keep an eye on it as well. The benchmark cases are tiny,
+    # so this is measured on a separate large case (same spacing, so it is preprocessed just like the others)
+    dataset_json = load_json(join(preprocessed_folder, 'dataset.json'))
+    if memory_case_shape is None:
+        memory_case_shape = default_memory_case_shape(shape)
+    memory_case_folder = generate_synthetic_dataset(join(work_dir, 'memory_case'), BENCHMARK_DATASET_NAME, 1,
+                                                    memory_case_shape, spacing, num_classes, num_channels,
+                                                    shape_jitter=0, seed=seed)
+    memory_case = get_filenames_of_train_images_and_targets(memory_case_folder, dataset_json)['case_0000']
+    with multiprocessing.get_context('spawn').Pool(1) as p:
+        memory = p.apply(_preprocess_case_peak_memory, (memory_case['images'], memory_case['label'],
+                                                     join(preprocessed_folder, 'nnUNetPlans.json'), configuration,
+                                                     join(preprocessed_folder, 'dataset.json')))
+    results['preprocessing']['peak_memory_mb_large_case'] = memory['peak_mb']
+    results['preprocessing']['peak_memory_method'] = memory['method']
+    shutil.rmtree(join(work_dir, 'memory_case'))
+
+    set_seeds(seed)
+    trainer = nnUNetTrainer(plans, configuration, 0, dataset_json, unpack_dataset=True, device=device)
+    trainer.num_iterations_per_epoch = num_dataloader_batches
+    trainer.initialize()
+    maybe_mkdir_p(trainer.output_folder)
+    unpack_dataset(trainer.preprocessed_dataset_folder, unpack_segmentation=True, overwrite_existing=False,
+                   num_processes=num_processes)
+
+    # dataloader: time to first batch (worker startup) and batches/s afterwards
+    set_seeds(seed)
+    dataloader_train, dataloader_val = trainer.get_dataloaders()
+    try:
+        time_first_batch, batch = _time_it(next, dataloader_train)
+        batches = [batch]
+        times = []
+        for _ in range(num_dataloader_batches):
+            t, batch = _time_it(next, dataloader_train)
+            times.append(t)
+            batches.append(batch)
+    finally:
+        for dl in (dataloader_train, dataloader_val):
+            if hasattr(dl, '_finish'):
+                dl._finish()
+    results['dataloader'] = _stage_result(times, num_dataloader_batches, 'batches')
+    results['dataloader']['seconds_first_batch'] = time_first_batch
+
+    # train step without data loading. The first step is a warmup
+    trainer.set_deep_supervision_enabled(True)
+    trainer.network.train()
+    trainer.train_step(batches[0])
+    times = []
+    for i in range(num_train_steps):
+        t, _ = _time_it(trainer.train_step, batches[(i + 1) % len(batches)])
+        times.append(t)
+    results['train_step'] = _stage_result(times, num_train_steps, 'iterations')
+    del batches
+
+    # sliding window prediction + export on the first cases of the validation set
+    trainer.set_deep_supervision_enabled(False)
+    trainer.network.eval()
+    predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True,
+                                perform_everything_on_gpu=False, device=device, verbose=False,
+                                verbose_preprocessing=False, allow_tqdm=False, tile_batch_size=tile_batch_size)
+    predictor.manual_initialization(trainer.network, trainer.plans_manager, trainer.configuration_manager, None,
+                                    trainer.dataset_json, trainer.__class__.__name__,
+                                    trainer.inference_allowed_mirroring_axes)
+    _, dataset_val = trainer.get_tr_and_val_datasets()
+    keys = sorted(dataset_val.keys())[:num_prediction_cases]
+    prediction_folder = join(work_dir, 'predictions')
+    maybe_mkdir_p(prediction_folder)
+    times_prediction = []
+    times_export = []
+    for k in keys:
+        data, properties = trainer._load_case_for_validation(dataset_val, k)
+        t, logits = _time_it(lambda x: predictor.predict_sliding_window_return_logits(x)[-1], data)
+        times_prediction.append(t)
+        t, _ = _time_it(export_prediction_from_logits, logits.cpu(), properties, trainer.configuration_manager,
+                        trainer.plans_manager, trainer.dataset_json, join(prediction_folder, k))
+        times_export.append(t)
+    results['sliding_window_prediction'] = _stage_result(times_prediction, len(keys), 'cases')
+    results['export'] = _stage_result(times_export, len(keys), 'cases')
+
+    # evaluation. Writes summary.json to the prediction folder, just like the validation does. The postprocessing
+    # then reuses it, so postprocessing_determination does not contain the evaluation of the raw predictions
+    gt_folder = join(work_dir, 'gt_segmentations')
+    maybe_mkdir_p(gt_folder)
+    for k in keys:
+        shutil.copy(join(preprocessed_folder, 'gt_segmentations', k + dataset_json['file_ending']), gt_folder)
+    label_manager = trainer.label_manager
+    t, _ = _time_it(compute_metrics_on_folder, gt_folder, prediction_folder, join(prediction_folder, 'summary.json'),
+                    trainer.plans_manager.image_reader_writer_class(), dataset_json['file_ending'],
+                    label_manager.foreground_regions if label_manager.has_regions else label_manager.foreground_labels,
+                    label_manager.ignore_label, num_processes)
+    results['evaluation'] = _stage_result([t], len(keys), 'cases')
+
+    t, _ = _time_it(determine_postprocessing, prediction_folder, gt_folder, plans, dataset_json, num_processes)
+    results['postprocessing_determination'] = _stage_result([t], len(keys), 'cases')
+
+    return {
+        'timestamp': time(),
+        'machine': get_machine_info(),
+        'config': {
+            'shape': list(shape),
+            'spacing': list(spacing),
+            'num_classes': num_classes,
+            'num_channels': num_channels,
+            'num_cases': num_cases,
+            'configuration': configuration,
+            'patch_size': list(trainer.configuration_manager.patch_size),
+            'batch_size': trainer.configuration_manager.batch_size,
+            'num_processes': num_processes,
+            'num_processes_DA': num_processes_DA,
+            'num_dataloader_batches': num_dataloader_batches,
+            'num_train_steps': num_train_steps,
+            'num_prediction_cases': len(keys),
+            'tile_batch_size': tile_batch_size,
+            'seed': seed,
+            'memory_case_shape': list(memory_case_shape),
+        },
+        'stages': {s: results[s] for s in BENCHMARK_STAGES if s in stages},
+    }
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = 0.2,
+                        memory_tolerance: float = 0.2) -> List[str]:
+    """
+    Returns a list of regressions (human readable). A stage has regressed if it takes more than (1 + tolerance) times
+    as long as in the baseline. Stages that are not present in both are ignored.
+    The peak memory of preprocessing (large case) has regressed if it is more than (1 + memory_tolerance) times the
+    baseline. If the baseline has a peak memory but the current run has none or measured it differently, that is
+    reported as well, so the memory check cannot silently be skipped.
+    """
+    if results['config'] != baseline['config']:
+        print('WARNING: the baseline was created with a different benchmark config. The comparison is not '
+              'meaningful!')
+    if results['machine']['hostname'] != baseline['machine']['hostname']:
+        print(f'WARNING: the baseline was created on a different machine ({baseline["machine"]["hostname"]})')
+    regressions = []
+    for s in BENCHMARK_STAGES:
+        if s not in results['stages'].keys() or s not in baseline['stages'].keys():
+            continue
+        current = results['stages'][s]['seconds']
+        reference = baseline['stages'][s]['seconds']
+        ratio = current / reference if reference > 0 else float('inf')
+        results['stages'][s]['baseline_seconds'] = reference
+        results['stages'][s]['ratio_to_baseline'] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(f'{s}: {round(current, 3)} s vs {round(reference, 3)} s in baseline '
+                               f'({round((ratio - 1) * 100, 1)} % slower)')
+
+    current = results['stages'].get('preprocessing', {})
+    reference = baseline['stages'].get('preprocessing', {})
+    if 'peak_memory_mb_large_case' not in reference.keys():
+        print('WARNING: the baseline has no preprocessing peak memory. Re-create it to also check for memory '
+              'regressions')
+    elif 'peak_memory_mb_large_case' not in current.keys():
+        regressions.append('preprocessing peak memory: not measured in this run, but present in the baseline')
+    elif current['peak_memory_method'] != reference['peak_memory_method']:
+        regressions.append(f'preprocessing peak memory: measured with {current["peak_memory_method"]}, the baseline '
+                           f'with {reference["peak_memory_method"]}. Cannot compare')
+    else:
+        ratio = current['peak_memory_mb_large_case'] / reference['peak_memory_mb_large_case'] \
+            if reference['peak_memory_mb_large_case'] > 0 else float('inf')
+        current['baseline_peak_memory_mb_large_case'] = reference['peak_memory_mb_large_case']
+        if ratio > 1 + memory_tolerance:
+            regressions.append(f'preprocessing peak memory: {round(current["peak_memory_mb_large_case"], 1)} MB '
+                               f'vs {round(reference["peak_memory_mb_large_case"], 1)} MB in baseline '
+                               f'({round((ratio - 1) * 100, 1)} % more)')
+    return regressions
+
+
+def check_peak_memory(results: dict, max_memory_mb: float) -> List[str]:
+    """
+    Absolute limit for the peak memory of preprocessing (large case), no baseline needed. Returns a list of
+    regressions (human readable) like compare_to_baseline
+    """
+    preprocessing = results['stages'].get('preprocessing', {})
+    if 'peak_memory_mb_large_case' not in preprocessing.keys():
+        return ['preprocessing peak memory: not measured in this run, cannot check -max_memory_mb']
+    if preprocessing['peak_memory_mb_large_case'] > max_memory_mb:
+        return [f'preprocessing peak memory: {round(preprocessing["peak_memory_mb_large_case"], 1)} MB, limit is '
+                f'{max_memory_mb} MB']
+    return []
+
+
+def print_results(results: dict) -> None:
+    print()
+    print(f'{"stage":<30}{"seconds":>10}{"throughput":>24}{"vs baseline":>14}')
+    for s, r in results['stages'].items():
+        throughput = f'{round(r["items_per_second"], 2)} {r["unit"]}/s' if 'items_per_second' in r.keys() else ''
+        vs_baseline = f'{round(r["ratio_to_baseline"], 2)}x' if 'ratio_to_baseline' in r.keys() else ''
+        print(f'{s:<30}{round(r["seconds"], 3):>10}{throughput:>24}{vs_baseline:>14}')
+    if 'peak_memory_mb_large_case' in results['stages'].get('preprocessing', {}).keys():
+        r = results['stages']['preprocessing']
+        vs_baseline = f' (baseline: {round(r["baseline_peak_memory_mb_large_case"], 1)} MB)' \
+            if 'baseline_peak_memory_mb_large_case' in r.keys() else ''
+        print(f'peak memory for preprocessing a {"x".join([str(i) for i in results["config"]["memory_case_shape"]])} '
+              f'case ({r["peak_memory_method"]}): {round(r["peak_memory_mb_large_case"], 1)} MB{vs_baseline}')
+    print()
+
+
+def benchmark_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs an end-to-end benchmark of nnU-Net (fingerprint extraction, '
+                                                 'planning, preprocessing, data loading, training, inference, '
+                                                 'evaluation and postprocessing) on a synthetic dataset. Runs on CPU '
+                                                 'with fixed seeds and writes a json file with the results. Compare '
+                                                 'against a stored baseline with -b to detect performance '
+                                                 'regressions (non-zero exit code if there are any).')
+    parser.add_argument('-o', type=str, required=True,
+                        help='Output file (.json) for the results')
+    parser.add_argument('-b', type=str, required=False, default=None,
+                        help='[OPTIONAL] Baseline results file (created by an earlier run of this script) to compare '
+                             'against')
+    parser.add_argument('-tolerance', type=float, required=False, default=0.2,
+                        help='[OPTIONAL] A stage counts as regressed if it is slower than (1 + tolerance) times the '
+                             'baseline. Default: 0.2')
+    parser.add_argument('-memory_tolerance', type=float, required=False, default=0.2,
+                        help='[OPTIONAL] The peak memory of preprocessing counts as regressed if it is more than '
+                             '(1 + memory_tolerance) times the baseline. Default: 0.2')
+    parser.add_argument('-max_memory_mb', type=float, required=False, default=None,
+                        help='[OPTIONAL] Fail (non-zero exit code) if preprocessing the large case needs more than '
+                             'this many MB. Works with and without -b')
+    parser.add_argument('-shape', type=int, nargs='+', required=False, default=(48, 64, 64),
+                        help='[OPTIONAL] Shape of the synthetic images (z y x or y x). Default: 48 64 64')
+    parser.add_argument('-memory_case_shape', type=int, nargs='+', required=False, default=None,
+                        help='[OPTIONAL] Shape of the case the peak memory of preprocessing is measured on (same order '
+                             'as -shape). Default: -shape scaled up to at least 2**23 voxels')
+    parser.add_argument('-spacing', type=float, nargs='+', required=False, default=None,
+                        help='[OPTIONAL] Spacing of the synthetic images (same order as -shape). Use for example 5 1 1 '
+                             'for anisotropic data. Default: 1 for all axes')
+    parser.add_argument('-num_classes', type=int, required=False, default=3,
+                        help='[OPTIONAL] Number of classes including background. Default: 3')
+    parser.add_argument('-num_channels', type=int, required=False, default=1,
+                        help='[OPTIONAL] Number of input channels. Default: 1')
+    parser.add_argument('-num_cases', type=int, required=False, default=10,
+                        help='[OPTIONAL] Number of training cases. Must be at least 5 (5-fold split). Default: 10')
+    parser.add_argument('-c', type=str, required=False, default='3d_fullres',
+                        help='[OPTIONAL] Configuration to benchmark. Default: 3d_fullres')
+    parser.add_argument('-np', type=int, required=False, default=2,
+                        help='[OPTIONAL] Number of processes for fingerprint extraction, preprocessing, export and '
+                             'evaluation. Default: 2')
+    parser.add_argument('-np_DA', type=int, required=False, default=2,
+                        help='[OPTIONAL] Number of data augmentation workers. Default: 2')
+    parser.add_argument('-num_threads', type=int, required=False, default=None,
+                        help='[OPTIONAL] Number of torch threads. Set this for comparable results across runs. '
+                             'Default: torch default')
+    parser.add_argument('-num_batches', type=int, required=False, default=20,
+                        help='[OPTIONAL] Number of batches for the dataloader benchmark. Default: 20')
+    parser.add_argument('-num_train_steps', type=int, required=False, default=5,
+                        help='[OPTIONAL] Number of timed training steps. Default: 5')
+    parser.add_argument('-num_prediction_cases', type=int, required=False, default=2,
+                        help='[OPTIONAL] Number of validation cases that are predicted, exported and evaluated. '
+                             'Default: 2')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=2,
+                        help='[OPTIONAL] Number of sliding window tiles predicted at once. Default: 2')
+    parser.add_argument('-stages', type=str, nargs='+', required=False, default=BENCHMARK_STAGES,
+                        help=f'[OPTIONAL] Stages to report. Default: all ({", ".join(BENCHMARK_STAGES)})')
+    parser.add_argument('-seed', type=int, required=False, default=1234,
+                        help='[OPTIONAL] Seed. Default: 1234')
+    parser.add_argument('-work_dir', type=str, required=False, default=None,
+                        help='[OPTIONAL] Where the synthetic dataset and all intermediate files go. Must not be used by '
+                             'a real nnU-Net installation. Default: a temporary directory that is deleted afterwards')
+    args = parser.parse_args()
+
+    assert args.o.endswith('.json'), '-o must end with .json'
+    spacing = args.spacing if args.spacing is not None else [1.] * len(args.shape)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='nnUNet_benchmark_')
+    try:
+        results = run_benchmark(work_dir, tuple(args.shape), tuple(spacing), args.num_classes, args.num_channels,
+                                args.num_cases, args.c, args.np, args.np_DA, args.num_batches, args.num_train_steps,
+                                args.num_prediction_cases, args.tile_batch_size, args.seed, args.stages,
+                                None if args.memory_case_shape is None else tuple(args.memory_case_shape))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    regressions = []
+    if args.b is not None:
+        with open(args.b, 'r') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance, args.memory_tolerance)
+    if args.max_memory_mb is not None:
+        regressions += check_peak_memory(results, args.max_memory_mb)
+    if args.b is not None or args.max_memory_mb is not None:
+        results['regressions'] = regressions
+
+    output_folder = os.path.dirname(os.path.abspath(args.o))
+    os.makedirs(output_folder, exist_ok=True)
+    with open(args.o, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    print_results(results)
+    if len(regressions) > 0:
+        print('PERFORMANCE REGRESSIONS:')
+        for r in regressions:
+            print(f'    {r}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark_entry_point()
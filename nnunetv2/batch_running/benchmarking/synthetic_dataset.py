@@ -0,0 +1,85 @@
+from typing import Tuple
+
+import SimpleITK as sitk
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p
+
+from nnunetv2.dataset_conversion.generate_dataset_json import generate_dataset_json
+
+
+def generate_synthetic_case(shape: Tuple[int, ...], num_classes: int, num_channels: int,
+                            rs: np.random.RandomState) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (images, seg). images has shape (num_channels, *shape) and is float32, seg has shape shape and is uint8.
+    The segmentation consists of randomly placed ellipsoids (one or more per foreground class). Each class has its own
+    mean intensity (differs per channel) plus gaussian noise, so that a network can actually learn something and
+    the evaluation/postprocessing see realistic (not empty) predictions.
+    """
+    seg = np.zeros(shape, dtype=np.uint8)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    for c in range(1, num_classes):
+        for _ in range(rs.randint(1, 3)):
+            center = [rs.uniform(0.2, 0.8) * s for s in shape]
+            radii = [max(1., rs.uniform(0.05, 0.2) * s) for s in shape]
+            dist = sum(((g - ce) / r) ** 2 for g, ce, r in zip(grid, center, radii))
+            seg[dist <= 1] = c
+
+    images = np.zeros((num_channels, *shape), dtype=np.float32)
+    for ch in range(num_channels):
+        class_means = rs.uniform(0, 1000, size=num_classes).astype(np.float32)
+        images[ch] = class_means[seg] + rs.normal(0, 100, size=shape).astype(np.float32)
+    return images, seg
+
+
+def generate_synthetic_dataset(raw_folder: str, dataset_name: str, num_cases: int = 10,
+                               shape: Tuple[int, ...] = (48, 64, 64), spacing: Tuple[float, ...] = (1., 1., 1.),
+                               num_classes: int = 3, num_channels: int = 1, shape_jitter: float = 0.1,
+                               seed: int = 1234) -> str:
+    """
+    Writes a synthetic dataset in nnU-Net format (imagesTr, labelsTr, dataset.json) to raw_folder/dataset_name.
+    shape and spacing are given as (z, y, x) for 3D. Anisotropy is achieved by simply using a larger spacing for one
+    axis, for example spacing=(5, 1, 1). Each case has a shape that randomly deviates from shape by up to shape_jitter
+    (relative) so that the fingerprint/planning see some variability. num_classes includes background.
+
+    Everything is determined by seed, so two calls with the same arguments produce identical datasets.
+
+    Returns the dataset folder
+    """
+    assert len(shape) == len(spacing), 'shape and spacing must have the same length'
+    assert len(shape) in (2, 3), 'only 2D and 3D datasets are supported'
+    assert num_classes >= 2, 'num_classes includes background and must be at least 2'
+    rs = np.random.RandomState(seed)
+
+    dataset_folder = join(raw_folder, dataset_name)
+    maybe_mkdir_p(join(dataset_folder, 'imagesTr'))
+    maybe_mkdir_p(join(dataset_folder, 'labelsTr'))
+
+    for i in range(num_cases):
+        case_shape = tuple(max(8, int(round(s * rs.uniform(1 - shape_jitter, 1 + shape_jitter)))) for s in shape)
+        images, seg = generate_synthetic_case(case_shape, num_classes, num_channels, rs)
+        identifier = f'case_{i:04d}'
+        # SimpleITK wants the spacing in x, y(, z) order
+        sitk_spacing = [float(s) for s in spacing[::-1]]
+        for ch in range(num_channels):
+            itk_image = sitk.GetImageFromArray(images[ch])
+            itk_image.SetSpacing(sitk_spacing)
+            sitk.WriteImage(itk_image, join(dataset_folder, 'imagesTr', f'{identifier}_{ch:04d}.nii.gz'))
+        itk_seg = sitk.GetImageFromArray(seg)
+        itk_seg.SetSpacing(sitk_spacing)
+        sitk.WriteImage(itk_seg, join(dataset_folder, 'labelsTr', f'{identifier}.nii.gz'))
+
+    generate_dataset_json(dataset_folder,
+                          channel_names={ch: 'CT' if ch == 0 else f'channel{ch}' for ch in range(num_channels)},
+                          labels={'background': 0, **{f'class{c}': c for c in range(1, num_classes)}},
+                          num_training_cases=num_cases,
+                          file_ending='.nii.gz',
+                          dataset_name=dataset_name,
+                          description='Synthetic dataset for benchmarking. Generated by '
+                                      'nnunetv2.batch_running.benchmarking.synthetic_dataset',
+                          shape=list(shape), spacing=list(spacing), seed=seed)
+    return dataset_folder
+
+
+if __name__ == '__main__':
+    generate_synthetic_dataset('/tmp/nnUNet_raw_synthetic', 'Dataset980_SyntheticBenchmark', num_cases=5,
+                               shape=(24, 64, 64), spacing=(5., 1., 1.))
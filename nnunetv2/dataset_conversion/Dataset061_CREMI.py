@@ -20,6 +20,7 @@ import numpy as np
 from nnunet.paths import nnUNet_raw_data, preprocessing_output_dir
 import shutil
 import SimpleITK as sitk
+from nnunetv2.dataset_conversion.generate_dataset_json import generate_dataset_json
 
 try:
     import h5py
@@ -47,6 +48,34 @@ def save_as_nifti(arr, filename, spacing):
     sitk.WriteImage(itk_img, filename)
 
 
+def convert_sample_to_h5(filename, image_out, label_out=None, spacing=(40., 4., 4.)):
+    """
+    Alternative to load_sample + save_as_nifti: copies raw data (and thresholded clefts) into chunked, compressed HDF5
+    files that can be read with nnunetv2.imageio.h5_reader_writer.H5IO. Copies slab by slab, so the volumes are never
+    entirely in memory. spacing is in array axis order (z, y, x)
+    """
+    with h5py.File(filename, 'r') as f:
+        raw = f['volumes']['raw']
+        _copy_slabwise(raw, image_out, 'raw', spacing, lambda x: x)
+        if label_out is not None and 'labels' in f['volumes'].keys():
+            # clefts are low values, background is high
+            _copy_slabwise(f['volumes']['labels']['clefts'], label_out, 'seg', spacing,
+                           lambda x: (x < 100000).astype(np.uint8))
+
+
+def _copy_slabwise(source, filename, key, spacing, fn, chunks=(8, 128, 128)):
+    chunks = tuple(min(c, s) for c, s in zip(chunks, source.shape))
+    with h5py.File(filename, 'w') as f:
+        out = None
+        for z in range(0, source.shape[0], chunks[0]):
+            slab = fn(source[z:z + chunks[0]])
+            if out is None:
+                out = f.create_dataset(key, shape=source.shape, dtype=slab.dtype, chunks=chunks, compression='gzip',
+                                       compression_opts=4)
+                out.attrs['spacing'] = [float(i) for i in spacing]
+            out[z:z + chunks[0]] = slab
+
+
 def prepare_submission():
     from cremi.io import CremiFile
     from cremi.Volume import Volume
@@ -89,49 +118,70 @@ if __name__ == "__main__":
 
     base = "/media/ps/passport2/ltc/CREMI/"
 
-    # train
-    img, label = load_sample(join(base, "sample_A_20160501.hdf"))
-    save_as_nifti(img, join(imagestr, "sample_a_0000.nii.gz"), (4, 4, 40))
-    save_as_nifti(label, join(labelstr, "sample_a.nii.gz"), (4, 4, 40))
-    img, label = load_sample(join(base, "sample_B_20160501.hdf"))
-    save_as_nifti(img, join(imagestr, "sample_b_0000.nii.gz"), (4, 4, 40))
-    save_as_nifti(label, join(labelstr, "sample_b.nii.gz"), (4, 4, 40))
-    img, label = load_sample(join(base, "sample_C_20160501.hdf"))
-    save_as_nifti(img, join(imagestr, "sample_c_0000.nii.gz"), (4, 4, 40))
-    save_as_nifti(label, join(labelstr, "sample_c.nii.gz"), (4, 4, 40))
-
-    save_as_nifti(img, join(imagestr, "sample_d_0000.nii.gz"), (4, 4, 40))
-    save_as_nifti(label, join(labelstr, "sample_d.nii.gz"), (4, 4, 40))
-
-    save_as_nifti(img, join(imagestr, "sample_e_0000.nii.gz"), (4, 4, 40))
-    save_as_nifti(label, join(labelstr, "sample_e.nii.gz"), (4, 4, 40))
-
-    # test
-    img, label = load_sample(join(base, "sample_A+_20160601.hdf"))
-    save_as_nifti(img, join(imagests, "sample_a+_0000.nii.gz"), (4, 4, 40))
-    img, label = load_sample(join(base, "sample_B+_20160601.hdf"))
-    save_as_nifti(img, join(imagests, "sample_b+_0000.nii.gz"), (4, 4, 40))
-    img, label = load_sample(join(base, "sample_C+_20160601.hdf"))
-    save_as_nifti(img, join(imagests, "sample_c+_0000.nii.gz"), (4, 4, 40))
-
-    json_dict = OrderedDict()
-    json_dict['name'] = foldername
-    json_dict['description'] = foldername
-    json_dict['tensorImageSize'] = "4D"
-    json_dict['reference'] = "see challenge website"
-    json_dict['licence'] = "see challenge website"
-    json_dict['release'] = "0.0"
-    json_dict['modality'] = {
-        "0": "EM",
-    }
-    json_dict['labels'] = {i: str(i) for i in range(2)}
-
-    json_dict['numTraining'] = 5
-    json_dict['numTest'] = 1
-    json_dict['training'] = [{'image': "./imagesTr/sample_%s.nii.gz" % i, "label": "./labelsTr/sample_%s.nii.gz" % i} for i in
-                             ['a', 'b', 'c', 'd', 'e']]
-
-    json_dict['test'] = ["./imagesTs/sample_a+.nii.gz", "./imagesTs/sample_b+.nii.gz", "./imagesTs/sample_c+.nii.gz"]
-
-    save_json(json_dict, os.path.join(out_base, "dataset.json"))
+    # set to True to convert to HDF5 (use H5IO, file ending .h5) instead of nifti. Conversion is faster, needs much
+    # less RAM and the data stays chunked + compressed
+    export_h5 = False
+
+    if export_h5:
+        for s, f in zip(['a', 'b', 'c', 'd', 'e'], ["sample_A_20160501.hdf", "sample_B_20160501.hdf",
+                                                    "sample_C_20160501.hdf", "sample_C_20160501.hdf",
+                                                    "sample_C_20160501.hdf"]):
+            convert_sample_to_h5(join(base, f), join(imagestr, "sample_%s_0000.h5" % s), join(labelstr, "sample_%s.h5" % s))
+        for s, f in zip(['a+', 'b+', 'c+'], ["sample_A+_20160601.hdf", "sample_B+_20160601.hdf",
+                                             "sample_C+_20160601.hdf"]):
+            convert_sample_to_h5(join(base, f), join(imagests, "sample_%s_0000.h5" % s))
+    else:
+        # train
+        img, label = load_sample(join(base, "sample_A_20160501.hdf"))
+        save_as_nifti(img, join(imagestr, "sample_a_0000.nii.gz"), (4, 4, 40))
+        save_as_nifti(label, join(labelstr, "sample_a.nii.gz"), (4, 4, 40))
+        img, label = load_sample(join(base, "sample_B_20160501.hdf"))
+        save_as_nifti(img, join(imagestr, "sample_b_0000.nii.gz"), (4, 4, 40))
+        save_as_nifti(label, join(labelstr, "sample_b.nii.gz"), (4, 4, 40))
+        img, label = load_sample(join(base, "sample_C_20160501.hdf"))
+        save_as_nifti(img, join(imagestr, "sample_c_0000.nii.gz"), (4, 4, 40))
+        save_as_nifti(label, join(labelstr, "sample_c.nii.gz"), (4, 4, 40))
+
+        save_as_nifti(img, join(imagestr, "sample_d_0000.nii.gz"), (4, 4, 40))
+        save_as_nifti(label, join(labelstr, "sample_d.nii.gz"), (4, 4, 40))
+
+        save_as_nifti(img, join(imagestr, "sample_e_0000.nii.gz"), (4, 4, 40))
+        save_as_nifti(label, join(labelstr, "sample_e.nii.gz"), (4, 4, 40))
+
+        # test
+        img, label = load_sample(join(base, "sample_A+_20160601.hdf"))
+        save_as_nifti(img, join(imagests, "sample_a+_0000.nii.gz"), (4, 4, 40))
+        img, label = load_sample(join(base, "sample_B+_20160601.hdf"))
+        save_as_nifti(img, join(imagests, "sample_b+_0000.nii.gz"), (4, 4, 40))
+        img, label = load_sample(join(base, "sample_C+_20160601.hdf"))
+        save_as_nifti(img, join(imagests, "sample_c+_0000.nii.gz"), (4, 4, 40))
+
+    if export_h5:
+        # nnU-Net v2 dataset.json. H5IO is found through the file ending, but let's be explicit
+        generate_dataset_json(out_base, channel_names={0: 'EM'}, labels={'background': 0, 'cleft': 1},
+                              num_training_cases=5, file_ending='.h5', dataset_name=foldername,
+                              reference='see challenge website', license='see challenge website',
+                              description=foldername, overwrite_image_reader_writer='H5IO')
+    else:
+        ending = ".nii.gz"
+        json_dict = OrderedDict()
+        json_dict['name'] = foldername
+        json_dict['description'] = foldername
+        json_dict['tensorImageSize'] = "4D"
+        json_dict['reference'] = "see challenge website"
+        json_dict['licence'] = "see challenge website"
+        json_dict['release'] = "0.0"
+        json_dict['modality'] = {
+            "0": "EM",
+        }
+        json_dict['labels'] = {i: str(i) for i in range(2)}
+
+        json_dict['numTraining'] = 5
+        json_dict['numTest'] = 1
+        json_dict['training'] = [{'image': "./imagesTr/sample_%s%s" % (i, ending), "label": "./labelsTr/sample_%s%s" % (i, ending)}
+                                 for i in ['a', 'b', 'c', 'd', 'e']]
+
+        json_dict['test'] = ["./imagesTs/sample_%s%s" % (i, ending) for i in ['a+', 'b+', 'c+']]
+
+        save_json(json_dict, os.path.join(out_base, "dataset.json"))
     # prepare_submission()
\ No newline at end of file
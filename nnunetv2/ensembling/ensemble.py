@@ -1,49 +1,100 @@
 import argparse
 import multiprocessing
 import shutil
-from copy import deepcopy
+from contextlib import nullcontext
 from multiprocessing import Pool
-from typing import List, Union, Tuple
+from typing import List, Union, Tuple, Iterator
 
 import numpy as np
-from batchgenerators.utilities.file_and_folder_operations import load_json, join, subfiles, \
-    maybe_mkdir_p, isdir, save_pickle, load_pickle, isfile
+import torch
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, maybe_mkdir_p, isdir, \
+    save_pickle, load_pickle, isfile
 from nnunetv2.configuration import default_num_processes
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
+from nnunetv2.utilities.output_encoding import load_probabilities, open_probabilities, ProbabilityWriter, \
+    strip_probability_file_ending, find_probability_files, PROBABILITY_FORMATS
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
 
 
-def average_probabilities(list_of_files: List[str]) -> np.ndarray:
+def average_probabilities(list_of_files: List[str], num_threads: int = 1) -> np.ndarray:
+    """
+    files can be any of the formats in nnunetv2.utilities.output_encoding (also mixed)
+    """
     assert len(list_of_files), 'At least one file must be given in list_of_files'
     avg = None
     for f in list_of_files:
         if avg is None:
-            avg = np.load(f)['probabilities']
-            # maybe increase precision to prevent rounding errors
-            if avg.dtype != np.float32:
-                avg = avg.astype(np.float32)
+            # maybe increase precision to prevent rounding errors. Always copy, .npy files are read only memmaps
+            avg = np.array(load_probabilities(f, num_threads), dtype=np.float32)
         else:
-            avg += np.load(f)['probabilities']
+            avg += load_probabilities(f, num_threads)
     avg /= len(list_of_files)
     return avg
 
 
+def iterate_average_probabilities(probabilities: List[np.ndarray], slab_size: int,
+                                  device: torch.device = None) -> Iterator[Tuple[Tuple[slice, slice],
+                                                                                 Union[np.ndarray, torch.Tensor]]]:
+    """
+    Same average as average_probabilities, but computed slab by slab along the first spatial axis. probabilities
+    are (c, x, y(, z)) arrays that are only read where they are sliced (see open_probabilities). Yields
+    (slicer, average of probabilities[slicer]). float32 numpy arrays, torch tensors on device if device is given
+    """
+    shape = probabilities[0].shape
+    assert all([p.shape == shape for p in probabilities]), 'All probabilities must have the same shape'
+    for start in range(0, shape[1], slab_size):
+        slicer = (slice(None), slice(start, min(start + slab_size, shape[1])))
+        avg = None
+        for p in probabilities:
+            slab = np.ascontiguousarray(p[slicer])
+            if device is not None:
+                # transfer float16, accumulate float32. torch wants writable arrays (memmaps are read only)
+                slab = torch.from_numpy(slab if slab.flags.writeable else slab.copy()).to(device)
+            if avg is None:
+                avg = slab.float() if device is not None else slab.astype(np.float32)
+            else:
+                avg += slab
+        avg /= len(probabilities)
+        yield slicer, avg
+
+
 def merge_files(list_of_files,
                 output_filename_truncated: str,
                 output_file_ending: str,
                 image_reader_writer: BaseReaderWriter,
                 label_manager: LabelManager,
-                save_probabilities: bool = False):
+                save_probabilities: bool = False,
+                probabilities_format: str = 'npz',
+                num_compression_threads: int = 1,
+                device: torch.device = None,
+                max_values_per_slab: int = 16777216):
+    """
+    The probabilities are averaged and converted to a segmentation in slabs along the first spatial axis, so apart
+    from the segmentation itself no full volume is ever held in memory. max_values_per_slab (number of probability
+    values, all channels) limits the size of a slab (16777216: 64 MB float32).
+
+    device: if given (for example torch.device('cuda')) averaging and segmentation run on this device
+    """
     # load the pkl file associated with the first file in list_of_files
-    properties = load_pickle(list_of_files[0][:-4] + '.pkl')
-    # load and average predictions
-    probabilities = average_probabilities(list_of_files)
-    segmentation = label_manager.convert_logits_to_segmentation(probabilities)
+    properties = load_pickle(strip_probability_file_ending(list_of_files[0]) + '.pkl')
+    probabilities = [open_probabilities(f, num_compression_threads) for f in list_of_files]
+    shape = probabilities[0].shape
+    slab_size = max(1, max_values_per_slab // int(np.prod(shape[:1] + shape[2:])))
+    segmentation = np.zeros(shape[1:], dtype=np.uint8 if max(label_manager.all_labels) < 256 else np.uint16)
+    with ProbabilityWriter(output_filename_truncated, shape, probabilities_format, num_compression_threads) \
+            if save_probabilities else nullcontext() as writer:
+        for slicer, avg in iterate_average_probabilities(probabilities, slab_size, device):
+            seg = label_manager.convert_logits_to_segmentation(avg)
+            if isinstance(seg, torch.Tensor):
+                seg = seg.cpu().numpy()
+                avg = avg.cpu().numpy()
+            segmentation[slicer[1:]] = seg
+            if writer is not None:
+                writer[slicer] = avg
     image_reader_writer.write_seg(segmentation, output_filename_truncated + output_file_ending, properties)
     if save_probabilities:
-        np.savez_compressed(output_filename_truncated + '.npz', probabilities=probabilities)
-        save_pickle(probabilities, output_filename_truncated + '.pkl')
+        save_pickle(properties, output_filename_truncated + '.pkl')
 
 
 def ensemble_folders(list_of_input_folders: List[str],
@@ -51,7 +102,10 @@ def ensemble_folders(list_of_input_folders: List[str],
                      save_merged_probabilities: bool = False,
                      num_processes: int = default_num_processes,
                      dataset_json_file_or_dict: str = None,
-                     plans_json_file_or_dict: str = None):
+                     plans_json_file_or_dict: str = None,
+                     probabilities_format: str = 'npz',
+                     num_compression_threads: int = 1,
+                     device: torch.device = None):
     """we need too much shit for this function. Problem is that we now have to support region-based training plus
     multiple input/output formats so there isn't really a way around this.
 
@@ -59,7 +113,14 @@ def ensemble_folders(list_of_input_folders: List[str],
     and/or dataset.json in it. These are usually copied into those folders by nnU-Net during prediction.
     We just pick the dataset.json and plans.json from the first of the folders and we DONT check whether the 5
     folders contain the same plans etc! This can be a feature if results from different datasets are to be merged (only
-    works if label dict in dataset.json is the same between these datasets!!!)"""
+    works if label dict in dataset.json is the same between these datasets!!!)
+
+    The input folders may contain probabilities in any of the formats of nnunetv2.utilities.output_encoding.
+    probabilities_format is the format of the merged probabilities (if save_merged_probabilities).
+    num_compression_threads is used by each process for (de)compression.
+    Probabilities are merged slab by slab (see merge_files). Inputs in npy or blosc2 format are read piece by piece,
+    npz inputs are decompressed to temporary files first. device (optional): average on this device (see
+    merge_files)"""
     if dataset_json_file_or_dict is not None:
         if isinstance(dataset_json_file_or_dict, str):
             dataset_json = load_json(dataset_json_file_or_dict)
@@ -79,18 +140,20 @@ def ensemble_folders(list_of_input_folders: List[str],
     plans_manager = PlansManager(plans)
 
     # now collect the files in each of the folders and enforce that all files are present in all folders
-    files_per_folder = [set(subfiles(i, suffix='.npz', join=False)) for i in list_of_input_folders]
-    # first build a set with all files
-    s = deepcopy(files_per_folder[0])
+    # (identifier -> file name, so that folders can use different formats)
+    files_per_folder = [{strip_probability_file_ending(fi): fi for fi in find_probability_files(i, join=False)}
+                        for i in list_of_input_folders]
+    # first build a set with all identifiers
+    s = set(files_per_folder[0].keys())
     for f in files_per_folder[1:]:
-        s.update(f)
+        s.update(f.keys())
     for f in files_per_folder:
-        assert len(s.difference(f)) == 0, "Not all folders contain the same files for ensembling. Please only " \
-                                          "provide folders that contain the predictions"
-    lists_of_lists_of_files = [[join(fl, fi) for fl in list_of_input_folders] for fi in s]
-    output_files_truncated = [join(output_folder, fi[:-4]) for fi in s]
+        assert len(s.difference(f.keys())) == 0, "Not all folders contain the same files for ensembling. Please " \
+                                                 "only provide folders that contain the predictions"
+    lists_of_lists_of_files = [[join(fl, f[i]) for fl, f in zip(list_of_input_folders, files_per_folder)] for i in s]
+    output_files_truncated = [join(output_folder, i) for i in s]
 
-    image_reader_writer = plans_manager.image_reader_writer_class()
+    image_reader_writer = plans_manager.image_reader_writer_class(num_compression_threads=num_compression_threads)
     label_manager = plans_manager.get_label_manager(dataset_json)
 
     maybe_mkdir_p(output_folder)
@@ -106,7 +169,10 @@ def ensemble_folders(list_of_input_folders: List[str],
                 [dataset_json['file_ending']] * num_preds,
                 [image_reader_writer] * num_preds,
                 [label_manager] * num_preds,
-                [save_merged_probabilities] * num_preds
+                [save_merged_probabilities] * num_preds,
+                [probabilities_format] * num_preds,
+                [num_compression_threads] * num_preds,
+                [device] * num_preds
             )
         )
 
@@ -119,19 +185,39 @@ def entry_point_ensemble_folders():
     parser.add_argument('-np', type=int, required=False, default=default_num_processes,
                         help=f"Numbers of processes used for ensembling. Default: {default_num_processes}")
     parser.add_argument('--save_npz', action='store_true', required=False, help='Set this flag to store output '
-                                                                                'probabilities in separate .npz files')
+                                                                                'probabilities in separate files '
+                                                                                '(format: -prob_format)')
+    parser.add_argument('-prob_format', type=str, required=False, default='npz',
+                        choices=list(PROBABILITY_FORMATS.keys()),
+                        help='Only relevant with --save_npz. How the merged probabilities are stored. npz: '
+                             'compressed, single threaded (default). npy: uncompressed, fastest but large. blosc2: '
+                             'multithreaded zstd compression, requires blosc2 (pip install blosc2). The input folders '
+                             'can have any of these formats')
+    parser.add_argument('-compression_threads', type=int, required=False, default=1,
+                        help='Number of threads each process (-np) uses for (de)compressing probabilities (blosc2) '
+                             'and segmentations (.nii.gz). Default: 1')
+    parser.add_argument('-device', type=str, default='cpu', required=False,
+                        help="Device used for averaging the probabilities: 'cpu' (default), 'cuda' or 'mps'. Do NOT "
+                             "use this to set which GPU ID! Use CUDA_VISIBLE_DEVICES=X nnUNetv2_ensemble [...] instead!")
 
     args = parser.parse_args()
-    ensemble_folders(args.i, args.o, args.save_npz, args.np)
+    assert args.device in ['cpu', 'cuda',
+                           'mps'], f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {args.device}.'
+    ensemble_folders(args.i, args.o, args.save_npz, args.np, probabilities_format=args.prob_format,
+                     num_compression_threads=args.compression_threads,
+                     device=None if args.device == 'cpu' else torch.device(args.device))
 
 
 def ensemble_crossvalidations(list_of_trained_model_folders: List[str],
                               output_folder: str,
                               folds: Union[Tuple[int, ...], List[int]] = (0, 1, 2, 3, 4),
                               num_processes: int = default_num_processes,
-                              overwrite: bool = True) -> None:
+                              overwrite: bool = True,
+                              device: torch.device = None) -> None:
     """
     Feature: different configurations can now have different splits
+
+    device (optional): average the probabilities on this device (see merge_files)
     """
     dataset_json = load_json(join(list_of_trained_model_folders[0], 'dataset.json'))
     plans_manager = PlansManager(join(list_of_trained_model_folders[0], 'plans.json'))
@@ -145,12 +231,13 @@ def ensemble_crossvalidations(list_of_trained_model_folders: List[str],
             if not isdir(join(tr, f'fold_{f}', 'validation')):
                 raise RuntimeError(f'Expected model output directory does not exist. You must train all requested '
                                    f'folds of the specified model.\nModel: {tr}\nFold: {f}')
-            files_here = subfiles(join(tr, f'fold_{f}', 'validation'), suffix='.npz', join=False)
+            files_here = find_probability_files(join(tr, f'fold_{f}', 'validation'), join=False)
             if len(files_here) == 0:
                 raise RuntimeError(f"No .npz files found in folder {join(tr, f'fold_{f}', 'validation')}. Rerun your "
                                    f"validation with the --npz flag. Use nnUNetv2_train [...] --val --npz.")
-            files_per_folder[tr][f] = subfiles(join(tr, f'fold_{f}', 'validation'), suffix='.npz', join=False)
-            unique_filenames.update(files_per_folder[tr][f])
+            # identifier -> file name
+            files_per_folder[tr][f] = {strip_probability_file_ending(i): i for i in files_here}
+            unique_filenames.update(files_per_folder[tr][f].keys())
 
     # verify that all trained_model_folders have all predictions
     ok = True
@@ -170,14 +257,14 @@ def ensemble_crossvalidations(list_of_trained_model_folders: List[str],
     for tr in list_of_trained_model_folders:
         file_mapping.append({})
         for f in folds:
-            for fi in files_per_folder[tr][f]:
+            for identifier, fi in files_per_folder[tr][f].items():
                 # check for duplicates
-                assert fi not in file_mapping[-1].keys(), f"Duplicate detected. Case {fi} is present in more than " \
-                                                          f"one fold of model {tr}."
-                file_mapping[-1][fi] = join(tr, f'fold_{f}', 'validation', fi)
+                assert identifier not in file_mapping[-1].keys(), f"Duplicate detected. Case {identifier} is " \
+                                                                  f"present in more than one fold of model {tr}."
+                file_mapping[-1][identifier] = join(tr, f'fold_{f}', 'validation', fi)
 
     lists_of_lists_of_files = [[fm[i] for fm in file_mapping] for i in unique_filenames]
-    output_files_truncated = [join(output_folder, fi[:-4]) for fi in unique_filenames]
+    output_files_truncated = [join(output_folder, i) for i in unique_filenames]
 
     image_reader_writer = plans_manager.image_reader_writer_class()
     maybe_mkdir_p(output_folder)
@@ -198,7 +285,10 @@ def ensemble_crossvalidations(list_of_trained_model_folders: List[str],
                 [dataset_json['file_ending']] * num_preds,
                 [image_reader_writer] * num_preds,
                 [label_manager] * num_preds,
-                [False] * num_preds
+                [False] * num_preds,
+                ['npz'] * num_preds,
+                [1] * num_preds,
+                [device] * num_preds
             )
         )
 
@@ -18,6 +18,8 @@ from medpy import metric
 import multiprocessing 
 import time
 from sklearn import metrics
+from nnunetv2.evaluation.gt_distance_cache import get_distance_to_foreground, default_gt_edt_cache_dir
+from nnunetv2.utilities.results_store import append_result, load_results, compact_results
 try:
     import h5py
 except ImportError:
@@ -25,15 +27,21 @@ except ImportError:
 
 class Clefts:
 
-    def __init__(self, test, truth):
+    def __init__(self, test, truth, truth_clefts_edt: np.ndarray = None):
+        """
+        truth_clefts_edt: optional, precomputed distance to the truth foreground (see gt_distance_cache). Computed
+        here if not given
+        """
 
         # background is True, foreground is False
         self.test_clefts_mask = ~(sitk.GetArrayFromImage(test).astype(bool))
         self.truth_clefts_mask = ~(sitk.GetArrayFromImage(truth).astype(bool))
-	
+
         # distance to foreground
         self.test_clefts_edt = ndimage.distance_transform_edt(self.test_clefts_mask, sampling=np.flip(test.GetSpacing()))
-        self.truth_clefts_edt = ndimage.distance_transform_edt(self.truth_clefts_mask, sampling=np.flip(test.GetSpacing()))
+        if truth_clefts_edt is None:
+            truth_clefts_edt = ndimage.distance_transform_edt(self.truth_clefts_mask, sampling=np.flip(test.GetSpacing()))
+        self.truth_clefts_edt = truth_clefts_edt
 
         self.all_zero = False
         
@@ -95,10 +103,10 @@ class Clefts:
 cal_filename = "predictionsTs"
 
 
-def evaluate_one(pred,gt_label,file_name):
+def evaluate_one(pred,gt_label,file_name,truth_clefts_edt=None):
     print(f"evaluating {file_name}...")
 
-    clefts_evaluation = Clefts(pred, gt_label)
+    clefts_evaluation = Clefts(pred, gt_label, truth_clefts_edt)
 
     false_positive_count = clefts_evaluation.count_false_positives()
     false_negative_count = clefts_evaluation.count_false_negatives()
@@ -120,57 +128,60 @@ def evaluate_one(pred,gt_label,file_name):
     
     return false_positive_count,false_negative_count,false_positive_stats,false_negative_stats
 
-def evaluate_one_and_save(pred,gt_label,file_name,pred_dir):
-    
-    false_positive_count, false_negative_count, false_positive_stats, false_negative_stats = evaluate_one(pred,gt_label,file_name)
-    with open(os.path.join(pred_dir,cal_filename)+'.json', 'r') as json_file:
-        result_dict = json.load(json_file)
-    result_dict['detailed'][file_name] = {
+def evaluate_one_and_save(pred_file,gt_file,file_name,pred_dir,edt_cache_dir=default_gt_edt_cache_dir):
+    # the images are read by the workers, only the file names are sent to them
+    pred = sitk.ReadImage(pred_file)
+    gt_label = sitk.ReadImage(gt_file)
+    # the distance to the ground truth does not depend on the prediction, so it is cached across evaluations
+    truth_clefts_edt = get_distance_to_foreground(gt_file, np.flip(pred.GetSpacing()), edt_cache_dir,
+                                                  sitk.GetArrayFromImage(gt_label))
+
+    false_positive_count, false_negative_count, false_positive_stats, false_negative_stats = evaluate_one(pred,gt_label,file_name,truth_clefts_edt)
+    # only append. The summary is written by the main process once all cases are done
+    append_result(os.path.join(pred_dir,cal_filename)+'.jsonl', file_name, {
         "false positives": false_positive_count,
         "false negatives": false_negative_count,
         "distance to ground truth": false_positive_stats,
         "distance to proposal": false_negative_stats,
-        "cremi score": (false_positive_stats['mean']+false_negative_stats['mean'])/2}
-    with open(os.path.join(pred_dir,cal_filename)+'.json', 'w') as json_file:
-        json.dump(result_dict, json_file, indent=4)
-        
-def evaluation(pred_dir,c,num_workers):
+        "cremi score": (false_positive_stats['mean']+false_negative_stats['mean'])/2})
+
+def evaluation(pred_dir,c,num_workers,edt_cache_dir=default_gt_edt_cache_dir):
 
     names = ['sample_c.nii.gz']
     GT_dir="/media/ps/passport2/ltc/nnUNetv2/nnUNet_raw/Dataset061_CREMI/labelsTs"
 
+    store_file = os.path.join(pred_dir,cal_filename)+'.jsonl'
+    if not c and os.path.isfile(store_file):
+        os.remove(store_file)
+    if c and not os.path.isfile(store_file) and os.path.isfile(os.path.join(pred_dir,cal_filename)+'.json'):
+        # evaluation from before there was a results store. Take over its results
+        with open(os.path.join(pred_dir,cal_filename)+'.json', 'r') as json_file:
+            for name, result in json.load(json_file)['detailed'].items():
+                append_result(store_file, name, result)
+    done = load_results(store_file)
+
     with multiprocessing.get_context("spawn").Pool(num_workers) as export_pool:
         tasks_record = []
-        
-        if not c or not os.path.exists(os.path.join(pred_dir,cal_filename)+'.json'):
-            result_dict = {
-                "name": pred_dir,
-                "mean": {},
-                "detailed": {}}
-            with open(os.path.join(pred_dir,cal_filename)+'.json', 'w') as json_file:
-                json.dump(result_dict, json_file, indent=4)
-
         for name in sorted(names):
-            try:
-                gt_label = sitk.ReadImage(join(GT_dir, name))
-                pred = sitk.ReadImage(join(pred_dir, name))
-            except:
+            if name in done.keys() or not isfile(join(pred_dir, name)) or not isfile(join(GT_dir, name)):
                 continue
-            
-            if name not in result_dict['detailed'].keys():
-                while len([r for r in tasks_record if not r.ready()]) >= num_workers:
-                    time.sleep(0.1)  
-                r = export_pool.starmap_async(evaluate_one_and_save, ((pred,gt_label,name,pred_dir),))
-                tasks_record.append(r)
-                
+
+            while len([r for r in tasks_record if not r.ready()]) >= num_workers:
+                time.sleep(0.1)
+            r = export_pool.starmap_async(evaluate_one_and_save, ((join(pred_dir, name),join(GT_dir, name),name,pred_dir,edt_cache_dir),))
+            tasks_record.append(r)
+
         ret = [i.get() for i in tasks_record]
-    
-    with open(os.path.join(pred_dir,cal_filename)+'.json', 'r') as json_file:
-        result_dict = json.load(json_file)
-    result_dict['mean']['average cremi score'] = np.array([result_dict['detailed'][name]['cremi score'] for name in names]).mean()
+
+    # the workers only appended their results to the store
+    detailed = compact_results(store_file)
+    result_dict = {
+        "name": pred_dir,
+        "mean": {'average cremi score': np.array([detailed[name]['cremi score'] for name in names if name in detailed.keys()]).mean()},
+        "detailed": detailed}
     with open(os.path.join(pred_dir,cal_filename)+'.json', 'w') as json_file:
         json.dump(result_dict, json_file, indent=4)
-        
+
     print(f"average cremi score: {result_dict['mean']['average cremi score']}")
     
     return result_dict
@@ -180,10 +191,16 @@ def main():
     parser.add_argument('-p', '--pred_dir', help="pred_exp_name",default="/media/ps/passport2/ltc/nnUNetv2/nnUNet_outputs/CREMI/3d_lowres/fold2/patch32_160_160_step0.5_chkfinal_down1.0_1.0_1.0/stage_2/save_stage2_roi_th_0.001_level_sample_3.0_16.0_16.0_patch_12_128_128_center_canvas_12_128_128_shuffle_False_nms_0.75_prior_False_expand0_itc_4.0_pix_6.0_child_nmm_0.35_crop_12_128_128_max_fullres/", required=False)
     parser.add_argument('--continue_evaluation', action='store_true', default=False)
     parser.add_argument('--num_workers', type=int, default=5)
+    parser.add_argument('--edt_cache_dir', type=str, default=default_gt_edt_cache_dir,
+                        help='where the distance transforms of the ground truth are cached. Default: environment '
+                             'variable nnUNet_edt_cache or ~/.cache/nnunetv2/gt_edt')
+    parser.add_argument('--no_edt_cache', action='store_true', default=False,
+                        help='compute the distance transforms of the ground truth every time')
     
     args = parser.parse_args()
 
-    evaluation(pred_dir=args.pred_dir,c=args.continue_evaluation,num_workers=args.num_workers)
+    evaluation(pred_dir=args.pred_dir,c=args.continue_evaluation,num_workers=args.num_workers,
+               edt_cache_dir=None if args.no_edt_cache else args.edt_cache_dir)
     
     
         
@@ -12,6 +12,7 @@ from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json, \
     determine_reader_writer_from_file_ending
 from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
+from nnunetv2.evaluation.surface_distance import compute_surface_metrics_for_regions, SURFACE_METRICS
 # the Evaluator class of the previous nnU-Net was great and all but man was it overengineered. Keep it simple
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
@@ -86,68 +87,173 @@ def compute_tp_fp_fn_tn(mask_ref: np.ndarray, mask_pred: np.ndarray, ignore_mask
     return tp, fp, fn, tn
 
 
+def compute_confusion_matrix(seg_ref: np.ndarray, seg_pred: np.ndarray, ignore_label: int = None,
+                             chunk_size: int = 262144) -> np.ndarray:
+    """
+    Returns the joint histogram of reference and prediction: confusion_matrix[i, j] is the number of voxels with
+    label i in seg_ref and label j in seg_pred. Computed in a single pass over the volume (np.bincount of
+    ref * K + pred). Voxels that are ignore_label in the reference are not counted.
+
+    The volume is processed in chunks of chunk_size voxels so that the integer temporaries stay small (allocating
+    full size int64 arrays is slower than the counting itself).
+
+    Labels must be non-negative integers (float arrays as returned by read_seg are fine).
+    """
+    assert seg_ref.shape == seg_pred.shape, f'shape mismatch between reference {seg_ref.shape} and prediction ' \
+                                            f'{seg_pred.shape}'
+    seg_ref = seg_ref.reshape(-1)
+    seg_pred = seg_pred.reshape(-1)
+    assert min(seg_ref.min(initial=0), seg_pred.min(initial=0)) >= 0, 'labels must not be negative'
+    num_classes = int(max(seg_ref.max(initial=0), seg_pred.max(initial=0))) + 1
+    if num_classes <= 4096:
+        confusion_matrix = np.zeros(num_classes ** 2, dtype=np.int64)
+        for start in range(0, seg_ref.size, chunk_size):
+            joint = seg_ref[start:start + chunk_size].astype(np.intp)
+            joint *= num_classes
+            joint += seg_pred[start:start + chunk_size].astype(np.intp)
+            confusion_matrix += np.bincount(joint, minlength=num_classes ** 2)
+        confusion_matrix = confusion_matrix.reshape(num_classes, num_classes)
+    else:
+        # too many bins. Only count the label combinations that actually exist
+        pairs, counts = np.unique(np.stack((seg_ref, seg_pred)).astype(np.intp), axis=1, return_counts=True)
+        confusion_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+        confusion_matrix[pairs[0], pairs[1]] = counts
+    if ignore_label is not None and ignore_label < num_classes:
+        # all ignored voxels are in this row
+        confusion_matrix[ignore_label] = 0
+    return confusion_matrix
+
+
+def compute_confusion_matrix_in_slabs(seg_ref, seg_pred, ignore_label: int = None,
+                                     slab_voxels: int = 16777216) -> np.ndarray:
+    """
+    Same result as compute_confusion_matrix, but seg_ref and seg_pred (shape (c, x, y, z)) are only accessed in slabs
+    along the first spatial axis of about slab_voxels voxels each. Meant for the array-likes returned by
+    H5IO.read_seg_lazy, which only read the slab that is requested, so the volumes never have to fit into RAM
+    """
+    assert seg_ref.shape == seg_pred.shape, f'shape mismatch between reference {seg_ref.shape} and prediction ' \
+                                            f'{seg_pred.shape}'
+    step = max(1, slab_voxels // int(np.prod(seg_ref.shape[2:])))
+    confusion_matrix = np.zeros((1, 1), dtype=np.int64)
+    for start in range(0, seg_ref.shape[1], step):
+        slab = compute_confusion_matrix(seg_ref[:, start:start + step], seg_pred[:, start:start + step])
+        if slab.shape[0] > confusion_matrix.shape[0]:
+            confusion_matrix = np.pad(confusion_matrix, (0, slab.shape[0] - confusion_matrix.shape[0]))
+        confusion_matrix[:slab.shape[0], :slab.shape[1]] += slab
+    if ignore_label is not None and ignore_label < confusion_matrix.shape[0]:
+        confusion_matrix[ignore_label] = 0
+    return confusion_matrix
+
+
+def tp_fp_fn_tn_from_confusion_matrix(confusion_matrix: np.ndarray, region_or_label: Union[int, Tuple[int, ...]]):
+    """
+    same result as compute_tp_fp_fn_tn(region_or_label_to_mask(ref, r), region_or_label_to_mask(pred, r),
+    ignore_mask) but from the confusion matrix returned by compute_confusion_matrix
+    """
+    in_region = np.zeros(confusion_matrix.shape[0], dtype=bool)
+    for r in np.atleast_1d(region_or_label):
+        # labels that are not in the confusion matrix don't occur in either segmentation
+        if r < len(in_region):
+            in_region[r] = True
+    tp = confusion_matrix[in_region][:, in_region].sum()
+    fp = confusion_matrix[~in_region][:, in_region].sum()
+    fn = confusion_matrix[in_region][:, ~in_region].sum()
+    tn = confusion_matrix.sum() - tp - fp - fn
+    return tp, fp, fn, tn
+
+
+def metrics_from_confusion_matrix(confusion_matrix: np.ndarray,
+                                  labels_or_regions: Union[List[int], List[Union[int, Tuple[int, ...]]]]) -> dict:
+    """
+    Dice, IoU, FP, TP, FN, TN, n_pred, n_ref for each label/region. Returns {label_or_region: {metric: value}}
+    """
+    metrics = {}
+    for r in labels_or_regions:
+        metrics[r] = {}
+        tp, fp, fn, tn = tp_fp_fn_tn_from_confusion_matrix(confusion_matrix, r)
+        if tp + fp + fn == 0:
+            metrics[r]['Dice'] = np.nan
+            metrics[r]['IoU'] = np.nan
+        else:
+            metrics[r]['Dice'] = 2 * tp / (2 * tp + fp + fn)
+            metrics[r]['IoU'] = tp / (tp + fp + fn)
+        metrics[r]['FP'] = fp
+        metrics[r]['TP'] = tp
+        metrics[r]['FN'] = fn
+        metrics[r]['TN'] = tn
+        metrics[r]['n_pred'] = fp + tp
+        metrics[r]['n_ref'] = fn + tp
+    return metrics
+
+
 def compute_metrics(reference_file: str, prediction_file: str, image_reader_writer: BaseReaderWriter,
                     labels_or_regions: Union[List[int], List[Union[int, Tuple[int, ...]]]],
-                    ignore_label: int = None) -> dict:
+                    ignore_label: int = None,
+                    surface_metrics: Optional[Tuple[str, ...]] = None,
+                    nsd_tolerance: float = 1.,
+                    surface_mode: str = 'surfel') -> dict:
+    """
+    surface_metrics: optional, any of nnunetv2.evaluation.surface_distance.SURFACE_METRICS ('HD95', 'ASSD', 'NSD').
+    nsd_tolerance and the surface distances are in the units of the spacing (usually mm). See surface_distance.py for
+    surface_mode. Voxels that are ignore_label in the reference are excluded from the surface metrics as well
+
+    Reader/writers that can read lazily (H5IO) are evaluated slab by slab unless surface metrics are requested (those
+    need the entire volume)
+    """
+    want_surface_metrics = surface_metrics is not None and len(surface_metrics) > 0
+    if not want_surface_metrics and hasattr(image_reader_writer, 'read_seg_lazy'):
+        seg_ref, _ = image_reader_writer.read_seg_lazy(reference_file)
+        seg_pred, _ = image_reader_writer.read_seg_lazy(prediction_file)
+        confusion_matrix = compute_confusion_matrix_in_slabs(seg_ref, seg_pred, ignore_label)
+        return {'reference_file': reference_file, 'prediction_file': prediction_file,
+                'metrics': metrics_from_confusion_matrix(confusion_matrix, labels_or_regions)}
+
     # load images
     seg_ref, seg_ref_dict = image_reader_writer.read_seg(reference_file)
     seg_pred, seg_pred_dict = image_reader_writer.read_seg(prediction_file)
-    # spacing = seg_ref_dict['spacing']
 
-    ignore_mask = seg_ref == ignore_label if ignore_label is not None else None
+    # one pass over the volume for all labels/regions instead of several per label
+    confusion_matrix = compute_confusion_matrix(seg_ref, seg_pred, ignore_label)
+    if want_surface_metrics:
+        surface_results = compute_surface_metrics_for_regions(seg_ref[0], seg_pred[0], labels_or_regions,
+                                                              seg_ref_dict['spacing'], surface_metrics,
+                                                              nsd_tolerance, surface_mode, ignore_label)
+    else:
+        surface_results = None
+    del seg_ref, seg_pred
 
     results = {}
     results['reference_file'] = reference_file
     results['prediction_file'] = prediction_file
-    results['metrics'] = {}
-    for r in labels_or_regions:
-        results['metrics'][r] = {}
-        mask_ref = region_or_label_to_mask(seg_ref, r)
-        mask_pred = region_or_label_to_mask(seg_pred, r)
-        tp, fp, fn, tn = compute_tp_fp_fn_tn(mask_ref, mask_pred, ignore_mask)
-        if tp + fp + fn == 0:
-            results['metrics'][r]['Dice'] = np.nan
-            results['metrics'][r]['IoU'] = np.nan
-        else:
-            results['metrics'][r]['Dice'] = 2 * tp / (2 * tp + fp + fn)
-            results['metrics'][r]['IoU'] = tp / (tp + fp + fn)
-        results['metrics'][r]['FP'] = fp
-        results['metrics'][r]['TP'] = tp
-        results['metrics'][r]['FN'] = fn
-        results['metrics'][r]['TN'] = tn
-        results['metrics'][r]['n_pred'] = fp + tp
-        results['metrics'][r]['n_ref'] = fn + tp
+    results['metrics'] = metrics_from_confusion_matrix(confusion_matrix, labels_or_regions)
+    if surface_results is not None:
+        for r in labels_or_regions:
+            results['metrics'][r].update(surface_results[r])
     return results
 
 
-def compute_metrics_on_folder(folder_ref: str, folder_pred: str, output_file: str,
-                              image_reader_writer: BaseReaderWriter,
-                              file_ending: str,
-                              regions_or_labels: Union[List[int], List[Union[int, Tuple[int, ...]]]],
-                              ignore_label: int = None,
-                              num_processes: int = default_num_processes,
-                              chill: bool = True) -> dict:
+def compute_surface_metrics_on_files(reference_file: str, prediction_file: str,
+                                     image_reader_writer: BaseReaderWriter,
+                                     labels_or_regions: Union[List[int], List[Union[int, Tuple[int, ...]]]],
+                                     surface_metrics: Tuple[str, ...] = SURFACE_METRICS,
+                                     nsd_tolerance: float = 1.,
+                                     surface_mode: str = 'surfel',
+                                     ignore_label: int = None) -> dict:
     """
-    output_file must end with .json; can be None
+    only the surface metrics of compute_metrics. Returns {label_or_region: {metric: value}}
     """
-    if output_file is not None:
-        assert output_file.endswith('.json'), 'output_file should end with .json'
-    files_pred = subfiles(folder_pred, suffix=file_ending, join=False)
-    files_ref = subfiles(folder_ref, suffix=file_ending, join=False)
-    if not chill:
-        present = [isfile(join(folder_pred, i)) for i in files_ref]
-        assert all(present), "Not all files in folder_pred exist in folder_ref"
-    files_ref = [join(folder_ref, i) for i in files_pred]
-    files_pred = [join(folder_pred, i) for i in files_pred]
-    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
-        # for i in list(zip(files_ref, files_pred, [image_reader_writer] * len(files_pred), [regions_or_labels] * len(files_pred), [ignore_label] * len(files_pred))):
-        #     compute_metrics(*i)
-        results = pool.starmap(
-            compute_metrics,
-            list(zip(files_ref, files_pred, [image_reader_writer] * len(files_pred), [regions_or_labels] * len(files_pred),
-                     [ignore_label] * len(files_pred)))
-        )
+    seg_ref, seg_ref_dict = image_reader_writer.read_seg(reference_file)
+    seg_pred, _ = image_reader_writer.read_seg(prediction_file)
+    return compute_surface_metrics_for_regions(seg_ref[0], seg_pred[0], labels_or_regions, seg_ref_dict['spacing'],
+                                               surface_metrics, nsd_tolerance, surface_mode, ignore_label)
+
 
+def summarize_results(results: List[dict], regions_or_labels: Union[List[int], List[Union[int, Tuple[int, ...]]]]) \
+        -> dict:
+    """
+    results: one compute_metrics result per case. Returns the summary as written by compute_metrics_on_folder
+    (metric_per_case, mean, foreground_mean)
+    """
     # mean metric per class
     metric_list = list(results[0]['metrics'][regions_or_labels[0]].keys())
     means = {}
@@ -169,7 +275,60 @@ def compute_metrics_on_folder(folder_ref: str, folder_pred: str, output_file: st
     [recursive_fix_for_json_export(i) for i in results]
     recursive_fix_for_json_export(means)
     recursive_fix_for_json_export(foreground_mean)
-    result = {'metric_per_case': results, 'mean': means, 'foreground_mean': foreground_mean}
+    return {'metric_per_case': results, 'mean': means, 'foreground_mean': foreground_mean}
+
+
+def compute_metrics_on_folder(folder_ref: str, folder_pred: str, output_file: str,
+                              image_reader_writer: BaseReaderWriter,
+                              file_ending: str,
+                              regions_or_labels: Union[List[int], List[Union[int, Tuple[int, ...]]]],
+                              ignore_label: int = None,
+                              num_processes: int = default_num_processes,
+                              chill: bool = True,
+                              surface_metrics: Optional[Tuple[str, ...]] = None,
+                              nsd_tolerance: float = 1.,
+                              surface_mode: str = 'surfel') -> dict:
+    """
+    output_file must end with .json; can be None
+
+    surface_metrics (optional): see compute_metrics. If there are fewer cases than processes the labels/regions of
+    each case are additionally distributed across the processes
+    """
+    if output_file is not None:
+        assert output_file.endswith('.json'), 'output_file should end with .json'
+    files_pred = subfiles(folder_pred, suffix=file_ending, join=False)
+    files_ref = subfiles(folder_ref, suffix=file_ending, join=False)
+    if not chill:
+        present = [isfile(join(folder_pred, i)) for i in files_ref]
+        assert all(present), "Not all files in folder_pred exist in folder_ref"
+    files_ref = [join(folder_ref, i) for i in files_pred]
+    files_pred = [join(folder_pred, i) for i in files_pred]
+    num_cases = len(files_pred)
+    if surface_metrics is not None and len(surface_metrics) > 0 and 0 < num_cases < num_processes:
+        num_groups = min(len(regions_or_labels), num_processes // num_cases)
+    else:
+        num_groups = 1
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        # for i in list(zip(files_ref, files_pred, [image_reader_writer] * len(files_pred), [regions_or_labels] * len(files_pred), [ignore_label] * len(files_pred))):
+        #     compute_metrics(*i)
+        results = pool.starmap(
+            compute_metrics,
+            list(zip(files_ref, files_pred, [image_reader_writer] * num_cases, [regions_or_labels] * num_cases,
+                     [ignore_label] * num_cases, [surface_metrics if num_groups == 1 else None] * num_cases,
+                     [nsd_tolerance] * num_cases, [surface_mode] * num_cases))
+        )
+        if num_groups > 1:
+            groups = [list(regions_or_labels[i::num_groups]) for i in range(num_groups)]
+            surface_results = pool.starmap(
+                compute_surface_metrics_on_files,
+                [(fr, fp, image_reader_writer, g, surface_metrics, nsd_tolerance, surface_mode, ignore_label)
+                 for fr, fp in zip(files_ref, files_pred) for g in groups]
+            )
+            for i, res in enumerate(surface_results):
+                for r in res.keys():
+                    results[i // num_groups]['metrics'][r].update(res[r])
+
+    result = summarize_results(results, regions_or_labels)
     if output_file is not None:
         save_summary_json(result, output_file)
     return result
@@ -179,7 +338,10 @@ def compute_metrics_on_folder(folder_ref: str, folder_pred: str, output_file: st
 def compute_metrics_on_folder2(folder_ref: str, folder_pred: str, dataset_json_file: str, plans_file: str,
                                output_file: str = None,
                                num_processes: int = default_num_processes,
-                               chill: bool = False):
+                               chill: bool = False,
+                               surface_metrics: Optional[Tuple[str, ...]] = None,
+                               nsd_tolerance: float = 1.,
+                               surface_mode: str = 'surfel'):
     dataset_json = load_json(dataset_json_file)
     # get file ending
     file_ending = dataset_json['file_ending']
@@ -195,14 +357,18 @@ def compute_metrics_on_folder2(folder_ref: str, folder_pred: str, dataset_json_f
     lm = PlansManager(plans_file).get_label_manager(dataset_json)
     compute_metrics_on_folder(folder_ref, folder_pred, output_file, rw, file_ending,
                               lm.foreground_regions if lm.has_regions else lm.foreground_labels, lm.ignore_label,
-                              num_processes, chill=chill)
+                              num_processes, chill=chill, surface_metrics=surface_metrics, nsd_tolerance=nsd_tolerance,
+                              surface_mode=surface_mode)
 
 
 def compute_metrics_on_folder_simple(folder_ref: str, folder_pred: str, labels: Union[Tuple[int, ...], List[int]],
                                      output_file: str = None,
                                      num_processes: int = default_num_processes,
                                      ignore_label: int = None,
-                                     chill: bool = False):
+                                     chill: bool = False,
+                                     surface_metrics: Optional[Tuple[str, ...]] = None,
+                                     nsd_tolerance: float = 1.,
+                                     surface_mode: str = 'surfel'):
     example_file = subfiles(folder_ref, join=True)[0]
     file_ending = os.path.splitext(example_file)[-1]
     rw = determine_reader_writer_from_file_ending(file_ending, example_file, allow_nonmatching_filename=True,
@@ -211,7 +377,8 @@ def compute_metrics_on_folder_simple(folder_ref: str, folder_pred: str, labels:
     if output_file is None:
         output_file = join(folder_pred, 'summary.json')
     compute_metrics_on_folder(folder_ref, folder_pred, output_file, rw, file_ending,
-                              labels, ignore_label=ignore_label, num_processes=num_processes, chill=chill)
+                              labels, ignore_label=ignore_label, num_processes=num_processes, chill=chill,
+                              surface_metrics=surface_metrics, nsd_tolerance=nsd_tolerance, surface_mode=surface_mode)
 
 
 def evaluate_folder_entry_point():
@@ -228,8 +395,19 @@ def evaluate_folder_entry_point():
     parser.add_argument('-np', type=int, required=False, default=default_num_processes,
                         help=f'number of processes used. Optional. Default: {default_num_processes}')
     parser.add_argument('--chill', action='store_true', help='dont crash if folder_pred does not have all files that are present in folder_gt')
+    parser.add_argument('-surface_metrics', type=str, nargs='+', required=False, default=None,
+                        choices=SURFACE_METRICS,
+                        help='Optional. Also compute these surface distance metrics, for example -surface_metrics HD95 '
+                             'NSD. Distances are in the units of the spacing (usually mm)')
+    parser.add_argument('-nsd_tolerance', type=float, required=False, default=1.,
+                        help='Tolerance for NSD (normalized surface dice). Default: 1')
+    parser.add_argument('-surface_mode', type=str, required=False, default='surfel', choices=('surfel', 'voxel'),
+                        help="surfel: area weighted surface elements (like DeepMind's surface-distance). voxel: border "
+                             "voxels (like medpy). Default: surfel")
     args = parser.parse_args()
-    compute_metrics_on_folder2(args.gt_folder, args.pred_folder, args.djfile, args.pfile, args.o, args.np, chill=args.chill)
+    compute_metrics_on_folder2(args.gt_folder, args.pred_folder, args.djfile, args.pfile, args.o, args.np, chill=args.chill,
+                               surface_metrics=args.surface_metrics, nsd_tolerance=args.nsd_tolerance,
+                               surface_mode=args.surface_mode)
 
 
 def evaluate_simple_entry_point():
@@ -246,9 +424,20 @@ def evaluate_simple_entry_point():
     parser.add_argument('-np', type=int, required=False, default=default_num_processes,
                         help=f'number of processes used. Optional. Default: {default_num_processes}')
     parser.add_argument('--chill', action='store_true', help='dont crash if folder_pred does not have all files that are present in folder_gt')
+    parser.add_argument('-surface_metrics', type=str, nargs='+', required=False, default=None,
+                        choices=SURFACE_METRICS,
+                        help='Optional. Also compute these surface distance metrics, for example -surface_metrics HD95 '
+                             'NSD. Distances are in the units of the spacing (usually mm)')
+    parser.add_argument('-nsd_tolerance', type=float, required=False, default=1.,
+                        help='Tolerance for NSD (normalized surface dice). Default: 1')
+    parser.add_argument('-surface_mode', type=str, required=False, default='surfel', choices=('surfel', 'voxel'),
+                        help="surfel: area weighted surface elements (like DeepMind's surface-distance). voxel: border "
+                             "voxels (like medpy). Default: surfel")
 
     args = parser.parse_args()
-    compute_metrics_on_folder_simple(args.gt_folder, args.pred_folder, args.l, args.o, args.np, args.il, chill=args.chill)
+    compute_metrics_on_folder_simple(args.gt_folder, args.pred_folder, args.l, args.o, args.np, args.il, chill=args.chill,
+                                     surface_metrics=args.surface_metrics, nsd_tolerance=args.nsd_tolerance,
+                                     surface_mode=args.surface_mode)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+"""
+Persistent cache for the distance transforms of ground truth segmentations. The cleft evaluations (CREMI, FAFB) need
+the distance of every voxel to the ground truth foreground. That only depends on the ground truth file and the
+spacing, but used to be recomputed for every prediction folder that was evaluated against it.
+
+Distance maps are stored as uncompressed float64 .npy files (same values as computing them on the fly) and opened as
+read only memmaps, so only the pages that are actually indexed are read. The file name is the sha1 of the ground
+truth file plus the spacing, so modified ground truth files automatically get a new entry. Old entries are never
+deleted, clean up the folder yourself.
+
+The cache folder is nnUNet_edt_cache (environment variable) or ~/.cache/nnunetv2/gt_edt
+"""
+
+import os
+from typing import Tuple, Union, List
+
+import numpy as np
+import SimpleITK as sitk
+from batchgenerators.utilities.file_and_folder_operations import join, isfile, maybe_mkdir_p
+from scipy import ndimage
+
+from nnunetv2.utilities.utils import hash_file
+
+default_gt_edt_cache_dir = os.environ.get('nnUNet_edt_cache',
+                                          join(os.path.expanduser('~'), '.cache', 'nnunetv2', 'gt_edt'))
+
+
+def get_distance_to_foreground(gt_file: str, spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                               cache_dir: str = default_gt_edt_cache_dir,
+                               gt_array: np.ndarray = None) -> np.ndarray:
+    """
+    Euclidean distance of each voxel to the closest foreground (!= 0) voxel of gt_file (0 in the foreground), like
+    ndimage.distance_transform_edt(gt == 0, sampling=spacing). spacing must be in the axis order of the array.
+
+    Returns a read only memmap from cache_dir. The map is computed and stored if it isn't cached yet. If cache_dir is
+    None nothing is cached. gt_array can be given to avoid reading gt_file again (sitk.GetArrayFromImage order)
+    """
+    spacing = [float(i) for i in spacing]
+    if cache_dir is not None:
+        key = hash_file(gt_file) + '_' + '_'.join([repr(i) for i in spacing])
+        cache_file = join(cache_dir, key + '.npy')
+        if isfile(cache_file):
+            return np.load(cache_file, mmap_mode='r')
+
+    if gt_array is None:
+        gt_array = sitk.GetArrayFromImage(sitk.ReadImage(gt_file))
+    distances = ndimage.distance_transform_edt(~(gt_array.astype(bool)), sampling=spacing)
+    if cache_dir is None:
+        return distances
+
+    maybe_mkdir_p(cache_dir)
+    # several workers (or evaluations) may compute the same map at the same time. Write to a temporary file and
+    # rename, so that nobody ever sees a partially written file
+    tmp_file = join(cache_dir, f'{key}_tmp{os.getpid()}.npy')
+    np.save(tmp_file, distances)
+    os.replace(tmp_file, cache_file)
+    return np.load(cache_file, mmap_mode='r')
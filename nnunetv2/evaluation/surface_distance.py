@@ -0,0 +1,481 @@
+"""
+Surface distance metrics (HD95, ASSD, NSD) shared by all evaluations. Two surface definitions are supported:
+
+- 'surfel': surface elements from the marching cubes neighbourhood codes, weighted by their area (Nikolov et al.,
+  https://github.com/deepmind/surface-distance). This is what the COVID evaluation (NSD) uses
+- 'voxel': border voxels (mask minus its erosion), all with the same weight. Identical to medpy.metric.binary.hd95
+  / assd. This is what the WORD evaluation (HD95) uses
+
+Everything is computed on the bounding box of reference + prediction (plus one voxel margin) only, so the distance
+transforms are much cheaper than on the full volume. Results are identical to computing on the full volume.
+"""
+
+from functools import lru_cache
+from typing import Tuple, List, Union, Dict
+
+import numpy as np
+from scipy.ndimage import correlate, distance_transform_edt, binary_erosion, generate_binary_structure, find_objects
+
+# For every binary neighbour code (2x2x2 neighbourhood = 8 neighbours = 8 bits = 256 codes) this contains the surface
+# normals of the triangles ("surfels"). The length of the normal vector encodes the surfel area. Created with the
+# marching cubes algorithm, see https://github.com/deepmind/surface-distance
+NEIGHBOUR_CODE_TO_NORMALS = [
+    [[0,0,0]],
+    [[0.125,0.125,0.125]],
+    [[-0.125,-0.125,0.125]],
+    [[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
+    [[0.125,-0.125,0.125]],
+    [[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
+    [[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
+    [[-0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,0.125,0.125]],
+    [[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
+    [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
+    [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125]],
+    [[-0.5,0.0,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
+    [[0.5,0.0,0.0],[0.5,0.0,0.0]],
+    [[0.125,-0.125,-0.125]],
+    [[0.0,-0.25,-0.25],[0.0,0.25,0.25]],
+    [[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,-0.5,0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
+    [[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,0.0,-0.5],[0.25,0.25,0.25],[-0.125,-0.125,-0.125]],
+    [[-0.125,-0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.25,0.25,0.25],[0.125,0.125,0.125]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[-0.125,0.125,0.125]],
+    [[-0.25,0.0,0.25],[-0.25,0.0,0.25],[0.125,-0.125,-0.125]],
+    [[0.125,0.125,0.125],[0.375,0.375,0.375],[0.0,-0.25,0.25],[-0.25,0.0,0.25]],
+    [[0.125,-0.125,-0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
+    [[0.375,0.375,0.375],[0.0,0.25,-0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
+    [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.125,0.125,0.125]],
+    [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25]],
+    [[0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
+    [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25]],
+    [[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.125,-0.125,0.125],[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
+    [[0.0,-0.25,0.25],[0.0,0.25,-0.25],[0.125,-0.125,0.125]],
+    [[-0.375,-0.375,0.375],[-0.0,0.25,0.25],[0.125,0.125,-0.125],[-0.25,-0.0,-0.25]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,0.125,0.125]],
+    [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.25,0.25,-0.25],[0.25,0.25,-0.25],[0.125,0.125,-0.125],[-0.125,-0.125,0.125]],
+    [[0.125,-0.125,0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
+    [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125],[0.125,-0.125,0.125]],
+    [[0.0,0.25,-0.25],[0.375,-0.375,-0.375],[-0.125,0.125,0.125],[0.25,0.25,0.0]],
+    [[-0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
+    [[0.0,0.5,0.0],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
+    [[0.0,0.5,0.0],[0.125,-0.125,0.125],[-0.25,0.25,-0.25]],
+    [[0.0,0.5,0.0],[0.0,-0.5,0.0]],
+    [[0.25,-0.25,0.0],[-0.25,0.25,0.0],[0.125,-0.125,0.125]],
+    [[-0.375,-0.375,-0.375],[-0.25,0.0,0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
+    [[0.125,0.125,0.125],[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
+    [[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
+    [[-0.125,0.125,0.125],[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
+    [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.375,0.375,-0.375],[-0.25,-0.25,0.0],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
+    [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
+    [[0.25,-0.25,0.0],[-0.25,0.25,0.0],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
+    [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[-0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
+    [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
+    [[-0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.125,-0.125,0.125],[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
+    [[0.0,-0.25,0.25],[0.0,-0.25,0.25]],
+    [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
+    [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.375,-0.375,0.375],[0.0,-0.25,-0.25],[-0.125,0.125,-0.125],[0.25,0.25,0.0]],
+    [[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
+    [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
+    [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
+    [[-0.25,0.25,-0.25],[-0.25,0.25,-0.25],[-0.125,0.125,-0.125],[-0.125,0.125,-0.125]],
+    [[-0.25,0.0,-0.25],[0.375,-0.375,-0.375],[0.0,0.25,-0.25],[-0.125,0.125,0.125]],
+    [[0.5,0.0,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
+    [[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
+    [[-0.0,0.0,0.5],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
+    [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
+    [[-0.25,-0.0,-0.25],[-0.375,0.375,0.375],[-0.25,-0.25,0.0],[-0.125,0.125,0.125]],
+    [[0.0,0.0,-0.5],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
+    [[-0.0,0.0,0.5],[0.0,0.0,0.5]],
+    [[0.125,0.125,0.125],[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
+    [[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
+    [[-0.25,0.0,0.25],[0.25,0.0,-0.25],[-0.125,0.125,0.125]],
+    [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[-0.25,0.0,0.25],[-0.25,0.0,0.25],[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
+    [[0.125,-0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
+    [[0.25,0.0,0.25],[-0.375,-0.375,0.375],[-0.25,0.25,0.0],[-0.125,-0.125,0.125]],
+    [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
+    [[0.25,0.0,0.25],[0.25,0.0,0.25]],
+    [[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[-0.125,-0.125,0.125],[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
+    [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
+    [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.125,-0.125,0.125]],
+    [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
+    [[0.0,0.25,0.25],[0.0,0.25,0.25],[0.125,-0.125,-0.125]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
+    [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.5,0.0,-0.0],[0.25,-0.25,-0.25],[0.125,-0.125,-0.125]],
+    [[-0.25,0.25,0.25],[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
+    [[0.375,-0.375,0.375],[0.0,0.25,0.25],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
+    [[0.0,-0.5,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
+    [[-0.375,-0.375,0.375],[0.25,-0.25,0.0],[0.0,0.25,0.25],[-0.125,-0.125,0.125]],
+    [[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.0,0.0,0.5]],
+    [[0.125,0.125,0.125],[0.0,0.25,0.25],[0.0,0.25,0.25]],
+    [[0.0,0.25,0.25],[0.0,0.25,0.25]],
+    [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125],[0.125,0.125,0.125]],
+    [[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
+    [[-0.25,-0.0,-0.25],[0.25,0.0,0.25],[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
+    [[-0.25,-0.25,0.0],[0.25,0.25,-0.0],[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.25,-0.25,0.0],[0.25,0.25,-0.0],[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
+    [[-0.25,-0.0,-0.25],[0.25,0.0,0.25],[0.125,0.125,0.125]],
+    [[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
+    [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125],[0.125,0.125,0.125]],
+    [[0.0,0.25,0.25],[0.0,0.25,0.25]],
+    [[0.125,0.125,0.125],[0.0,0.25,0.25],[0.0,0.25,0.25]],
+    [[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.0,0.0,0.5]],
+    [[-0.375,-0.375,0.375],[0.25,-0.25,0.0],[0.0,0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.0,-0.5,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
+    [[0.375,-0.375,0.375],[0.0,0.25,0.25],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
+    [[-0.25,0.25,0.25],[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
+    [[0.5,0.0,-0.0],[0.25,-0.25,-0.25],[0.125,-0.125,-0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[0.0,0.25,0.25],[0.0,0.25,0.25],[0.125,-0.125,-0.125]],
+    [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[0.0,0.25,0.25],[0.0,0.25,0.25]],
+    [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.125,-0.125,0.125]],
+    [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
+    [[-0.125,-0.125,0.125],[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.25,0.0,0.25],[0.25,0.0,0.25]],
+    [[0.125,0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
+    [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
+    [[0.25,0.0,0.25],[-0.375,-0.375,0.375],[-0.25,0.25,0.0],[-0.125,-0.125,0.125]],
+    [[0.125,-0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
+    [[-0.25,-0.0,-0.25],[0.25,0.0,0.25],[0.25,0.0,0.25],[0.25,0.0,0.25]],
+    [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[-0.25,0.0,0.25],[0.25,0.0,-0.25],[-0.125,0.125,0.125]],
+    [[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
+    [[0.125,0.125,0.125],[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
+    [[-0.0,0.0,0.5],[0.0,0.0,0.5]],
+    [[0.0,0.0,-0.5],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
+    [[-0.25,-0.0,-0.25],[-0.375,0.375,0.375],[-0.25,-0.25,0.0],[-0.125,0.125,0.125]],
+    [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
+    [[-0.0,0.0,0.5],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
+    [[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
+    [[0.5,0.0,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
+    [[-0.25,0.0,-0.25],[0.375,-0.375,-0.375],[0.0,0.25,-0.25],[-0.125,0.125,0.125]],
+    [[-0.25,0.25,-0.25],[-0.25,0.25,-0.25],[-0.125,0.125,-0.125],[-0.125,0.125,-0.125]],
+    [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
+    [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
+    [[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
+    [[0.375,-0.375,0.375],[0.0,-0.25,-0.25],[-0.125,0.125,-0.125],[0.25,0.25,0.0]],
+    [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
+    [[0.0,-0.25,0.25],[0.0,-0.25,0.25]],
+    [[-0.125,-0.125,0.125],[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
+    [[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.125,-0.125,0.125]],
+    [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
+    [[0.125,0.125,0.125],[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
+    [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[-0.125,-0.125,0.125]],
+    [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
+    [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
+    [[-0.375,0.375,-0.375],[-0.25,-0.25,0.0],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
+    [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.125,0.125,0.125],[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
+    [[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
+    [[0.125,0.125,0.125],[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
+    [[-0.375,-0.375,-0.375],[-0.25,0.0,0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
+    [[0.25,-0.25,0.0],[-0.25,0.25,0.0],[0.125,-0.125,0.125]],
+    [[0.0,0.5,0.0],[0.0,-0.5,0.0]],
+    [[0.0,0.5,0.0],[0.125,-0.125,0.125],[-0.25,0.25,-0.25]],
+    [[0.0,0.5,0.0],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
+    [[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
+    [[-0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.0,0.25,-0.25],[0.375,-0.375,-0.375],[-0.125,0.125,0.125],[0.25,0.25,0.0]],
+    [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125],[0.125,-0.125,0.125]],
+    [[0.125,-0.125,0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
+    [[0.25,0.25,-0.25],[0.25,0.25,-0.25],[0.125,0.125,-0.125],[-0.125,-0.125,0.125]],
+    [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,0.125,0.125]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,0.125]],
+    [[-0.375,-0.375,0.375],[-0.0,0.25,0.25],[0.125,0.125,-0.125],[-0.25,-0.0,-0.25]],
+    [[0.0,-0.25,0.25],[0.0,0.25,-0.25],[0.125,-0.125,0.125]],
+    [[0.125,-0.125,0.125],[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
+    [[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25]],
+    [[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
+    [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
+    [[0.125,-0.125,0.125]],
+    [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25]],
+    [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.125,0.125,0.125]],
+    [[0.375,0.375,0.375],[0.0,0.25,-0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
+    [[0.125,-0.125,-0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
+    [[0.125,0.125,0.125],[0.375,0.375,0.375],[0.0,-0.25,0.25],[-0.25,0.0,0.25]],
+    [[-0.25,0.0,0.25],[-0.25,0.0,0.25],[0.125,-0.125,-0.125]],
+    [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[-0.125,0.125,0.125]],
+    [[-0.125,0.125,0.125],[0.125,-0.125,-0.125]],
+    [[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.25,0.25,0.25],[0.125,0.125,0.125]],
+    [[-0.125,-0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,0.0,-0.5],[0.25,0.25,0.25],[-0.125,-0.125,-0.125]],
+    [[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,-0.5,0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
+    [[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
+    [[0.0,-0.25,-0.25],[0.0,0.25,0.25]],
+    [[0.125,-0.125,-0.125]],
+    [[0.5,0.0,0.0],[0.5,0.0,0.0]],
+    [[-0.5,0.0,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
+    [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125]],
+    [[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
+    [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
+    [[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
+    [[0.125,0.125,0.125],[-0.125,0.125,0.125]],
+    [[-0.125,0.125,0.125]],
+    [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
+    [[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
+    [[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
+    [[0.125,-0.125,0.125]],
+    [[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
+    [[-0.125,-0.125,0.125]],
+    [[0.125,0.125,0.125]],
+    [[0,0,0]]]
+
+
+SURFACE_METRICS = ('HD95', 'ASSD', 'NSD')
+
+
+@lru_cache(maxsize=None)
+def _surface_area_lookup(spacing: Tuple[float, ...]) -> np.ndarray:
+    """
+    area of the surfels of each of the 256 neighbour codes for the given spacing
+    """
+    areas = np.zeros(256)
+    for code in range(256):
+        normals = np.array(NEIGHBOUR_CODE_TO_NORMALS[code], dtype=float)
+        scaled = np.stack((normals[:, 0] * spacing[1] * spacing[2],
+                           normals[:, 1] * spacing[0] * spacing[2],
+                           normals[:, 2] * spacing[0] * spacing[1]), axis=1)
+        areas[code] = sum(np.linalg.norm(n) for n in scaled)
+    return areas
+
+
+def _bbox(mask: np.ndarray, margin: int = 0) -> Union[Tuple[slice, ...], None]:
+    """
+    bounding box of mask as tuple of slices, enlarged by margin (clipped to the array). None if mask is empty
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        nonzero = np.flatnonzero(np.any(mask, axis=tuple(i for i in range(mask.ndim) if i != axis)))
+        if len(nonzero) == 0:
+            return None
+        bbox.append(slice(max(0, nonzero[0] - margin), min(mask.shape[axis], nonzero[-1] + 1 + margin)))
+    return tuple(bbox)
+
+
+def _enlarge_bbox(bbox: Tuple[slice, ...], shape: Tuple[int, ...], margin: int) -> Tuple[slice, ...]:
+    return tuple(slice(max(0, b.start - margin), min(s, b.stop + margin)) for b, s in zip(bbox, shape))
+
+
+def compute_surface_distances(mask_ref: np.ndarray, mask_pred: np.ndarray, spacing: Tuple[float, ...],
+                              mode: str = 'surfel') -> Dict[str, Union[np.ndarray, str]]:
+    """
+    Distances from all surface elements of mask_ref to the surface of mask_pred and vice versa, plus the weight
+    (surfel area in 'surfel' mode, 1 in 'voxel' mode) of each surface element. Distances are sorted in ascending order.
+    If one of the masks is empty its distances are empty and all distances of the other one are inf.
+
+    spacing must be in the axis order of the arrays!
+    """
+    assert mode in ('surfel', 'voxel'), f"mode must be 'surfel' or 'voxel', got {mode}"
+    assert mask_ref.ndim == 3 and mask_ref.shape == mask_pred.shape, 'masks must be 3d and have the same shape'
+    mask_ref = mask_ref.astype(bool, copy=False)
+    mask_pred = mask_pred.astype(bool, copy=False)
+    spacing = tuple(float(i) for i in spacing)
+
+    # voxel mode needs a margin of one voxel so that the erosion behaves like on the full volume
+    bbox = _bbox(mask_ref | mask_pred, margin=1 if mode == 'voxel' else 0)
+    if bbox is None:
+        return {'distances_ref_to_pred': np.zeros(0), 'distances_pred_to_ref': np.zeros(0),
+                'weights_ref': np.zeros(0), 'weights_pred': np.zeros(0), 'mode': mode}
+
+    if mode == 'surfel':
+        # zero pad at the end of each axis to get the full correlation result with the 2x2x2 kernel
+        crop_shape = tuple(b.stop - b.start + 1 for b in bbox)
+        crop_ref, crop_pred = np.zeros(crop_shape, np.uint8), np.zeros(crop_shape, np.uint8)
+        crop_ref[:-1, :-1, :-1] = mask_ref[bbox]
+        crop_pred[:-1, :-1, :-1] = mask_pred[bbox]
+        # neighbour code (local binary pattern) of each voxel. Shifted by half a voxel, so these are the voxel corners
+        kernel = np.array([[[128, 64], [32, 16]], [[8, 4], [2, 1]]])
+        code_ref = correlate(crop_ref, kernel, mode='constant', cval=0)
+        code_pred = correlate(crop_pred, kernel, mode='constant', cval=0)
+        border_ref = (code_ref != 0) & (code_ref != 255)
+        border_pred = (code_pred != 0) & (code_pred != 255)
+        area_lookup = _surface_area_lookup(spacing)
+        weights_ref = area_lookup[code_ref[border_ref]]
+        weights_pred = area_lookup[code_pred[border_pred]]
+    else:
+        crop_ref, crop_pred = mask_ref[bbox], mask_pred[bbox]
+        structure = generate_binary_structure(3, 1)
+        border_ref = crop_ref ^ binary_erosion(crop_ref, structure=structure, iterations=1)
+        border_pred = crop_pred ^ binary_erosion(crop_pred, structure=structure, iterations=1)
+        weights_ref = np.ones(np.count_nonzero(border_ref))
+        weights_pred = np.ones(np.count_nonzero(border_pred))
+
+    # distance of each voxel to the closest surface voxel. Only on the crop
+    if border_pred.any():
+        distances_ref_to_pred = distance_transform_edt(~border_pred, sampling=spacing)[border_ref]
+    else:
+        distances_ref_to_pred = np.full(np.count_nonzero(border_ref), np.inf)
+    if border_ref.any():
+        distances_pred_to_ref = distance_transform_edt(~border_ref, sampling=spacing)[border_pred]
+    else:
+        distances_pred_to_ref = np.full(np.count_nonzero(border_pred), np.inf)
+
+    order_ref = np.argsort(distances_ref_to_pred, kind='stable')
+    order_pred = np.argsort(distances_pred_to_ref, kind='stable')
+    return {'distances_ref_to_pred': distances_ref_to_pred[order_ref], 'weights_ref': weights_ref[order_ref],
+            'distances_pred_to_ref': distances_pred_to_ref[order_pred], 'weights_pred': weights_pred[order_pred],
+            'mode': mode}
+
+
+def compute_hd95(surface_distances: dict, percent: float = 95) -> float:
+    """
+    'surfel': max of the two directed, area weighted percentiles (surface-distance's compute_robust_hausdorff)
+    'voxel': percentile of the distances of both directions pooled (medpy's hd95)
+    """
+    d_ref, d_pred = surface_distances['distances_ref_to_pred'], surface_distances['distances_pred_to_ref']
+    if len(d_ref) == 0 and len(d_pred) == 0:
+        return np.nan
+    if len(d_ref) == 0 or len(d_pred) == 0:
+        return np.inf
+    if surface_distances['mode'] == 'voxel':
+        return float(np.percentile(np.hstack((d_pred, d_ref)), percent))
+    ret = []
+    for d, w in ((d_ref, surface_distances['weights_ref']), (d_pred, surface_distances['weights_pred'])):
+        idx = np.searchsorted(np.cumsum(w) / np.sum(w), percent / 100.0)
+        ret.append(d[min(idx, len(d) - 1)])
+    return float(max(ret))
+
+
+def compute_assd(surface_distances: dict) -> float:
+    """
+    average symmetric surface distance: mean of the two directed (weighted) average distances
+    """
+    d_ref, d_pred = surface_distances['distances_ref_to_pred'], surface_distances['distances_pred_to_ref']
+    if len(d_ref) == 0 and len(d_pred) == 0:
+        return np.nan
+    if len(d_ref) == 0 or len(d_pred) == 0:
+        return np.inf
+    w_ref, w_pred = surface_distances['weights_ref'], surface_distances['weights_pred']
+    return float((np.sum(d_ref * w_ref) / np.sum(w_ref) + np.sum(d_pred * w_pred) / np.sum(w_pred)) / 2)
+
+
+def compute_nsd(surface_distances: dict, tolerance: float = 1.) -> float:
+    """
+    normalized surface dice: (weighted) fraction of both surfaces that is within tolerance (in spacing units, usually
+    mm) of the other surface
+    """
+    d_ref, d_pred = surface_distances['distances_ref_to_pred'], surface_distances['distances_pred_to_ref']
+    w_ref, w_pred = surface_distances['weights_ref'], surface_distances['weights_pred']
+    total = np.sum(w_ref) + np.sum(w_pred)
+    if total == 0:
+        return np.nan
+    return float((np.sum(w_ref[d_ref <= tolerance]) + np.sum(w_pred[d_pred <= tolerance])) / total)
+
+
+def compute_surface_metrics(mask_ref: np.ndarray, mask_pred: np.ndarray, spacing: Tuple[float, ...],
+                            metrics: Tuple[str, ...] = SURFACE_METRICS, nsd_tolerance: float = 1.,
+                            mode: str = 'surfel') -> Dict[str, float]:
+    """
+    metrics: any of SURFACE_METRICS. Both masks empty -> nan, one empty -> inf (HD95, ASSD) / 0 (NSD)
+    """
+    for m in metrics:
+        assert m in SURFACE_METRICS, f'unknown surface metric {m}. Choose from {SURFACE_METRICS}'
+    surface_distances = compute_surface_distances(mask_ref, mask_pred, spacing, mode)
+    ret = {}
+    if 'HD95' in metrics:
+        ret['HD95'] = compute_hd95(surface_distances)
+    if 'ASSD' in metrics:
+        ret['ASSD'] = compute_assd(surface_distances)
+    if 'NSD' in metrics:
+        ret['NSD'] = compute_nsd(surface_distances, nsd_tolerance)
+    return ret
+
+
+def compute_surface_metrics_for_regions(seg_ref: np.ndarray, seg_pred: np.ndarray,
+                                        labels_or_regions: Union[List[int], List[Union[int, Tuple[int, ...]]]],
+                                        spacing: Tuple[float, ...], metrics: Tuple[str, ...] = SURFACE_METRICS,
+                                        nsd_tolerance: float = 1., mode: str = 'surfel',
+                                        ignore_label: int = None) -> dict:
+    """
+    surface metrics for several labels/regions of two label maps. The bounding boxes of all labels are determined in
+    one pass (scipy.ndimage.find_objects), each label/region is then only processed within the union of its bounding
+    boxes in reference and prediction.
+
+    seg_ref and seg_pred must be 3d label maps with non-negative integer labels (float is fine). Voxels that are
+    ignore_label in seg_ref are removed from both masks before the surfaces are extracted (same as the ignore handling
+    of the confusion matrix in evaluate_predictions.py).
+    Returns {label_or_region: {metric: value}}
+    """
+    seg_ref = seg_ref.astype(np.int32, copy=False)
+    seg_pred = seg_pred.astype(np.int32, copy=False)
+    bboxes_ref, bboxes_pred = find_objects(seg_ref), find_objects(seg_pred)
+
+    results = {}
+    for r in labels_or_regions:
+        members = np.atleast_1d(r)
+        boxes = [b[l - 1] for b in (bboxes_ref, bboxes_pred) for l in members if 0 < l <= len(b) and
+                 b[l - 1] is not None]
+        if len(boxes) == 0:
+            # empty in both, no need to look at the images
+            empty = np.zeros((1, 1, 1), dtype=bool)
+            results[r] = compute_surface_metrics(empty, empty, spacing, metrics, nsd_tolerance, mode)
+            continue
+        bbox = tuple(slice(min(b[i].start for b in boxes), max(b[i].stop for b in boxes)) for i in range(3))
+        # margin so that the erosion in voxel mode sees the true neighbourhood
+        bbox = _enlarge_bbox(bbox, seg_ref.shape, 1)
+        crop_ref, crop_pred = seg_ref[bbox], seg_pred[bbox]
+        mask_ref = np.isin(crop_ref, members)
+        mask_pred = np.isin(crop_pred, members)
+        if ignore_label is not None:
+            keep = crop_ref != ignore_label
+            mask_ref &= keep
+            mask_pred &= keep
+        results[r] = compute_surface_metrics(mask_ref, mask_pred, spacing, metrics, nsd_tolerance, mode)
+    return results
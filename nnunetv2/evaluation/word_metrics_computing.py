@@ -9,678 +9,115 @@
 #   journal={arXiv preprint arXiv:2111.02403},
 #   year={2021}
 # }
+#
+# The metrics themselves are computed by nnunetv2.evaluation.surface_distance ('voxel' mode is what medpy's hd95
+# does). This file only contains the WORD specific conventions (classes, HD95 = 50 if a class is missing, output json)
 
-import os
-import numpy as np
-import SimpleITK as sitk
-from medpy import metric
-from tqdm import tqdm
-import matplotlib.pyplot as plt
 import argparse
 import json
-import scipy.ndimage 
-# neighbour_code_to_normals is a lookup table.
-# For every binary neighbour code 
-# (2x2x2 neighbourhood = 8 neighbours = 8 bits = 256 codes) 
-# it contains the surface normals of the triangles (called "surfel" for 
-# "surface element" in the following). The length of the normal 
-# vector encodes the surfel area.
-#
-# created by compute_surface_area_lookup_table.ipynb using the 
-# marching_cube algorithm, see e.g. https://en.wikipedia.org/wiki/Marching_cubes
-#
-neighbour_code_to_normals = [
-  [[0,0,0]],
-  [[0.125,0.125,0.125]],
-  [[-0.125,-0.125,0.125]],
-  [[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
-  [[0.125,-0.125,0.125]],
-  [[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
-  [[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
-  [[-0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,0.125,0.125]],
-  [[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
-  [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
-  [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125]],
-  [[-0.5,0.0,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
-  [[0.5,0.0,0.0],[0.5,0.0,0.0]],
-  [[0.125,-0.125,-0.125]],
-  [[0.0,-0.25,-0.25],[0.0,0.25,0.25]],
-  [[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,-0.5,0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
-  [[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,0.0,-0.5],[0.25,0.25,0.25],[-0.125,-0.125,-0.125]],
-  [[-0.125,-0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.25,0.25,0.25],[0.125,0.125,0.125]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[-0.125,0.125,0.125]],
-  [[-0.25,0.0,0.25],[-0.25,0.0,0.25],[0.125,-0.125,-0.125]],
-  [[0.125,0.125,0.125],[0.375,0.375,0.375],[0.0,-0.25,0.25],[-0.25,0.0,0.25]],
-  [[0.125,-0.125,-0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
-  [[0.375,0.375,0.375],[0.0,0.25,-0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
-  [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.125,0.125,0.125]],
-  [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25]],
-  [[0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
-  [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25]],
-  [[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.125,-0.125,0.125],[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
-  [[0.0,-0.25,0.25],[0.0,0.25,-0.25],[0.125,-0.125,0.125]],
-  [[-0.375,-0.375,0.375],[-0.0,0.25,0.25],[0.125,0.125,-0.125],[-0.25,-0.0,-0.25]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,0.125,0.125]],
-  [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.25,0.25,-0.25],[0.25,0.25,-0.25],[0.125,0.125,-0.125],[-0.125,-0.125,0.125]],
-  [[0.125,-0.125,0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
-  [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125],[0.125,-0.125,0.125]],
-  [[0.0,0.25,-0.25],[0.375,-0.375,-0.375],[-0.125,0.125,0.125],[0.25,0.25,0.0]],
-  [[-0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
-  [[0.0,0.5,0.0],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
-  [[0.0,0.5,0.0],[0.125,-0.125,0.125],[-0.25,0.25,-0.25]],
-  [[0.0,0.5,0.0],[0.0,-0.5,0.0]],
-  [[0.25,-0.25,0.0],[-0.25,0.25,0.0],[0.125,-0.125,0.125]],
-  [[-0.375,-0.375,-0.375],[-0.25,0.0,0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
-  [[0.125,0.125,0.125],[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
-  [[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
-  [[-0.125,0.125,0.125],[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
-  [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.375,0.375,-0.375],[-0.25,-0.25,0.0],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
-  [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
-  [[0.25,-0.25,0.0],[-0.25,0.25,0.0],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
-  [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[-0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
-  [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
-  [[-0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.125,-0.125,0.125],[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
-  [[0.0,-0.25,0.25],[0.0,-0.25,0.25]],
-  [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
-  [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.375,-0.375,0.375],[0.0,-0.25,-0.25],[-0.125,0.125,-0.125],[0.25,0.25,0.0]],
-  [[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
-  [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
-  [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
-  [[-0.25,0.25,-0.25],[-0.25,0.25,-0.25],[-0.125,0.125,-0.125],[-0.125,0.125,-0.125]],
-  [[-0.25,0.0,-0.25],[0.375,-0.375,-0.375],[0.0,0.25,-0.25],[-0.125,0.125,0.125]],
-  [[0.5,0.0,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
-  [[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
-  [[-0.0,0.0,0.5],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
-  [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
-  [[-0.25,-0.0,-0.25],[-0.375,0.375,0.375],[-0.25,-0.25,0.0],[-0.125,0.125,0.125]],
-  [[0.0,0.0,-0.5],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
-  [[-0.0,0.0,0.5],[0.0,0.0,0.5]],
-  [[0.125,0.125,0.125],[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
-  [[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
-  [[-0.25,0.0,0.25],[0.25,0.0,-0.25],[-0.125,0.125,0.125]],
-  [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[-0.25,0.0,0.25],[-0.25,0.0,0.25],[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
-  [[0.125,-0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
-  [[0.25,0.0,0.25],[-0.375,-0.375,0.375],[-0.25,0.25,0.0],[-0.125,-0.125,0.125]],
-  [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
-  [[0.25,0.0,0.25],[0.25,0.0,0.25]],
-  [[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[-0.125,-0.125,0.125],[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
-  [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
-  [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.125,-0.125,0.125]],
-  [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
-  [[0.0,0.25,0.25],[0.0,0.25,0.25],[0.125,-0.125,-0.125]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
-  [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.5,0.0,-0.0],[0.25,-0.25,-0.25],[0.125,-0.125,-0.125]],
-  [[-0.25,0.25,0.25],[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
-  [[0.375,-0.375,0.375],[0.0,0.25,0.25],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
-  [[0.0,-0.5,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
-  [[-0.375,-0.375,0.375],[0.25,-0.25,0.0],[0.0,0.25,0.25],[-0.125,-0.125,0.125]],
-  [[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.0,0.0,0.5]],
-  [[0.125,0.125,0.125],[0.0,0.25,0.25],[0.0,0.25,0.25]],
-  [[0.0,0.25,0.25],[0.0,0.25,0.25]],
-  [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125],[0.125,0.125,0.125]],
-  [[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
-  [[-0.25,-0.0,-0.25],[0.25,0.0,0.25],[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
-  [[-0.25,-0.25,0.0],[0.25,0.25,-0.0],[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.25,-0.25,0.0],[0.25,0.25,-0.0],[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
-  [[-0.25,-0.0,-0.25],[0.25,0.0,0.25],[0.125,0.125,0.125]],
-  [[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
-  [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125],[0.125,0.125,0.125]],
-  [[0.0,0.25,0.25],[0.0,0.25,0.25]],
-  [[0.125,0.125,0.125],[0.0,0.25,0.25],[0.0,0.25,0.25]],
-  [[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.0,0.0,0.5]],
-  [[-0.375,-0.375,0.375],[0.25,-0.25,0.0],[0.0,0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.0,-0.5,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
-  [[0.375,-0.375,0.375],[0.0,0.25,0.25],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
-  [[-0.25,0.25,0.25],[-0.125,0.125,0.125],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
-  [[0.5,0.0,-0.0],[0.25,-0.25,-0.25],[0.125,-0.125,-0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125],[0.125,0.125,0.125]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[0.0,0.25,0.25],[0.0,0.25,0.25],[0.125,-0.125,-0.125]],
-  [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[0.0,0.25,0.25],[0.0,0.25,0.25]],
-  [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[0.125,-0.125,0.125]],
-  [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
-  [[-0.125,-0.125,0.125],[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[-0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.25,0.0,0.25],[0.25,0.0,0.25]],
-  [[0.125,0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
-  [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
-  [[0.25,0.0,0.25],[-0.375,-0.375,0.375],[-0.25,0.25,0.0],[-0.125,-0.125,0.125]],
-  [[0.125,-0.125,0.125],[0.25,0.0,0.25],[0.25,0.0,0.25]],
-  [[-0.25,-0.0,-0.25],[0.25,0.0,0.25],[0.25,0.0,0.25],[0.25,0.0,0.25]],
-  [[-0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[-0.25,0.0,0.25],[0.25,0.0,-0.25],[-0.125,0.125,0.125]],
-  [[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
-  [[0.125,0.125,0.125],[0.125,0.125,0.125],[0.25,0.25,0.25],[0.0,0.0,0.5]],
-  [[-0.0,0.0,0.5],[0.0,0.0,0.5]],
-  [[0.0,0.0,-0.5],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
-  [[-0.25,-0.0,-0.25],[-0.375,0.375,0.375],[-0.25,-0.25,0.0],[-0.125,0.125,0.125]],
-  [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
-  [[-0.0,0.0,0.5],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
-  [[-0.25,0.0,0.25],[0.25,0.0,-0.25]],
-  [[0.5,0.0,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
-  [[-0.25,0.0,-0.25],[0.375,-0.375,-0.375],[0.0,0.25,-0.25],[-0.125,0.125,0.125]],
-  [[-0.25,0.25,-0.25],[-0.25,0.25,-0.25],[-0.125,0.125,-0.125],[-0.125,0.125,-0.125]],
-  [[-0.0,0.5,0.0],[-0.25,0.25,-0.25],[0.125,-0.125,0.125]],
-  [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.125,-0.125,0.125],[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
-  [[-0.125,-0.125,0.125],[-0.125,0.125,0.125]],
-  [[0.375,-0.375,0.375],[0.0,-0.25,-0.25],[-0.125,0.125,-0.125],[0.25,0.25,0.0]],
-  [[0.0,-0.25,0.25],[0.0,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.0,0.0,0.5],[0.25,-0.25,0.25],[0.125,-0.125,0.125]],
-  [[0.0,-0.25,0.25],[0.0,-0.25,0.25]],
-  [[-0.125,-0.125,0.125],[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
-  [[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.125,-0.125,0.125]],
-  [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
-  [[0.125,0.125,0.125],[-0.25,-0.25,0.0],[-0.25,-0.25,0.0]],
-  [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[-0.125,-0.125,0.125]],
-  [[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
-  [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125]],
-  [[-0.375,0.375,-0.375],[-0.25,-0.25,0.0],[-0.125,0.125,-0.125],[-0.25,0.0,0.25]],
-  [[0.0,0.5,0.0],[0.25,0.25,-0.25],[-0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.125,0.125,0.125],[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
-  [[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
-  [[0.125,0.125,0.125],[0.0,-0.5,0.0],[-0.25,-0.25,-0.25],[-0.125,-0.125,-0.125]],
-  [[-0.375,-0.375,-0.375],[-0.25,0.0,0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
-  [[0.25,-0.25,0.0],[-0.25,0.25,0.0],[0.125,-0.125,0.125]],
-  [[0.0,0.5,0.0],[0.0,-0.5,0.0]],
-  [[0.0,0.5,0.0],[0.125,-0.125,0.125],[-0.25,0.25,-0.25]],
-  [[0.0,0.5,0.0],[-0.25,0.25,0.25],[0.125,-0.125,-0.125]],
-  [[0.25,-0.25,0.0],[-0.25,0.25,0.0]],
-  [[-0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.0,0.25,-0.25],[0.375,-0.375,-0.375],[-0.125,0.125,0.125],[0.25,0.25,0.0]],
-  [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125],[0.125,-0.125,0.125]],
-  [[0.125,-0.125,0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
-  [[0.25,0.25,-0.25],[0.25,0.25,-0.25],[0.125,0.125,-0.125],[-0.125,-0.125,0.125]],
-  [[-0.0,0.0,0.5],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125],[-0.125,0.125,0.125]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,0.125]],
-  [[-0.375,-0.375,0.375],[-0.0,0.25,0.25],[0.125,0.125,-0.125],[-0.25,-0.0,-0.25]],
-  [[0.0,-0.25,0.25],[0.0,0.25,-0.25],[0.125,-0.125,0.125]],
-  [[0.125,-0.125,0.125],[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
-  [[0.125,-0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.0,-0.5,0.0],[0.125,0.125,-0.125],[0.25,0.25,-0.25]],
-  [[0.0,-0.25,0.25],[0.0,0.25,-0.25]],
-  [[0.125,0.125,0.125],[0.125,-0.125,0.125]],
-  [[0.125,-0.125,0.125]],
-  [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25]],
-  [[-0.5,0.0,0.0],[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.125,0.125,0.125]],
-  [[0.375,0.375,0.375],[0.0,0.25,-0.25],[-0.125,-0.125,-0.125],[-0.25,0.25,0.0]],
-  [[0.125,-0.125,-0.125],[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
-  [[0.125,0.125,0.125],[0.375,0.375,0.375],[0.0,-0.25,0.25],[-0.25,0.0,0.25]],
-  [[-0.25,0.0,0.25],[-0.25,0.0,0.25],[0.125,-0.125,-0.125]],
-  [[0.0,-0.25,-0.25],[0.0,0.25,0.25],[-0.125,0.125,0.125]],
-  [[-0.125,0.125,0.125],[0.125,-0.125,-0.125]],
-  [[-0.125,-0.125,-0.125],[-0.25,-0.25,-0.25],[0.25,0.25,0.25],[0.125,0.125,0.125]],
-  [[-0.125,-0.125,0.125],[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,0.0,-0.5],[0.25,0.25,0.25],[-0.125,-0.125,-0.125]],
-  [[0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,-0.5,0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
-  [[-0.125,-0.125,0.125],[0.125,-0.125,-0.125]],
-  [[0.0,-0.25,-0.25],[0.0,0.25,0.25]],
-  [[0.125,-0.125,-0.125]],
-  [[0.5,0.0,0.0],[0.5,0.0,0.0]],
-  [[-0.5,0.0,0.0],[-0.25,0.25,0.25],[-0.125,0.125,0.125]],
-  [[0.5,0.0,0.0],[0.25,-0.25,0.25],[-0.125,0.125,-0.125]],
-  [[0.25,-0.25,0.0],[0.25,-0.25,0.0]],
-  [[0.5,0.0,0.0],[-0.25,-0.25,0.25],[-0.125,-0.125,0.125]],
-  [[-0.25,0.0,0.25],[-0.25,0.0,0.25]],
-  [[0.125,0.125,0.125],[-0.125,0.125,0.125]],
-  [[-0.125,0.125,0.125]],
-  [[0.5,0.0,-0.0],[0.25,0.25,0.25],[0.125,0.125,0.125]],
-  [[0.125,-0.125,0.125],[-0.125,-0.125,0.125]],
-  [[-0.25,-0.0,-0.25],[0.25,0.0,0.25]],
-  [[0.125,-0.125,0.125]],
-  [[-0.25,-0.25,0.0],[0.25,0.25,-0.0]],
-  [[-0.125,-0.125,0.125]],
-  [[0.125,0.125,0.125]],
-  [[0,0,0]]]
-
-def compute_surface_distances(mask_gt, mask_pred, spacing_mm):
-  """Compute closest distances from all surface points to the other surface.
-
-  Finds all surface elements "surfels" in the ground truth mask `mask_gt` and
-  the predicted mask `mask_pred`, computes their area in mm^2 and the distance
-  to the closest point on the other surface. It returns two sorted lists of
-  distances together with the corresponding surfel areas. If one of the masks
-  is empty, the corresponding lists are empty and all distances in the other
-  list are `inf` 
-  
-  Args:
-    mask_gt: 3-dim Numpy array of type bool. The ground truth mask.
-    mask_pred: 3-dim Numpy array of type bool. The predicted mask.
-    spacing_mm: 3-element list-like structure. Voxel spacing in x0, x1 and x2
-        direction 
-
-  Returns:
-    A dict with 
-    "distances_gt_to_pred": 1-dim numpy array of type float. The distances in mm
-        from all ground truth surface elements to the predicted surface, 
-        sorted from smallest to largest
-    "distances_pred_to_gt": 1-dim numpy array of type float. The distances in mm
-        from all predicted surface elements to the ground truth surface, 
-        sorted from smallest to largest 
-    "surfel_areas_gt": 1-dim numpy array of type float. The area in mm^2 of 
-        the ground truth surface elements in the same order as 
-        distances_gt_to_pred
-    "surfel_areas_pred": 1-dim numpy array of type float. The area in mm^2 of 
-        the predicted surface elements in the same order as 
-        distances_pred_to_gt
-       
-  """
-  
-  # compute the area for all 256 possible surface elements 
-  # (given a 2x2x2 neighbourhood) according to the spacing_mm
-  neighbour_code_to_surface_area = np.zeros([256])
-  for code in range(256):
-    normals = np.array(neighbour_code_to_normals[code])
-    sum_area = 0
-    for normal_idx in range(normals.shape[0]):
-      # normal vector
-      n = np.zeros([3])
-      n[0] = normals[normal_idx,0] * spacing_mm[1] * spacing_mm[2]
-      n[1] = normals[normal_idx,1] * spacing_mm[0] * spacing_mm[2]
-      n[2] = normals[normal_idx,2] * spacing_mm[0] * spacing_mm[1]
-      area = np.linalg.norm(n)
-      sum_area += area
-    neighbour_code_to_surface_area[code] = sum_area
-
-  # compute the bounding box of the masks to trim
-  # the volume to the smallest possible processing subvolume
-  mask_all = mask_gt | mask_pred
-  bbox_min = np.zeros(3, np.int64)
-  bbox_max = np.zeros(3, np.int64)
-
-  # max projection to the x0-axis
-  proj_0 = np.max(np.max(mask_all, axis=2), axis=1)
-  idx_nonzero_0 = np.nonzero(proj_0)[0]
-  if len(idx_nonzero_0) == 0:
-    return {"distances_gt_to_pred":  np.array([]), 
-            "distances_pred_to_gt":  np.array([]), 
-            "surfel_areas_gt":       np.array([]), 
-            "surfel_areas_pred":     np.array([])}
-    
-  bbox_min[0] = np.min(idx_nonzero_0)
-  bbox_max[0] = np.max(idx_nonzero_0)
-
-  # max projection to the x1-axis
-  proj_1 = np.max(np.max(mask_all, axis=2), axis=0)
-  idx_nonzero_1 = np.nonzero(proj_1)[0]
-  bbox_min[1] = np.min(idx_nonzero_1)
-  bbox_max[1] = np.max(idx_nonzero_1)
-
-  # max projection to the x2-axis
-  proj_2 = np.max(np.max(mask_all, axis=1), axis=0)
-  idx_nonzero_2 = np.nonzero(proj_2)[0]
-  bbox_min[2] = np.min(idx_nonzero_2)
-  bbox_max[2] = np.max(idx_nonzero_2)
-
-#   print("bounding box min = {}".format(bbox_min))
-#   print("bounding box max = {}".format(bbox_max))
-
-  # crop the processing subvolume.
-  # we need to zeropad the cropped region with 1 voxel at the lower, 
-  # the right and the back side. This is required to obtain the "full" 
-  # convolution result with the 2x2x2 kernel
-  cropmask_gt = np.zeros((bbox_max - bbox_min)+2, np.uint8)
-  cropmask_pred = np.zeros((bbox_max - bbox_min)+2, np.uint8)
-
-  cropmask_gt[0:-1, 0:-1, 0:-1] = mask_gt[bbox_min[0]:bbox_max[0]+1,
-                                          bbox_min[1]:bbox_max[1]+1,
-                                          bbox_min[2]:bbox_max[2]+1]
-
-  cropmask_pred[0:-1, 0:-1, 0:-1] = mask_pred[bbox_min[0]:bbox_max[0]+1,
-                                              bbox_min[1]:bbox_max[1]+1,
-                                              bbox_min[2]:bbox_max[2]+1]
-
-  # compute the neighbour code (local binary pattern) for each voxel
-  # the resultsing arrays are spacially shifted by minus half a voxel in each axis.
-  # i.e. the points are located at the corners of the original voxels
-  kernel = np.array([[[128,64],
-                      [32,16]],
-                     [[8,4],
-                      [2,1]]])
-  neighbour_code_map_gt = scipy.ndimage.filters.correlate(cropmask_gt.astype(np.uint8), kernel, mode="constant", cval=0) 
-  neighbour_code_map_pred = scipy.ndimage.filters.correlate(cropmask_pred.astype(np.uint8), kernel, mode="constant", cval=0) 
-
-  # create masks with the surface voxels
-  borders_gt   = ((neighbour_code_map_gt != 0) & (neighbour_code_map_gt != 255))
-  borders_pred = ((neighbour_code_map_pred != 0) & (neighbour_code_map_pred != 255))
-
-  # compute the distance transform (closest distance of each voxel to the surface voxels)
-  if borders_gt.any():
-    distmap_gt = scipy.ndimage.morphology.distance_transform_edt(~borders_gt, sampling=spacing_mm)
-  else:
-    distmap_gt = np.Inf * np.ones(borders_gt.shape)
-
-  if borders_pred.any():  
-    distmap_pred = scipy.ndimage.morphology.distance_transform_edt(~borders_pred, sampling=spacing_mm)
-  else:
-    distmap_pred = np.Inf * np.ones(borders_pred.shape)
-
-  # compute the area of each surface element
-  surface_area_map_gt = neighbour_code_to_surface_area[neighbour_code_map_gt]
-  surface_area_map_pred = neighbour_code_to_surface_area[neighbour_code_map_pred]
-
-  # create a list of all surface elements with distance and area
-  distances_gt_to_pred = distmap_pred[borders_gt]
-  distances_pred_to_gt = distmap_gt[borders_pred]
-  surfel_areas_gt   = surface_area_map_gt[borders_gt]
-  surfel_areas_pred = surface_area_map_pred[borders_pred]
-
-  # sort them by distance
-  if distances_gt_to_pred.shape != (0,):
-    sorted_surfels_gt = np.array(sorted(zip(distances_gt_to_pred, surfel_areas_gt)))
-    distances_gt_to_pred = sorted_surfels_gt[:,0]
-    surfel_areas_gt      = sorted_surfels_gt[:,1]
-
-  if distances_pred_to_gt.shape != (0,):
-    sorted_surfels_pred = np.array(sorted(zip(distances_pred_to_gt, surfel_areas_pred)))
-    distances_pred_to_gt = sorted_surfels_pred[:,0]
-    surfel_areas_pred    = sorted_surfels_pred[:,1]
-
-
-  return {"distances_gt_to_pred":  distances_gt_to_pred, 
-          "distances_pred_to_gt":  distances_pred_to_gt, 
-          "surfel_areas_gt":       surfel_areas_gt, 
-          "surfel_areas_pred":     surfel_areas_pred}
-
-def compute_average_surface_distance(surface_distances):
-  distances_gt_to_pred = surface_distances["distances_gt_to_pred"]
-  distances_pred_to_gt = surface_distances["distances_pred_to_gt"]
-  surfel_areas_gt      = surface_distances["surfel_areas_gt"]
-  surfel_areas_pred    = surface_distances["surfel_areas_pred"]
-  average_distance_gt_to_pred = np.sum( distances_gt_to_pred * surfel_areas_gt) / np.sum(surfel_areas_gt)
-  average_distance_pred_to_gt = np.sum( distances_pred_to_gt * surfel_areas_pred) / np.sum(surfel_areas_pred)
-  return (average_distance_gt_to_pred, average_distance_pred_to_gt)
-
-def compute_robust_hausdorff(surface_distances, percent):
-  distances_gt_to_pred = surface_distances["distances_gt_to_pred"]
-  distances_pred_to_gt = surface_distances["distances_pred_to_gt"]
-  surfel_areas_gt      = surface_distances["surfel_areas_gt"]
-  surfel_areas_pred    = surface_distances["surfel_areas_pred"]
-  if len(distances_gt_to_pred) > 0:
-    surfel_areas_cum_gt   = np.cumsum(surfel_areas_gt) / np.sum(surfel_areas_gt)
-    idx = np.searchsorted(surfel_areas_cum_gt, percent/100.0)
-    perc_distance_gt_to_pred = distances_gt_to_pred[min(idx, len(distances_gt_to_pred)-1)]
-  else:
-    perc_distance_gt_to_pred = np.Inf
-    
-  if len(distances_pred_to_gt) > 0:
-    surfel_areas_cum_pred = np.cumsum(surfel_areas_pred) / np.sum(surfel_areas_pred)
-    idx = np.searchsorted(surfel_areas_cum_pred, percent/100.0)
-    perc_distance_pred_to_gt = distances_pred_to_gt[min(idx, len(distances_pred_to_gt)-1)]
-  else:
-    perc_distance_pred_to_gt = np.Inf
-    
-  return max( perc_distance_gt_to_pred, perc_distance_pred_to_gt)
-
-def compute_surface_overlap_at_tolerance(surface_distances, tolerance_mm):
-  distances_gt_to_pred = surface_distances["distances_gt_to_pred"]
-  distances_pred_to_gt = surface_distances["distances_pred_to_gt"]
-  surfel_areas_gt      = surface_distances["surfel_areas_gt"]
-  surfel_areas_pred    = surface_distances["surfel_areas_pred"]
-  rel_overlap_gt   = np.sum(surfel_areas_gt[distances_gt_to_pred <= tolerance_mm]) / np.sum(surfel_areas_gt)
-  rel_overlap_pred = np.sum(surfel_areas_pred[distances_pred_to_gt <= tolerance_mm]) / np.sum(surfel_areas_pred)
-  return (rel_overlap_gt, rel_overlap_pred)
-
-def compute_surface_dice_at_tolerance(surface_distances, tolerance_mm):
-  distances_gt_to_pred = surface_distances["distances_gt_to_pred"]
-  distances_pred_to_gt = surface_distances["distances_pred_to_gt"]
-  surfel_areas_gt      = surface_distances["surfel_areas_gt"]
-  surfel_areas_pred    = surface_distances["surfel_areas_pred"]
-  overlap_gt   = np.sum(surfel_areas_gt[distances_gt_to_pred <= tolerance_mm])
-  overlap_pred = np.sum(surfel_areas_pred[distances_pred_to_gt <= tolerance_mm])
-  surface_dice = (overlap_gt + overlap_pred) / (
-      np.sum(surfel_areas_gt) + np.sum(surfel_areas_pred))
-  return surface_dice
-
-def compute_dice_coefficient(mask_gt, mask_pred):
-  """Compute soerensen-dice coefficient.
-
-  compute the soerensen-dice coefficient between the ground truth mask `mask_gt`
-  and the predicted mask `mask_pred`. 
-  
-  Args:
-    mask_gt: 3-dim Numpy array of type bool. The ground truth mask.
-    mask_pred: 3-dim Numpy array of type bool. The predicted mask.
-
-  Returns:
-    the dice coeffcient as float. If both masks are empty, the result is NaN
-  """
-  volume_sum = mask_gt.sum() + mask_pred.sum()
-  if volume_sum == 0:
-    return np.NaN
-  volume_intersect = (mask_gt & mask_pred).sum()
-  return 2*volume_intersect / volume_sum
- 
- 
- 
- 
- 
-
-def cal_metric(gt, pred, voxel_spacing):
-    if pred.sum() > 0 and gt.sum() > 0:
-        dice = metric.binary.dc(pred, gt)
-        hd95 = metric.binary.hd95(pred, gt, voxelspacing=voxel_spacing)
-        return np.array([dice, hd95])
-    else:
-        return np.array([0.0, 50])
+import multiprocessing
+import os
 
-def each_cases_metric(gt, pred, voxel_spacing):
-    classes_num = gt.max() + 1
-    class_wise_metric = np.zeros((classes_num-1, 2))
-    for cls in tqdm(range(1, classes_num)):
-        
-        # COVID 19 
-        # surface_distances = compute_surface_distances(gt==cls, pred==cls, voxel_spacing)
-        # class_wise_metric[cls-1, ...] = [compute_dice_coefficient(gt==cls, pred==cls),compute_robust_hausdorff(surface_distances, 95)]
-        
-        # WORD
-        class_wise_metric[cls-1, ...] = cal_metric(pred==cls, gt==cls, voxel_spacing)
-        
-    print(class_wise_metric)
-    return class_wise_metric
+import numpy as np
 
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.evaluation.evaluate_predictions import compute_confusion_matrix, tp_fp_fn_tn_from_confusion_matrix
+from nnunetv2.evaluation.surface_distance import compute_surface_metrics_for_regions
+from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
 
 cal_filename = "predictionsTs"
-class_list = ['Liver','Spleen','Kidney(L)','Kidney(R)','Stomach','Gallbladder','Esophagus','Pancreas','Duodenum','Colon','Intestine','Adrenal','Rectum','Bladder','Head of Femur(L)','Head of Femur(R)']
-
-
-def evaluation_one(args,id="0014"):
-  result_dict = {
-      "name": args.pred_dir,
-      "mean": {},
-      "dice": {},
-      "HD95": {},
-      "detailed": {}
-  }
-  
-  
-  all_results = np.zeros((1,16,3))
-  
-  ind=0
-  case=f"word_{id}.nii.gz"
-
-  gt_itk = sitk.ReadImage(os.path.join(args.GT_dir,case))
-  gt_array = sitk.GetArrayFromImage(gt_itk)
-  pred_itk = sitk.ReadImage(os.path.join(args.pred_dir,case))
-  pred_array = sitk.GetArrayFromImage(pred_itk)
-  
-  print(f'{ind}/1: evaluating {case}...')
-  print()
-  
-  gt_size = gt_itk.GetSize()
-  gt_spacing = gt_itk.GetSpacing()
-  
-  if gt_array.shape != pred_array.shape:
-      raise ValueError(f"shape of gt_array({gt_array.shape}) != shape of pred_array({pred_array.shape})")
-    # resampled_pred = sitk.Resample(pred_itk, gt_size, sitk.Transform(), sitk.sitkNearestNeighbor, pred_itk.GetOrigin(),
-    #                     gt_spacing, pred_itk.GetDirection(), 0.0, pred_itk.GetPixelID())
-    # pred_array = sitk.GetArrayFromImage(resampled_pred)
-  
-  all_results[ind, :, :-1] = each_cases_metric(gt_array, pred_array, gt_spacing)
-
-  fg_dice = metric.binary.dc(pred_array!=0,gt_array!=0)
-  all_results[ind, :, 2] = fg_dice
-  print(f"foreground_dice:{fg_dice}")
-
-  
+class_list = ['Liver', 'Spleen', 'Kidney(L)', 'Kidney(R)', 'Stomach', 'Gallbladder', 'Esophagus', 'Pancreas',
+              'Duodenum', 'Colon', 'Intestine', 'Adrenal', 'Rectum', 'Bladder', 'Head of Femur(L)', 'Head of Femur(R)']
+# HD95 and dice of classes that are missing in reference or prediction
+missing_class_hd95 = 50
+
+
+def _dice(tp, fp, fn) -> float:
+    # medpy's dc returns 0 if both are empty
+    return 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else 0.
+
+
+def evaluate_case(gt_file: str, pred_file: str) -> np.ndarray:
+    """
+    returns array of shape (len(class_list), 3): dice, HD95, foreground dice (same value for all classes)
+    """
+    rw = SimpleITKIO()
+    gt, gt_props = rw.read_seg(gt_file)
+    pred, _ = rw.read_seg(pred_file)
+    if gt.shape != pred.shape:
+        raise ValueError(f"shape of gt_array({gt.shape[1:]}) != shape of pred_array({pred.shape[1:]}). Case: "
+                         f"{os.path.basename(gt_file)}")
+    gt, pred = gt[0], pred[0]
+    labels = list(range(1, len(class_list) + 1))
+
+    confusion_matrix = compute_confusion_matrix(gt, pred)
+    class_wise_metric = np.zeros((len(class_list), 3))
+    class_wise_metric[:, 1] = missing_class_hd95
+    present = []
+    for i, l in enumerate(labels):
+        tp, fp, fn, _ = tp_fp_fn_tn_from_confusion_matrix(confusion_matrix, l)
+        if tp + fn > 0 and tp + fp > 0:
+            class_wise_metric[i, 0] = _dice(tp, fp, fn)
+            present.append(l)
+    # spacing from the reader is in the axis order of the array (sitk's GetSpacing is not!)
+    hd95 = compute_surface_metrics_for_regions(gt, pred, present, gt_props['spacing'], ('HD95', ), mode='voxel')
+    for l in present:
+        class_wise_metric[l - 1, 1] = hd95[l]['HD95']
+
+    tp, fp, fn, _ = tp_fp_fn_tn_from_confusion_matrix(confusion_matrix, tuple(range(1, confusion_matrix.shape[0])))
+    class_wise_metric[:, 2] = _dice(tp, fp, fn)
+    print(f'{os.path.basename(gt_file)}: foreground_dice {class_wise_metric[0, 2]}')
+    print(class_wise_metric[:, :2])
+    return class_wise_metric
 
-  result_dict['detailed'][case] = {'foreground_dice': all_results[ind, 0, 2],
-                                    'dice':{},
-                                    'HD95':{}}
-  for i in range(len(class_list)):
-    result_dict['detailed'][case]['dice'][class_list[i]] = all_results[ind,i,0]
-    result_dict['detailed'][case]['HD95'][class_list[i]] = all_results[ind,i,1]
 
-  result_dict["mean"] = {"dice":np.mean(all_results[:,:,0]),
-                        "HD95":np.mean(all_results[:,:,1]),
-                        "part_HD95":np.mean(all_results[:,:-2,1]),
-                        "foreground_dice":np.mean(all_results[:,0,2])}
-  
-  mean_results = np.mean(all_results,0)
-  for i in range(len(class_list)):
-      result_dict['dice'][class_list[i]] = mean_results[i,0]
-      result_dict['HD95'][class_list[i]] = mean_results[i,1]
+def _evaluate_cases(args, cases) -> dict:
+    result_dict = {
+        "name": args.pred_dir,
+        "mean": {},
+        "dice": {},
+        "HD95": {},
+        "detailed": {}
+    }
+    print(f'evaluating {len(cases)} cases...')
+    with multiprocessing.get_context("spawn").Pool(args.np) as pool:
+        all_results = np.stack(pool.starmap(evaluate_case, [(os.path.join(args.GT_dir, c),
+                                                             os.path.join(args.pred_dir, c)) for c in cases]))
+
+    for ind, case in enumerate(cases):
+        result_dict['detailed'][case] = {'foreground_dice': all_results[ind, 0, 2],
+                                         'dice': {},
+                                         'HD95': {}}
+        for i in range(len(class_list)):
+            result_dict['detailed'][case]['dice'][class_list[i]] = all_results[ind, i, 0]
+            result_dict['detailed'][case]['HD95'][class_list[i]] = all_results[ind, i, 1]
+
+    result_dict["mean"] = {"dice": np.mean(all_results[:, :, 0]),
+                           "HD95": np.mean(all_results[:, :, 1]),
+                           "part_HD95": np.mean(all_results[:, :-2, 1]),
+                           "foreground_dice": np.mean(all_results[:, 0, 2])}
+
+    mean_results = np.mean(all_results, 0)
+    for i in range(len(class_list)):
+        result_dict['dice'][class_list[i]] = mean_results[i, 0]
+        result_dict['HD95'][class_list[i]] = mean_results[i, 1]
 
-  with open(os.path.join(args.pred_dir,cal_filename)+'.json', 'w') as json_file:
-      json.dump(result_dict, json_file, indent=4)
+    with open(os.path.join(args.pred_dir, cal_filename) + '.json', 'w') as json_file:
+        json.dump(result_dict, json_file, indent=4)
 
-  print(f"dice:{np.mean(all_results[:,:,0])}")
-  print(f"HD95:{np.mean(all_results[:,:,1])}")
-  print("done")
-  return result_dict
+    print(f"dice:{result_dict['mean']['dice']}")
+    print(f"HD95:{result_dict['mean']['HD95']}")
+    print("done")
+    return result_dict
 
 
-def evaluation_test(args):
+def evaluation_one(args, id="0014"):
+    return _evaluate_cases(args, [f"word_{id}.nii.gz"])
 
-  for ind, case in (enumerate(sorted(os.listdir(args.GT_dir)))):
-    gt_itk = sitk.ReadImage(os.path.join(args.GT_dir,case))
-    pred_itk = sitk.ReadImage(os.path.join(args.pred_dir,case))
-    
-    print(f'{ind}/30: evaluating {case}...')
-    print()
-    
-    gt_size = gt_itk.GetSize()
-    pred_size = pred_itk.GetSize()
-    if gt_size != pred_size:
-      print(f"{case}: gt_size {gt_size} / pred_size {pred_size}")
-    
-    
 
 def evaluation(args):
-  result_dict = {
-      "name": args.pred_dir,
-      "mean": {},
-      "dice": {},
-      "HD95": {},
-      "detailed": {}
-  }
-  
-  
-  all_results = np.zeros((30,16,3))
-  for ind, case in (enumerate(sorted(os.listdir(args.GT_dir)))):
-    gt_itk = sitk.ReadImage(os.path.join(args.GT_dir,case))
-    gt_array = sitk.GetArrayFromImage(gt_itk)
-    pred_itk = sitk.ReadImage(os.path.join(args.pred_dir,case))
-    pred_array = sitk.GetArrayFromImage(pred_itk)
+    return _evaluate_cases(args, sorted(os.listdir(args.GT_dir)))
 
-    print(f'{ind}/30: evaluating {case}...')
-    print()
-    
-    gt_size = gt_itk.GetSize()
-    gt_spacing = gt_itk.GetSpacing()
-
-    if gt_array.shape != pred_array.shape:
-      ValueError(f"shape of gt_array({gt_array.shape}) != shape of pred_array({pred_array.shape})")
-    # resampled_pred = sitk.Resample(pred_itk, gt_size, sitk.Transform(), sitk.sitkNearestNeighbor, pred_itk.GetOrigin(),
-    #                     gt_spacing, pred_itk.GetDirection(), 0.0, pred_itk.GetPixelID())
-    # pred_array = sitk.GetArrayFromImage(resampled_pred)
-    
-    all_results[ind, :, :-1] = each_cases_metric(gt_array, pred_array, gt_spacing)
-
-    fg_dice = metric.binary.dc(pred_array!=0,gt_array!=0)
-    all_results[ind, :, 2] = fg_dice
-    print(f"foreground_dice:{fg_dice}")
-  
-  
-  for ind, case in (enumerate(sorted(os.listdir(args.GT_dir)))):
-    result_dict['detailed'][case] = {'foreground_dice': all_results[ind, 0, 2],
-                                      'dice':{},
-                                      'HD95':{}}
-    for i in range(len(class_list)):
-      result_dict['detailed'][case]['dice'][class_list[i]] = all_results[ind,i,0]
-      result_dict['detailed'][case]['HD95'][class_list[i]] = all_results[ind,i,1]
-
-  result_dict["mean"] = {"dice":np.mean(all_results[:,:,0]),
-                        "HD95":np.mean(all_results[:,:,1]),
-                        "part_HD95":np.mean(all_results[:,:-2,1]),
-                        "foreground_dice":np.mean(all_results[:,0,2])}
-  
-  mean_results = np.mean(all_results,0)
-  for i in range(len(class_list)):
-      result_dict['dice'][class_list[i]] = mean_results[i,0]
-      result_dict['HD95'][class_list[i]] = mean_results[i,1]
-
-  with open(os.path.join(args.pred_dir,cal_filename)+'.json', 'w') as json_file:
-      json.dump(result_dict, json_file, indent=4)
-
-  print(f"dice:{np.mean(all_results[:,:,0])}")
-  print(f"HD95:{np.mean(all_results[:,:,1])}")
-  print("done")
-  return result_dict
 
 def main():
     parser = argparse.ArgumentParser()
@@ -688,20 +125,16 @@ def main():
     parser.add_argument('-p', '--pred_dir', help="pred_exp_name",
                         default="/media/ps/passport2/ltc/nnUNetv2/nnUNet_outputs/WORD/3d_lowres/fold2/6_4_4_patch96_128_128_step0.5_chkfinal_down1.0_1.0_1.0/stage_2/save_stage2_roi_th_0.5_level_sample_8.0_16.0_16.0_patch_64_192_160_center_canvas_64_192_160_shuffle_False_nms_0.5_prior_False_expand0_itc_0.0_pix_0.0_child_nmm_0.35_max/", required=False)
     parser.add_argument('--mode',type=str,default='word')
-    
+    parser.add_argument('-np', type=int, required=False, default=default_num_processes,
+                        help=f'number of processes (cases are evaluated in parallel). Default: {default_num_processes}')
+
     args = parser.parse_args()
-    # evaluation_test(args)
-    try:       
-      for ind, case in (enumerate(sorted(os.listdir(args.GT_dir)))):
-        pred_itk = sitk.ReadImage(os.path.join(args.pred_dir,case))
-      evaluation(args)
-    except:
-      print(f"prediction not done, trying to evaluate word_14 only!")
-      evaluation_one(args,id="0014")
+    if all(os.path.isfile(os.path.join(args.pred_dir, case)) for case in os.listdir(args.GT_dir)):
+        evaluation(args)
+    else:
+        print(f"prediction not done, trying to evaluate word_14 only!")
+        evaluation_one(args, id="0014")
+
 
-    '''
-    plt.imsave("gt.jpg",gt_array[100,:,:])
-    plt.imsave("pred.jpg",pred_array[100,:,:])
-    '''
-if __name__ == "__main__":  
-  main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
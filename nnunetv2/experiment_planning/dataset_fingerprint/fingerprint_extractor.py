@@ -4,17 +4,23 @@ from time import sleep
 from typing import List, Type, Union
 
 import numpy as np
-from batchgenerators.utilities.file_and_folder_operations import load_json, join, save_json, isfile, maybe_mkdir_p
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, save_json, isfile, maybe_mkdir_p, \
+    subfiles, load_pickle, write_pickle
 from tqdm import tqdm
 
+from nnunetv2.experiment_planning.dataset_fingerprint.intensity_summary import summarize_intensities, \
+    merge_intensity_summaries
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
 from nnunetv2.paths import nnUNet_raw, nnUNet_preprocessed
 from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
+from nnunetv2.preprocessing.preprocessors.preprocessing_manifest import get_input_signature, is_unchanged
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
 from nnunetv2.utilities.utils import get_filenames_of_train_images_and_targets
+from nnunetv2.utilities.find_class_by_name import register_class
 
 
+@register_class
 class DatasetFingerprintExtractor(object):
     def __init__(self, dataset_name_or_id: Union[str, int], num_processes: int = 8, verbose: bool = False):
         """
@@ -33,16 +39,18 @@ class DatasetFingerprintExtractor(object):
         self.dataset_json = load_json(join(self.input_folder, 'dataset.json'))
         self.dataset = get_filenames_of_train_images_and_targets(self.input_folder, self.dataset_json)
 
-        # We don't want to use all foreground voxels because that can accumulate a lot of data (out of memory). It is
-        # also not critically important to get all pixels as long as there are enough. Let's use 10e7 voxels in total
-        # (for the entire dataset)
-        self.num_foreground_voxels_for_intensitystats = 10e7
+        # Each case is summarized by the exact moments and this many quantiles of its foreground intensities (see
+        # intensity_summary.py). All cases have the same weight in the dataset statistics. Memory in the main process
+        # is num_cases * num_intensity_quantiles_per_case floats per channel, no matter how large the images are
+        self.num_intensity_quantiles_per_case = 1000
 
     @staticmethod
-    def collect_foreground_intensities(segmentation: np.ndarray, images: np.ndarray, seed: int = 1234,
-                                       num_samples: int = 10000):
+    def collect_foreground_intensities(segmentation: np.ndarray, images: np.ndarray, num_quantiles: int = 1000):
         """
         images=image with multiple channels = shape (c, x, y(, z))
+
+        returns the mergeable intensity summaries (one per channel, None if there is no foreground) as well as the
+        intensity statistics of this case
         """
         assert images.ndim == 4
         assert segmentation.ndim == 4
@@ -50,9 +58,7 @@ class DatasetFingerprintExtractor(object):
         assert not np.any(np.isnan(segmentation)), "Segmentation contains NaN values. grrrr.... :-("
         assert not np.any(np.isnan(images)), "Images contains NaN values. grrrr.... :-("
 
-        rs = np.random.RandomState(seed)
-
-        intensities_per_channel = []
+        intensity_summaries_per_channel = []
         # we don't use the intensity_statistics_per_channel at all, it's just something that might be nice to have
         intensity_statistics_per_channel = []
 
@@ -60,29 +66,17 @@ class DatasetFingerprintExtractor(object):
         foreground_mask = segmentation[0] > 0
 
         for i in range(len(images)):
-            foreground_pixels = images[i][foreground_mask]
-            num_fg = len(foreground_pixels)
-            # sample with replacement so that we don't get issues with cases that have less than num_samples
-            # foreground_pixels. We could also just sample less in those cases but that would than cause these
-            # training cases to be underrepresented
-            intensities_per_channel.append(
-                rs.choice(foreground_pixels, num_samples, replace=True) if num_fg > 0 else [])
-            intensity_statistics_per_channel.append({
-                'mean': np.mean(foreground_pixels) if num_fg > 0 else np.nan,
-                'median': np.median(foreground_pixels) if num_fg > 0 else np.nan,
-                'min': np.min(foreground_pixels) if num_fg > 0 else np.nan,
-                'max': np.max(foreground_pixels) if num_fg > 0 else np.nan,
-                'percentile_99_5': np.percentile(foreground_pixels, 99.5) if num_fg > 0 else np.nan,
-                'percentile_00_5': np.percentile(foreground_pixels, 0.5) if num_fg > 0 else np.nan,
-
-            })
-
-        return intensities_per_channel, intensity_statistics_per_channel
+            summary = summarize_intensities(images[i][foreground_mask], num_quantiles)
+            intensity_summaries_per_channel.append(summary)
+            intensity_statistics_per_channel.append(merge_intensity_summaries([summary]))
+
+        return intensity_summaries_per_channel, intensity_statistics_per_channel
 
     @staticmethod
     def analyze_case(image_files: List[str], segmentation_file: str, reader_writer_class: Type[BaseReaderWriter],
-                     num_samples: int = 10000):
-        rw = reader_writer_class()
+                     num_quantiles: int = 1000):
+        # native dtype: no need to blow everything up to float32 just to look at the intensities
+        rw = reader_writer_class(native_dtype=True)
         images, properties_images = rw.read_images(image_files)
         segmentation, properties_seg = rw.read_seg(segmentation_file)
 
@@ -92,17 +86,51 @@ class DatasetFingerprintExtractor(object):
         # way. This is only possible because we are now using our new input/output interface.
         data_cropped, seg_cropped, bbox = crop_to_nonzero(images, segmentation)
 
-        foreground_intensities_per_channel, foreground_intensity_stats_per_channel = \
+        foreground_intensity_summaries_per_channel, foreground_intensity_stats_per_channel = \
             DatasetFingerprintExtractor.collect_foreground_intensities(seg_cropped, data_cropped,
-                                                                       num_samples=num_samples)
+                                                                       num_quantiles=num_quantiles)
 
         spacing = properties_images['spacing']
 
         shape_before_crop = images.shape[1:]
         shape_after_crop = data_cropped.shape[1:]
         relative_size_after_cropping = np.prod(shape_after_crop) / np.prod(shape_before_crop)
-        return shape_after_crop, spacing, foreground_intensities_per_channel, foreground_intensity_stats_per_channel, \
-               relative_size_after_cropping
+        return shape_after_crop, spacing, foreground_intensity_summaries_per_channel, \
+               foreground_intensity_stats_per_channel, relative_size_after_cropping
+
+    @staticmethod
+    def analyze_case_and_cache(image_files: List[str], segmentation_file: str,
+                               reader_writer_class: Type[BaseReaderWriter], num_quantiles: int, input_folder: str,
+                               cache_file: str, cache_settings: dict):
+        """
+        Runs analyze_case and stores its result together with the signature of the input files (size, mtime, hash)
+        in cache_file so that the next fingerprint extraction can skip this case if it didn't change. Hashing is done
+        here and not in the main process so that it is parallelized as well
+        """
+        result = DatasetFingerprintExtractor.analyze_case(image_files, segmentation_file, reader_writer_class,
+                                                          num_quantiles)
+        signature = get_input_signature(image_files + [segmentation_file], input_folder)
+        tmp_file = cache_file + '.tmp'
+        write_pickle({'settings': cache_settings, 'signature': signature, 'result': result}, tmp_file)
+        os.replace(tmp_file, cache_file)
+        return result
+
+    def _load_cached_result(self, identifier: str, cache_file: str, cache_settings: dict):
+        """
+        Returns the cached analyze_case result for this case or None if there is no valid one
+        """
+        if not isfile(cache_file):
+            return None
+        try:
+            cached = load_pickle(cache_file)
+        except Exception:
+            return None
+        if cached['settings'] != cache_settings:
+            return None
+        input_files = self.dataset[identifier]['images'] + [self.dataset[identifier]['label']]
+        # only hashes the files if size or mtime changed
+        signature = get_input_signature(input_files, self.input_folder, cached['signature'])
+        return cached['result'] if is_unchanged(signature, cached['signature']) else None
 
     def run(self, overwrite_existing: bool = False) -> dict:
         # we do not save the properties file in self.input_folder because that folder might be read-only. We can only
@@ -116,21 +144,41 @@ class DatasetFingerprintExtractor(object):
                                                                             # yikes. Rip the following line
                                                                             self.dataset[self.dataset.keys().__iter__().__next__()]['images'][0])
 
-            # determine how many foreground voxels we need to sample per training case
-            num_foreground_samples_per_case = int(self.num_foreground_voxels_for_intensitystats //
-                                                  len(self.dataset))
+            # per case cache of the analyze_case results. Cases whose files did not change since the last run are
+            # not read again, so re-running the fingerprint extraction after adding cases only touches the new ones
+            cache_folder = join(preprocessed_output_folder, 'fingerprint_cache')
+            maybe_mkdir_p(cache_folder)
+            cache_settings = {'fingerprint_extractor': self.__class__.__name__,
+                              'reader_writer': reader_writer_class.__name__,
+                              'num_quantiles': self.num_intensity_quantiles_per_case}
+            for f in subfiles(cache_folder, join=False):
+                if not f.endswith('.pkl') or f[:-4] not in self.dataset.keys():
+                    os.remove(join(cache_folder, f))
+
+            results = {}
+            for k in self.dataset.keys():
+                cached = self._load_cached_result(k, join(cache_folder, k + '.pkl'), cache_settings)
+                if cached is not None:
+                    results[k] = cached
+            keys_to_process = [k for k in self.dataset.keys() if k not in results.keys()]
+            # largest cases first so that the workers finish at roughly the same time. Only needs the image headers
+            rw = reader_writer_class()
+            keys_to_process.sort(key=lambda k: np.prod(rw.read_header(self.dataset[k]['images'][0])['shape'][1:]),
+                                 reverse=True)
+            print(f'{len(keys_to_process)} of {len(self.dataset)} cases need to be analyzed, the rest is cached')
 
             r = []
             with multiprocessing.get_context("spawn").Pool(self.num_processes) as p:
-                for k in self.dataset.keys():
-                    r.append(p.starmap_async(DatasetFingerprintExtractor.analyze_case,
+                for k in keys_to_process:
+                    r.append(p.starmap_async(DatasetFingerprintExtractor.analyze_case_and_cache,
                                              ((self.dataset[k]['images'], self.dataset[k]['label'], reader_writer_class,
-                                               num_foreground_samples_per_case),)))
-                remaining = list(range(len(self.dataset)))
+                                               self.num_intensity_quantiles_per_case, self.input_folder,
+                                               join(cache_folder, k + '.pkl'), cache_settings),)))
+                remaining = list(range(len(keys_to_process)))
                 # p is pretty nifti. If we kill workers they just respawn but don't do any work.
                 # So we need to store the original pool of workers.
                 workers = [j for j in p._pool]
-                with tqdm(desc=None, total=len(self.dataset), disable=self.verbose) as pbar:
+                with tqdm(desc=None, total=len(keys_to_process), disable=self.verbose) as pbar:
                     while len(remaining) > 0:
                         all_alive = all([j.is_alive() for j in workers])
                         if not all_alive:
@@ -142,21 +190,17 @@ class DatasetFingerprintExtractor(object):
                                                'an error message, out of RAM is likely the problem. In that case '
                                                'reducing the number of workers might help')
                         done = [i for i in remaining if r[i].ready()]
-                        for _ in done:
+                        for i in done:
+                            results[keys_to_process[i]] = r[i].get()[0]
                             pbar.update()
                         remaining = [i for i in remaining if i not in done]
                         sleep(0.1)
 
-            # results = ptqdm(DatasetFingerprintExtractor.analyze_case,
-            #                 (training_images_per_case, training_labels_per_case),
-            #                 processes=self.num_processes, zipped=True, reader_writer_class=reader_writer_class,
-            #                 num_samples=num_foreground_samples_per_case, disable=self.verbose)
-            results = [i.get()[0] for i in r]
+            # keep the order of the dataset
+            results = [results[k] for k in self.dataset.keys()]
 
             shapes_after_crop = [r[0] for r in results]
             spacings = [r[1] for r in results]
-            foreground_intensities_per_channel = [np.concatenate([r[2][i] for r in results]) for i in
-                                                  range(len(results[0][2]))]
             # we drop this so that the json file is somewhat human readable
             # foreground_intensity_stats_by_case_and_modality = [r[3] for r in results]
             median_relative_size_after_cropping = np.median([r[4] for r in results], 0)
@@ -166,15 +210,7 @@ class DatasetFingerprintExtractor(object):
                                  else self.dataset_json['modality'].keys())
             intensity_statistics_per_channel = {}
             for i in range(num_channels):
-                intensity_statistics_per_channel[i] = {
-                    'mean': float(np.mean(foreground_intensities_per_channel[i])),
-                    'median': float(np.median(foreground_intensities_per_channel[i])),
-                    'std': float(np.std(foreground_intensities_per_channel[i])),
-                    'min': float(np.min(foreground_intensities_per_channel[i])),
-                    'max': float(np.max(foreground_intensities_per_channel[i])),
-                    'percentile_99_5': float(np.percentile(foreground_intensities_per_channel[i], 99.5)),
-                    'percentile_00_5': float(np.percentile(foreground_intensities_per_channel[i], 0.5)),
-                }
+                intensity_statistics_per_channel[i] = merge_intensity_summaries([r[2][i] for r in results])
 
             fingerprint = {
                     "spacings": spacings,
@@ -0,0 +1,72 @@
+from typing import List, Union
+
+import numpy as np
+
+"""
+Mergeable summaries of the foreground intensities of a case. Instead of shipping (potentially millions of) sampled
+voxels from the workers to the main process, each case is reduced to its exact moments, min/max and a fixed number of
+quantiles. Summaries of any number of cases can then be merged into the dataset wide intensity statistics in
+O(num_cases * num_quantiles), independent of the image sizes.
+
+Like the sampling we did before, every case contributes with the same weight, regardless of how many foreground voxels
+it has. Mean and std are exact (under that weighting), the percentiles are approximations whose resolution is
+determined by num_quantiles.
+"""
+
+
+def summarize_intensities(values: np.ndarray, num_quantiles: int = 1000) -> Union[dict, None]:
+    """
+    values is the 1d array of foreground intensities of one channel of one case. Returns None if there are no values.
+
+    The quantiles are taken at the centers of num_quantiles equally sized bins of the cumulative distribution, so each
+    of them represents 1/num_quantiles of the case
+    """
+    if len(values) == 0:
+        return None
+    values = values.astype(np.float64, copy=False)
+    q = (np.arange(num_quantiles) + 0.5) / num_quantiles
+    return {
+        'num_voxels': int(len(values)),
+        'mean': float(np.mean(values)),
+        'variance': float(np.var(values)),
+        'min': float(np.min(values)),
+        'max': float(np.max(values)),
+        'quantiles': np.quantile(values, q).astype(np.float32),
+    }
+
+
+def merge_intensity_summaries(summaries: List[Union[dict, None]]) -> dict:
+    """
+    Merges the summaries of one channel (one per case, None for cases without foreground) into the intensity
+    statistics stored in the dataset fingerprint
+    """
+    summaries = [s for s in summaries if s is not None]
+    if len(summaries) == 0:
+        return {k: np.nan for k in ('mean', 'median', 'std', 'min', 'max', 'percentile_99_5', 'percentile_00_5')}
+    # equal weight per case
+    means = np.array([s['mean'] for s in summaries])
+    # law of total variance. Numerically more benign than E[x^2] - E[x]^2
+    variance = np.mean([s['variance'] for s in summaries]) + np.var(means)
+    quantiles = np.concatenate([s['quantiles'] for s in summaries])
+    return {
+        'mean': float(np.mean(means)),
+        'median': float(np.median(quantiles)),
+        'std': float(np.sqrt(variance)),
+        'min': float(min(s['min'] for s in summaries)),
+        'max': float(max(s['max'] for s in summaries)),
+        'percentile_99_5': float(np.percentile(quantiles, 99.5)),
+        'percentile_00_5': float(np.percentile(quantiles, 0.5)),
+    }
+
+
+if __name__ == '__main__':
+    # compare against the statistics computed from all values of all cases (each case weighted equally)
+    rs = np.random.RandomState(1234)
+    cases = [rs.normal(rs.uniform(-100, 100), rs.uniform(10, 200), size=rs.randint(1000, 200000)) for _ in range(20)]
+    merged = merge_intensity_summaries([summarize_intensities(c) for c in cases])
+    num_samples = 100000
+    reference = np.concatenate([rs.choice(c, num_samples) for c in cases])
+    for k, fn in (('mean', np.mean), ('median', np.median), ('std', np.std),
+                  ('percentile_99_5', lambda x: np.percentile(x, 99.5)),
+                  ('percentile_00_5', lambda x: np.percentile(x, 0.5))):
+        print(k, merged[k], fn(reference))
@@ -19,8 +19,10 @@ from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_datas
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folder, \
     get_filenames_of_train_images_and_targets
+from nnunetv2.utilities.find_class_by_name import register_class
 
 
+@register_class
 class ExperimentPlanner(object):
     def __init__(self, dataset_name_or_id: Union[str, int],
                  gpu_memory_target_in_gb: float = 8,
@@ -64,6 +66,13 @@ class ExperimentPlanner(object):
         self.UNet_min_batch_size = 2
         self.UNet_max_features_2d = 512
         self.UNet_max_features_3d = 320
+        # trading compute for memory. With gradient accumulation the trainer processes each batch in
+        # UNet_gradient_accumulation_steps micro batches, so only the micro batch needs to fit into VRAM. Activation
+        # checkpointing of the encoder/decoder stages roughly halves the memory needed for the feature maps (this
+        # factor is an estimate, not a measurement for each topology)
+        self.UNet_gradient_accumulation_steps = 1
+        self.UNet_activation_checkpointing = False
+        self.UNet_activation_checkpointing_vram_factor = 0.5
 
         self.lowres_creation_threshold = 0.25  # if the patch size of fullres is less than 25% of the voxels in the
         # median shape then we need a lowres config as well
@@ -283,7 +292,14 @@ class ExperimentPlanner(object):
         reference = (self.UNet_reference_val_2d if len(spacing) == 2 else self.UNet_reference_val_3d) * \
                     (self.UNet_vram_target_GB / self.UNet_reference_val_corresp_GB)
 
-        while estimate > reference:
+        # with gradient accumulation the patch size must only fit for a micro batch (of the minimum batch size), with
+        # activation checkpointing fewer feature maps are kept in memory
+        checkpointing_factor = self.UNet_activation_checkpointing_vram_factor if self.UNet_activation_checkpointing \
+            else 1
+        micro_batch_factor = np.ceil(self.UNet_min_batch_size / self.UNet_gradient_accumulation_steps) / \
+            self.UNet_min_batch_size
+
+        while estimate * checkpointing_factor * micro_batch_factor > reference:
             # print(patch_size)
             # patch size seems to be too large, so we need to reduce it. Reduce the axis that currently violates the
             # aspect ratio the most (that is the largest relative to median shape)
@@ -328,7 +344,7 @@ class ExperimentPlanner(object):
         # alright now let's determine the batch size. This will give self.UNet_min_batch_size if the while loop was
         # executed. If not, additional vram headroom is used to increase batch size
         ref_bs = self.UNet_reference_val_corresp_bs_2d if len(spacing) == 2 else self.UNet_reference_val_corresp_bs_3d
-        batch_size = round((reference / estimate) * ref_bs)
+        batch_size = round((reference / (estimate * checkpointing_factor)) * ref_bs)
 
         # we need to cap the batch size to cover at most 5% of the entire dataset. Overfitting precaution. We cannot
         # go smaller than self.UNet_min_batch_size though
@@ -366,6 +382,10 @@ class ExperimentPlanner(object):
             'resampling_fn_probabilities': resampling_softmax.__name__,
             'resampling_fn_probabilities_kwargs': resampling_softmax_kwargs,
         }
+        if self.UNet_gradient_accumulation_steps != 1 or self.UNet_activation_checkpointing:
+            # the trainer defaults to 1 and False if these are not in the plans
+            plan['gradient_accumulation_steps'] = self.UNet_gradient_accumulation_steps
+            plan['activation_checkpointing'] = self.UNet_activation_checkpointing
         return plan
 
     def plan_experiment(self):
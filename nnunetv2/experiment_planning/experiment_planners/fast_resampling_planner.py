@@ -0,0 +1,30 @@
+from typing import Union, List, Tuple
+
+from nnunetv2.experiment_planning.experiment_planners.default_experiment_planner import ExperimentPlanner
+from nnunetv2.preprocessing.resampling.fast_resampling import fast_resample_data_or_seg_to_shape
+from nnunetv2.utilities.find_class_by_name import register_class
+
+
+@register_class
+class ExperimentPlannerFastResampling(ExperimentPlanner):
+    def __init__(self, dataset_name_or_id: Union[str, int],
+                 gpu_memory_target_in_gb: float = 8,
+                 preprocessor_name: str = 'DefaultPreprocessor', plans_name: str = 'nnUNetPlansFastResampling',
+                 overwrite_target_spacing: Union[List[float], Tuple[float, ...]] = None,
+                 suppress_transpose: bool = False):
+        """
+        Same as ExperimentPlanner but uses fast_resample_data_or_seg_to_shape (float32, batched, multithreaded) for
+        resampling data, segmentations and probabilities. Same interpolation orders, so the results are (almost)
+        identical. Speeds up preprocessing and export a lot, especially for anisotropic data.
+        """
+        super().__init__(dataset_name_or_id, gpu_memory_target_in_gb, preprocessor_name, plans_name,
+                         overwrite_target_spacing, suppress_transpose)
+
+    def determine_resampling(self, *args, **kwargs):
+        _, resampling_data_kwargs, _, resampling_seg_kwargs = super().determine_resampling(*args, **kwargs)
+        return fast_resample_data_or_seg_to_shape, resampling_data_kwargs, fast_resample_data_or_seg_to_shape, \
+            resampling_seg_kwargs
+
+    def determine_segmentation_softmax_export_fn(self, *args, **kwargs):
+        _, resampling_fn_kwargs = super().determine_segmentation_softmax_export_fn(*args, **kwargs)
+        return fast_resample_data_or_seg_to_shape, resampling_fn_kwargs
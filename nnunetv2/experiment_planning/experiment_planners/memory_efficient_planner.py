@@ -0,0 +1,23 @@
+from typing import Union, List, Tuple
+
+from nnunetv2.experiment_planning.experiment_planners.default_experiment_planner import ExperimentPlanner
+from nnunetv2.utilities.find_class_by_name import register_class
+
+
+@register_class
+class ExperimentPlannerMemoryEfficient(ExperimentPlanner):
+    def __init__(self, dataset_name_or_id: Union[str, int],
+                 gpu_memory_target_in_gb: float = 8,
+                 preprocessor_name: str = 'DefaultPreprocessor', plans_name: str = 'nnUNetPlansMemoryEfficient',
+                 overwrite_target_spacing: Union[List[float], Tuple[float, ...]] = None,
+                 suppress_transpose: bool = False):
+        """
+        Same as ExperimentPlanner but plans with gradient accumulation (2 micro batches) and activation checkpointing.
+        Use this to get the patch sizes of a larger GPU on a smaller one (-gpu_memory_target) or larger patches on
+        the same GPU. Training will be slower (one additional forward pass per iteration because of the
+        checkpointing, smaller and thus less efficient micro batches).
+        """
+        super().__init__(dataset_name_or_id, gpu_memory_target_in_gb, preprocessor_name, plans_name,
+                         overwrite_target_spacing, suppress_transpose)
+        self.UNet_gradient_accumulation_steps = 2
+        self.UNet_activation_checkpointing = True
@@ -4,8 +4,10 @@ from torch import nn
 
 from nnunetv2.experiment_planning.experiment_planners.default_experiment_planner import ExperimentPlanner
 from dynamic_network_architectures.architectures.unet import ResidualEncoderUNet
+from nnunetv2.utilities.find_class_by_name import register_class
 
 
+@register_class
 class ResEncUNetPlanner(ExperimentPlanner):
     def __init__(self, dataset_name_or_id: Union[str, int],
                  gpu_memory_target_in_gb: float = 8,
@@ -1,3 +1,4 @@
+import os
 import shutil
 from typing import List, Type, Optional, Tuple, Union
 
@@ -88,7 +89,7 @@ def preprocess_dataset(dataset_id: int,
                        plans_identifier: str = 'nnUNetPlans',
                        configurations: Union[Tuple[str], List[str]] = ('2d', '3d_fullres', '3d_lowres'),
                        num_processes: Union[int, Tuple[int, ...], List[int]] = (8, 4, 8),
-                       verbose: bool = False) -> None:
+                       verbose: bool = False, overwrite_existing: bool = False) -> None:
     if not isinstance(num_processes, list):
         num_processes = list(num_processes)
     if len(num_processes) == 1:
@@ -113,7 +114,7 @@ def preprocess_dataset(dataset_id: int,
             continue
         configuration_manager = plans_manager.get_configuration(c)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        preprocessor.run(dataset_id, c, plans_identifier, num_processes=n)
+        preprocessor.run(dataset_id, c, plans_identifier, num_processes=n, overwrite_existing=overwrite_existing)
 
     # copy the gt to a folder in the nnUNet_preprocessed so that we can do validation even if the raw data is no
     # longer there (useful for compute cluster where only the preprocessed data is available)
@@ -126,6 +127,11 @@ def preprocess_dataset(dataset_id: int,
         copy_file(dataset[k]['label'],
                   join(nnUNet_preprocessed, dataset_name, 'gt_segmentations', k + dataset_json['file_ending']),
                   update=True)
+    # cases that were removed from the dataset must not linger around here either
+    for f in subfiles(join(nnUNet_preprocessed, dataset_name, 'gt_segmentations'), suffix=dataset_json['file_ending'],
+                      join=False):
+        if f[:-len(dataset_json['file_ending'])] not in dataset.keys():
+            os.remove(join(nnUNet_preprocessed, dataset_name, 'gt_segmentations', f))
 
 
 
@@ -133,6 +139,6 @@ def preprocess(dataset_ids: List[int],
                plans_identifier: str = 'nnUNetPlans',
                configurations: Union[Tuple[str], List[str]] = ('2d', '3d_fullres', '3d_lowres'),
                num_processes: Union[int, Tuple[int, ...], List[int]] = (8, 4, 8),
-               verbose: bool = False):
+               verbose: bool = False, overwrite_existing: bool = False):
     for d in dataset_ids:
-        preprocess_dataset(d, plans_identifier, configurations, num_processes, verbose)
+        preprocess_dataset(d, plans_identifier, configurations, num_processes, verbose, overwrite_existing)
@@ -93,6 +93,10 @@ def preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progress bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--overwrite_preprocessed', required=False, default=False, action='store_true',
+                        help='[OPTIONAL] Preprocessing is incremental: only cases whose input files (or whose relevant '
+                             'plans entries) changed are preprocessed again. Set this flag to delete the existing '
+                             'preprocessed data and start from scratch.')
     args, unrecognized_args = parser.parse_known_args()
     if args.np is None:
         default_np = {
@@ -103,7 +107,8 @@ def preprocess_entry():
         np = {default_np[c] if c in default_np.keys() else 4 for c in args.c}
     else:
         np = args.np
-    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose)
+    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose,
+               overwrite_existing=args.overwrite_preprocessed)
 
 
 def plan_and_preprocess_entry():
@@ -175,6 +180,10 @@ def plan_and_preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progress bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--overwrite_preprocessed', required=False, default=False, action='store_true',
+                        help='[OPTIONAL] Preprocessing is incremental: only cases whose input files (or whose relevant '
+                             'plans entries) changed are preprocessed again. Set this flag to delete the existing '
+                             'preprocessed data and start from scratch.')
     args = parser.parse_args()
 
     # fingerprint extraction
@@ -194,7 +203,7 @@ def plan_and_preprocess_entry():
     # preprocessing
     if not args.no_pp:
         print('Preprocessing...')
-        preprocess(args.d, args.overwrite_plans_name, args.c, np, args.verbose)
+        preprocess(args.d, args.overwrite_plans_name, args.c, np, args.verbose, args.overwrite_preprocessed)
 
 
 if __name__ == '__main__':
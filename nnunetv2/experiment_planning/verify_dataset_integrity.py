@@ -30,8 +30,14 @@ from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folde
 
 
 def verify_labels(label_file: str, readerclass: Type[BaseReaderWriter], expected_labels: List[int]) -> bool:
+    """
+    This is the only place where the pixel data of the segmentations is read, so the NaN check happens here as well
+    """
     rw = readerclass()
     seg, properties = rw.read_seg(label_file)
+    if np.issubdtype(seg.dtype, np.floating) and np.any(np.isnan(seg)):
+        print(f'Segmentation contains NaN pixel values. You need to fix that.\nSegmentation:\n{label_file}')
+        return False
     found_labels = np.sort(pd.unique(seg.ravel()))  # np.unique(seg)
     unexpected_labels = [i for i in found_labels if i not in expected_labels]
     if len(found_labels) == 0 and found_labels[0] == 0:
@@ -46,24 +52,32 @@ def verify_labels(label_file: str, readerclass: Type[BaseReaderWriter], expected
 
 def check_cases(image_files: List[str], label_file: str, expected_num_channels: int,
                 readerclass: Type[BaseReaderWriter]) -> bool:
+    """
+    Geometry checks only need the headers. Pixel data of the images is only read if they can contain NaN (float
+    dtype). The segmentation is not read at all here (see verify_labels)
+    """
     rw = readerclass()
     ret = True
 
-    images, properties_image = rw.read_images(image_files)
-    segmentation, properties_seg = rw.read_seg(label_file)
+    headers_image = [rw.read_header(i) for i in image_files]
+    header_seg = rw.read_header(label_file, is_segmentation=True)
 
     # check for nans
-    if np.any(np.isnan(images)):
-        print(f'Images contain NaN pixel values. You need to fix that by '
-              f'replacing NaN values with something that makes sense for your images!\nImages:\n{image_files}')
-        ret = False
-    if np.any(np.isnan(segmentation)):
-        print(f'Segmentation contains NaN pixel values. You need to fix that.\nSegmentation:\n{label_file}')
-        ret = False
+    if any(np.issubdtype(h['dtype'], np.floating) for h in headers_image):
+        images, _ = rw.read_images(image_files)
+        if np.any(np.isnan(images)):
+            print(f'Images contain NaN pixel values. You need to fix that by '
+                  f'replacing NaN values with something that makes sense for your images!\nImages:\n{image_files}')
+            ret = False
 
     # check shapes
-    shape_image = images.shape[1:]
-    shape_seg = segmentation.shape[1:]
+    shapes_image = [tuple(h['shape'][1:]) for h in headers_image]
+    if not all(i == shapes_image[0] for i in shapes_image):
+        print('Error: Not all images of a case have the same shape. \nShapes images: %s. \nImage files: %s.\n' %
+              (shapes_image, image_files))
+        ret = False
+    shape_image = shapes_image[0]
+    shape_seg = tuple(header_seg['shape'][1:])
     if shape_image != shape_seg:
         print('Error: Shape mismatch between segmentation and corresponding images. \nShape images: %s. '
               '\nShape seg: %s. \nImage files: %s. \nSeg file: %s\n' %
@@ -71,47 +85,37 @@ def check_cases(image_files: List[str], label_file: str, expected_num_channels:
         ret = False
 
     # check spacings
-    spacing_images = properties_image['spacing']
-    spacing_seg = properties_seg['spacing']
+    spacing_images = headers_image[0]['spacing']
+    spacing_seg = header_seg['spacing']
     if not np.allclose(spacing_seg, spacing_images):
         print('Error: Spacing mismatch between segmentation and corresponding images. \nSpacing images: %s. '
               '\nSpacing seg: %s. \nImage files: %s. \nSeg file: %s\n' %
-              (shape_image, shape_seg, image_files, label_file))
+              (spacing_images, spacing_seg, image_files, label_file))
         ret = False
 
     # check modalities
-    if not len(images) == expected_num_channels:
+    num_channels = sum(h['shape'][0] for h in headers_image)
+    if not num_channels == expected_num_channels:
         print('Error: Unexpected number of modalities. \nExpected: %d. \nGot: %d. \nImages: %s\n'
-              % (expected_num_channels, len(images), image_files))
+              % (expected_num_channels, num_channels, image_files))
         ret = False
 
-    # nibabel checks
-    if 'nibabel_stuff' in properties_image.keys():
-        # this image was read with NibabelIO
-        affine_image = properties_image['nibabel_stuff']['original_affine']
-        affine_seg = properties_seg['nibabel_stuff']['original_affine']
-        if not np.allclose(affine_image, affine_seg):
-            print('WARNING: Affine is not the same for image and seg! \nAffine image: %s \nAffine seg: %s\n'
-                  'Image files: %s. \nSeg file: %s.\nThis can be a problem but doesn\'t have to be. Please run '
-                  'nnUNet_plot_dataset_pngs to verify if everything is OK!\n'
-                  % (affine_image, affine_seg, image_files, label_file))
-
-    # sitk checks
-    if 'sitk_stuff' in properties_image.keys():
-        # this image was read with SimpleITKIO
-        # spacing has already been checked, only check direction and origin
-        origin_image = properties_image['sitk_stuff']['origin']
-        origin_seg = properties_seg['sitk_stuff']['origin']
-        if not np.allclose(origin_image, origin_seg):
-            print('Warning: Origin mismatch between segmentation and corresponding images. \nOrigin images: %s. '
-                  '\nOrigin seg: %s. \nImage files: %s. \nSeg file: %s\n' %
-                  (origin_image, origin_seg, image_files, label_file))
-        direction_image = properties_image['sitk_stuff']['direction']
-        direction_seg = properties_seg['sitk_stuff']['direction']
-        if not np.allclose(direction_image, direction_seg):
-            print('Warning: Direction mismatch between segmentation and corresponding images. \nDirection images: %s. '
-                  '\nDirection seg: %s. \nImage files: %s. \nSeg file: %s\n' %
-                  (direction_image, direction_seg, image_files, label_file))
+    # geometry checks. Only for formats that have an origin/direction (SimpleITKIO, NibabelIO). For nibabel these
+    # come from the affine, so together with the spacing this is the same as comparing the affines
+    origin_image = headers_image[0]['origin']
+    origin_seg = header_seg['origin']
+    if origin_image is not None and origin_seg is not None and not np.allclose(origin_image, origin_seg):
+        print('Warning: Origin mismatch between segmentation and corresponding images. \nOrigin images: %s. '
+              '\nOrigin seg: %s. \nImage files: %s. \nSeg file: %s\nThis can be a problem but doesn\'t have to be. '
+              'Please run nnUNet_plot_dataset_pngs to verify if everything is OK!\n' %
+              (origin_image, origin_seg, image_files, label_file))
+    direction_image = headers_image[0]['direction']
+    direction_seg = header_seg['direction']
+    if direction_image is not None and direction_seg is not None and not np.allclose(direction_image, direction_seg):
+        print('Warning: Direction mismatch between segmentation and corresponding images. \nDirection images: %s. '
+              '\nDirection seg: %s. \nImage files: %s. \nSeg file: %s\nThis can be a problem but doesn\'t have to '
+              'be. Please run nnUNet_plot_dataset_pngs to verify if everything is OK!\n' %
+              (direction_image, direction_seg, image_files, label_file))
 
     return ret
 
@@ -19,6 +19,24 @@ import numpy as np
 
 
 class BaseReaderWriter(ABC):
+    def __init__(self, native_dtype: bool = False, num_compression_threads: int = 1):
+        """
+        By default read_images/read_seg return float32 arrays. With native_dtype=True they return the data type that
+        is stored in the file instead (int16 for most CT images, uint8 for EM or segmentations, ...). That is 2-4x less
+        memory. Only use this if whatever consumes the arrays can deal with that (preprocessing can)
+
+        num_compression_threads: how many threads write_seg may use for compressing the output (if the format is
+        compressed and the reader/writer supports it, for example .nii.gz in SimpleITKIO and NibabelIO)
+        """
+        self.native_dtype = native_dtype
+        self.num_compression_threads = num_compression_threads
+
+    def _to_output_dtype(self, data: np.ndarray) -> np.ndarray:
+        """
+        use this to convert the arrays returned by read_images and read_seg. Respects native_dtype
+        """
+        return data if self.native_dtype else data.astype(np.float32, copy=False)
+
     @staticmethod
     def _check_all_same(input_list):
         # compare all entries to the first
@@ -85,6 +103,34 @@ class BaseReaderWriter(ABC):
         """
         pass
 
+    def read_header(self, fname: str, is_segmentation: bool = False) -> dict:
+        """
+        Returns the meta information of a single image (or segmentation if is_segmentation) file WITHOUT reading the
+        pixel data (if the file format allows it). Use this wherever you only need shape, spacing or geometry, for
+        example to check a dataset or to sort cases by size.
+
+        The returned dict has the following keys:
+        - 'shape': the shape read_images((fname,)) (or read_seg(fname)) would return, so (c, x, y, z)
+        - 'spacing': same as the 'spacing' read_images puts into its properties (nnU-Net axis order)
+        - 'origin': origin of the image in world coordinates or None if the format doesn't have one
+        - 'direction': direction cosines (flattened) or None if the format doesn't have them
+        - 'dtype': np.dtype of the pixel data as stored in the file
+
+        This default implementation reads the entire image, so it is slow and reports float32 as dtype. Please
+        override it in your reader/writer!
+        """
+        if is_segmentation:
+            image, properties = self.read_seg(fname)
+        else:
+            image, properties = self.read_images((fname, ))
+        return {
+            'shape': image.shape,
+            'spacing': properties['spacing'],
+            'origin': None,
+            'direction': None,
+            'dtype': image.dtype
+        }
+
     @abstractmethod
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         """
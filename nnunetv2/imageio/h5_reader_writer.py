@@ -0,0 +1,231 @@
+#    Copyright 2021 HIP Applied Computer Vision Lab, Division of Medical Image Computing, German Cancer Research Center
+#    (DKFZ), Heidelberg, Germany
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from typing import Tuple, Union, List
+
+import numpy as np
+
+from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from nnunetv2.utilities.find_class_by_name import register_class
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class LazyH5Volume(object):
+    """
+    Array-like view of one or more 3d HDF5 datasets (one per channel), so shape is (c, x, y, z) just like the arrays
+    returned by read_images. Nothing is read until you slice it (or convert it with np.asarray) and then only the
+    requested region of the requested channels is read. Supports what h5py supports per axis (integers and slices with
+    positive step) plus Ellipsis and index tuples shorter than ndim. Values are returned in the dtype of the file.
+
+    Only stores file names and dataset keys, the files are opened for each read. That makes it picklable, so it can be
+    handed to worker processes.
+    """
+    def __init__(self, filenames: Union[List[str], Tuple[str, ...]], dataset_keys: Union[List[str], Tuple[str, ...]]):
+        assert len(filenames) == len(dataset_keys)
+        self.filenames = list(filenames)
+        self.dataset_keys = list(dataset_keys)
+        with h5py.File(self.filenames[0], 'r') as f:
+            ds = f[self.dataset_keys[0]]
+            self.shape = (len(self.filenames), *ds.shape)
+            self.dtype = ds.dtype
+            self.chunks = ds.chunks
+        self.ndim = len(self.shape)
+
+    def _expand_index(self, item) -> tuple:
+        if not isinstance(item, tuple):
+            item = (item, )
+        ellipsis_positions = [i for i, j in enumerate(item) if j is Ellipsis]
+        if len(ellipsis_positions) > 1:
+            raise IndexError('an index can only have a single ellipsis (\'...\')')
+        if any(i is None for i in item):
+            raise IndexError('LazyH5Volume does not support np.newaxis')
+        if len(ellipsis_positions) == 1:
+            e = ellipsis_positions[0]
+            item = item[:e] + (slice(None), ) * (self.ndim - len(item) + 1) + item[e + 1:]
+        if len(item) > self.ndim:
+            raise IndexError(f'too many indices: LazyH5Volume is {self.ndim}-dimensional, but {len(item)} were indexed')
+        return item + (slice(None), ) * (self.ndim - len(item))
+
+    def __getitem__(self, item) -> np.ndarray:
+        item = self._expand_index(item)
+        # first axis is the channel axis which doesn't exist in the files
+        channel_item, spatial_item = item[0], item[1:]
+        channels = np.arange(self.shape[0])[channel_item]
+        data = []
+        # an empty channel selection still needs the shape of the spatial selection
+        for c in (np.atleast_1d(channels) if np.size(channels) > 0 else [0]):
+            with h5py.File(self.filenames[c], 'r') as f:
+                data.append(f[self.dataset_keys[c]][spatial_item])
+        if np.ndim(channels) == 0:
+            return data[0]
+        return np.stack(data)[:np.size(channels)]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def __len__(self):
+        return self.shape[0]
+
+
+@register_class
+class H5IO(BaseReaderWriter):
+    """
+    Reads and writes 3d volumes stored in HDF5 files (for example the CREMI challenge files, FAFB crops). Requires
+    h5py (pip install h5py).
+
+    Each file can contain several datasets. Images are read from the first of image_dataset_keys that exists in the
+    file, segmentations from the first of seg_dataset_keys. So image and label file can even be the same file (a
+    symlink in imagesTr and one in labelsTr). Segmentations must contain nnU-Net labels (0, 1, 2, ...), so raw CREMI
+    cleft ids need to be converted first (see dataset_conversion/Dataset061_CREMI.py).
+
+    The spacing is read from the 'spacing' or 'resolution' (CREMI) attribute of the dataset, in the axis order of
+    the array (so (40, 4, 4) for CREMI). (1, 1, 1) if there is none.
+
+    read_images_lazy and read_seg_lazy return a LazyH5Volume instead of a numpy array. It can be sliced like an
+    array and only reads what is requested. nnU-Net's preprocessing needs the entire image, but evaluation
+    (compute_metrics in evaluation/evaluate_predictions.py) uses them to process the volumes in slabs, so reference
+    and prediction never have to fit into RAM.
+
+    Predictions are written as chunked, gzip compressed HDF5 files (dataset key written_seg_dataset_key) with the
+    spacing as attribute.
+    """
+    supported_file_endings = [
+        '.h5',
+        '.hdf',
+        '.hdf5'
+    ]
+
+    image_dataset_keys = ('volumes/raw', 'raw', 'data', 'image')
+    seg_dataset_keys = ('volumes/labels/clefts', 'volumes/labels/segmentation', 'seg', 'label', 'labels')
+    written_seg_dataset_key = 'seg'
+    # chunks of the written segmentations. Clipped to the shape of the segmentation
+    write_chunk_size = (64, 64, 64)
+    write_compression_level = 4
+
+    def __init__(self, native_dtype: bool = False, num_compression_threads: int = 1):
+        assert h5py is not None, "H5IO requires h5py. Install with 'pip install h5py'"
+        super().__init__(native_dtype, num_compression_threads)
+
+    @staticmethod
+    def _find_dataset_key(f, candidates: Tuple[str, ...], fname: str) -> str:
+        for k in candidates:
+            if k in f:
+                return k
+        raise RuntimeError(f'None of the expected datasets {candidates} was found in file {fname}')
+
+    @staticmethod
+    def _get_spacing(ds) -> Tuple[float, ...]:
+        for k in ('spacing', 'resolution'):
+            if k in ds.attrs.keys():
+                spacing = [float(i) for i in ds.attrs[k]]
+                assert len(spacing) == 3, f'spacing must have 3 entries, one for each dimension of the image. ' \
+                                          f'Dataset: {ds.name}'
+                return tuple(spacing)
+        return 1., 1., 1.
+
+    def _read(self, fnames: Union[List[str], Tuple[str, ...]], dataset_keys: Tuple[str, ...], lazy: bool = False):
+        images = []
+        spacings = []
+        keys = []
+        shapes = []
+        for f in fnames:
+            with h5py.File(f, 'r') as h5f:
+                k = self._find_dataset_key(h5f, dataset_keys, f)
+                ds = h5f[k]
+                if ds.ndim != 3:
+                    raise RuntimeError(f"Only 3D images are supported! File: {f}, dataset: {k}")
+                spacings.append(self._get_spacing(ds))
+                keys.append(k)
+                shapes.append((1, *ds.shape))
+                if not lazy:
+                    images.append(ds[()][None])
+
+        if not self._check_all_same(shapes):
+            print('ERROR! Not all input images have the same shape!')
+            print('Shapes:')
+            print(shapes)
+            print('Image files:')
+            print(fnames)
+            raise RuntimeError()
+        if not self._check_all_same(spacings):
+            print('ERROR! Not all input images have the same spacing!')
+            print('Spacings:')
+            print(spacings)
+            print('Image files:')
+            print(fnames)
+            raise RuntimeError()
+
+        properties = {
+            'h5_stuff': {
+                'dataset_keys': keys,
+            },
+            'spacing': list(spacings[0])
+        }
+        if lazy:
+            return LazyH5Volume(fnames, keys), properties
+        return self._to_output_dtype(np.vstack(images)), properties
+
+    def read_images(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> Tuple[np.ndarray, dict]:
+        return self._read(image_fnames, self.image_dataset_keys)
+
+    def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
+        return self._read((seg_fname, ), self.seg_dataset_keys)
+
+    def read_images_lazy(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> Tuple[LazyH5Volume, dict]:
+        return self._read(image_fnames, self.image_dataset_keys, lazy=True)
+
+    def read_seg_lazy(self, seg_fname: str) -> Tuple[LazyH5Volume, dict]:
+        return self._read((seg_fname, ), self.seg_dataset_keys, lazy=True)
+
+    def read_header(self, fname: str, is_segmentation: bool = False) -> dict:
+        with h5py.File(fname, 'r') as f:
+            k = self._find_dataset_key(f, self.seg_dataset_keys if is_segmentation else self.image_dataset_keys,
+                                       fname)
+            ds = f[k]
+            return {
+                'shape': (1, *ds.shape),
+                'spacing': list(self._get_spacing(ds)),
+                'origin': None,
+                'direction': None,
+                'dtype': ds.dtype
+            }
+
+    def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
+        assert seg.ndim == 3, 'segmentation must be 3d'
+        chunks = tuple(min(c, s) for c, s in zip(self.write_chunk_size, seg.shape))
+        with h5py.File(output_fname, 'w') as f:
+            ds = f.create_dataset(self.written_seg_dataset_key, data=seg.astype(np.uint8, copy=False), chunks=chunks,
+                                  compression='gzip', compression_opts=self.write_compression_level)
+            ds.attrs['spacing'] = [float(i) for i in properties['spacing']]
+            # CREMI convention
+            ds.attrs['resolution'] = [float(i) for i in properties['spacing']]
+
+
+if __name__ == '__main__':
+    # CREMI files contain image and labels. Just symlink them into imagesTr (sample_a_0000.hdf) and labelsTr
+    # (sample_a.hdf)
+    h5io = H5IO()
+    img, props = h5io.read_images(('/media/ps/passport2/ltc/CREMI/sample_A_20160501.hdf', ))
+    lazy_img, _ = h5io.read_images_lazy(('/media/ps/passport2/ltc/CREMI/sample_A_20160501.hdf', ))
+    assert lazy_img.shape == img.shape
+    assert np.all(lazy_img[:, 10:20, 100:200, 50:60] == img[:, 10:20, 100:200, 50:60])
+    assert np.all(lazy_img[0, 5] == img[0, 5])
+    assert np.all(lazy_img[..., 7] == img[..., 7])
+    h5io.write_seg((img[0] > 128).astype(np.uint8), '/tmp/seg_h5io.h5', props)
@@ -16,9 +16,12 @@
 from typing import Tuple, Union, List
 import numpy as np
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from PIL import Image
 from skimage import io
+from nnunetv2.utilities.find_class_by_name import register_class
 
 
+@register_class
 class NaturalImage2DIO(BaseReaderWriter):
     """
     ONLY SUPPORTS 2D IMAGES!!!
@@ -33,6 +36,17 @@ class NaturalImage2DIO(BaseReaderWriter):
         '.tif'
     ]
 
+    # PIL mode -> (number of channels, dtype) as returned by skimage.io.imread
+    _pil_modes = {
+        '1': (1, bool),
+        'L': (1, np.uint8),
+        'RGB': (3, np.uint8),
+        'RGBA': (4, np.uint8),
+        'I;16': (1, np.uint16),
+        'I': (1, np.int32),
+        'F': (1, np.float32),
+    }
+
     def read_images(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> Tuple[np.ndarray, dict]:
         images = []
         for f in image_fnames:
@@ -56,11 +70,27 @@ class NaturalImage2DIO(BaseReaderWriter):
             print('Image files:')
             print(image_fnames)
             raise RuntimeError()
-        return np.vstack(images).astype(np.float32), {'spacing': (999, 1, 1)}
+        return self._to_output_dtype(np.vstack(images)), {'spacing': (999, 1, 1)}
 
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
+    def read_header(self, fname: str, is_segmentation: bool = False) -> dict:
+        # PIL only parses the header when opening an image. Pixel data is read lazily
+        with Image.open(fname) as img:
+            mode, (width, height) = img.mode, img.size
+        if mode not in self._pil_modes:
+            # palette images and other exotic stuff. Let skimage figure it out
+            return super().read_header(fname, is_segmentation)
+        num_channels, dtype = self._pil_modes[mode]
+        return {
+            'shape': (num_channels, 1, height, width),
+            'spacing': (999, 1, 1),
+            'origin': None,
+            'direction': None,
+            'dtype': np.dtype(dtype)
+        }
+
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         io.imsave(output_fname, seg[0].astype(np.uint8), check_contrast=False)
 
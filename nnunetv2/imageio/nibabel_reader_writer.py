@@ -16,11 +16,45 @@
 from typing import Tuple, Union, List
 import numpy as np
 from nibabel import io_orientation
+from nibabel.orientations import inv_ornt_aff
 
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 import nibabel
+from nnunetv2.utilities.find_class_by_name import register_class
+from nnunetv2.utilities.output_encoding import gzip_compress_parallel
 
 
+def _save(nib_image, output_fname: str, num_compression_threads: int) -> None:
+    if num_compression_threads > 1 and output_fname.endswith('.nii.gz'):
+        # nibabel compresses single threaded. Serialize uncompressed and gzip in parallel blocks instead
+        with open(output_fname, 'wb') as f:
+            f.write(gzip_compress_parallel(nib_image.to_bytes(), num_compression_threads))
+    else:
+        nibabel.save(nib_image, output_fname)
+
+
+def _get_stored_dtype(nib_image) -> np.dtype:
+    # get_fdata applies scl_slope/scl_inter. If they are set the values are no longer what is stored in the file
+    slope, inter = nib_image.dataobj.slope, nib_image.dataobj.inter
+    if (slope is not None and slope != 1) or (inter is not None and inter != 0):
+        return np.dtype(np.float32)
+    return nib_image.get_data_dtype()
+
+
+def _header_from_affine(shape, zooms, affine: np.ndarray, dtype: np.dtype) -> dict:
+    """
+    shape and zooms in nibabel axis order. Converted to sitk axis order just like read_images does
+    """
+    return {
+        'shape': (1, *[int(i) for i in shape[::-1]]),
+        'spacing': [float(i) for i in zooms[::-1]],
+        'origin': tuple(float(i) for i in affine[:3, 3]),
+        'direction': tuple(float(i) for i in (affine[:3, :3] / np.array(zooms, dtype=float)[None]).ravel()),
+        'dtype': dtype
+    }
+
+
+@register_class
 class NibabelIO(BaseReaderWriter):
     """
     Nibabel loads the images in a different order than sitk. We convert the axes to the sitk order to be
@@ -52,7 +86,9 @@ class NibabelIO(BaseReaderWriter):
             )
 
             # transpose image to be consistent with the way SimpleITk reads images. Yeah. Annoying.
-            images.append(nib_image.get_fdata().transpose((2, 1, 0))[None])
+            # get_fdata always returns float64, the dataobj has the dtype stored in the file (scaling is applied)
+            npy_image = np.asanyarray(nib_image.dataobj) if self.native_dtype else nib_image.get_fdata()
+            images.append(npy_image.transpose((2, 1, 0))[None])
 
         if not self._check_all_same([i.shape for i in images]):
             print('ERROR! Not all input images have the same shape!')
@@ -85,18 +121,26 @@ class NibabelIO(BaseReaderWriter):
             },
             'spacing': spacings_for_nnunet[0]
         }
-        return stacked_images.astype(np.float32), dict
+        return self._to_output_dtype(stacked_images), dict
 
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
+    def read_header(self, fname: str, is_segmentation: bool = False) -> dict:
+        # nibabel.load is lazy, the pixel data is only read once we ask for it
+        nib_image = nibabel.load(fname)
+        assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
+        return _header_from_affine(nib_image.shape, nib_image.header.get_zooms(), nib_image.affine,
+                                   _get_stored_dtype(nib_image))
+
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         # revert transpose
         seg = seg.transpose((2, 1, 0)).astype(np.uint8)
         seg_nib = nibabel.Nifti1Image(seg, affine=properties['nibabel_stuff']['original_affine'])
-        nibabel.save(seg_nib, output_fname)
+        _save(seg_nib, output_fname, self.num_compression_threads)
 
 
+@register_class
 class NibabelIOWithReorient(BaseReaderWriter):
     """
     Reorients images to RAS
@@ -134,7 +178,9 @@ class NibabelIOWithReorient(BaseReaderWriter):
             )
 
             # transpose image to be consistent with the way SimpleITk reads images. Yeah. Annoying.
-            images.append(reoriented_image.get_fdata().transpose((2, 1, 0))[None])
+            # get_fdata always returns float64, the dataobj has the dtype stored in the file (scaling is applied)
+            npy_image = np.asanyarray(reoriented_image.dataobj) if self.native_dtype else reoriented_image.get_fdata()
+            images.append(npy_image.transpose((2, 1, 0))[None])
 
         if not self._check_all_same([i.shape for i in images]):
             print('ERROR! Not all input images have the same shape!')
@@ -168,11 +214,24 @@ class NibabelIOWithReorient(BaseReaderWriter):
             },
             'spacing': spacings_for_nnunet[0]
         }
-        return stacked_images.astype(np.float32), dict
+        return self._to_output_dtype(stacked_images), dict
 
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
+    def read_header(self, fname: str, is_segmentation: bool = False) -> dict:
+        nib_image = nibabel.load(fname)
+        assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
+        # as_reoriented would load the pixel data, so we compute what it would do to shape, zooms and affine
+        ornt = io_orientation(nib_image.affine)
+        shape = [0] * 3
+        zooms = [0.] * 3
+        for i in range(3):
+            shape[int(ornt[i, 0])] = nib_image.shape[i]
+            zooms[int(ornt[i, 0])] = nib_image.header.get_zooms()[i]
+        reoriented_affine = nib_image.affine.dot(inv_ornt_aff(ornt, nib_image.shape))
+        return _header_from_affine(shape, zooms, reoriented_affine, _get_stored_dtype(nib_image))
+
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         # revert transpose
         seg = seg.transpose((2, 1, 0)).astype(np.uint8)
@@ -181,7 +240,7 @@ class NibabelIOWithReorient(BaseReaderWriter):
         seg_nib_reoriented = seg_nib.as_reoriented(io_orientation(properties['nibabel_stuff']['original_affine']))
         assert np.allclose(properties['nibabel_stuff']['original_affine'], seg_nib_reoriented.affine), \
             'restored affine does not match original affine'
-        nibabel.save(seg_nib_reoriented, output_fname)
+        _save(seg_nib_reoriented, output_fname, self.num_compression_threads)
 
 
 if __name__ == '__main__':
@@ -8,6 +8,7 @@ from nnunetv2.imageio.natural_image_reager_writer import NaturalImage2DIO
 from nnunetv2.imageio.nibabel_reader_writer import NibabelIO, NibabelIOWithReorient
 from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
 from nnunetv2.imageio.tif_reader_writer import Tiff3DIO
+from nnunetv2.imageio.h5_reader_writer import H5IO
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 
@@ -16,7 +17,8 @@ LIST_OF_IO_CLASSES = [
     SimpleITKIO,
     Tiff3DIO,
     NibabelIO,
-    NibabelIOWithReorient
+    NibabelIOWithReorient,
+    H5IO
 ]
 
 
@@ -17,8 +17,11 @@ from typing import Tuple, Union, List
 import numpy as np
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 import SimpleITK as sitk
+from nnunetv2.utilities.find_class_by_name import register_class
+from nnunetv2.utilities.output_encoding import gzip_file_parallel
 
 
+@register_class
 class SimpleITKIO(BaseReaderWriter):
     supported_file_endings = [
         '.nii.gz',
@@ -109,11 +112,42 @@ class SimpleITKIO(BaseReaderWriter):
             # are returned x,y,z but spacing is returned z,y,x. Duh.
             'spacing': spacings_for_nnunet[0]
         }
-        return stacked_images.astype(np.float32), dict
+        return self._to_output_dtype(stacked_images), dict
 
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
+    def read_header(self, fname: str, is_segmentation: bool = False) -> dict:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(fname)
+        # only reads the header, not the pixel data
+        reader.ReadImageInformation()
+        spacing = reader.GetSpacing()
+        # shape in numpy axis order, same as sitk.GetArrayFromImage
+        shape = tuple(reader.GetSize()[::-1])
+        if reader.GetNumberOfComponents() > 1:
+            shape = shape + (reader.GetNumberOfComponents(), )
+        if len(shape) == 2:
+            shape = (1, 1, *shape)
+            spacing_for_nnunet = (max(spacing) * 999, *list(spacing)[::-1])
+        elif len(shape) == 3:
+            shape = (1, *shape)
+            spacing_for_nnunet = list(spacing)[::-1]
+        elif len(shape) == 4:
+            spacing_for_nnunet = list(spacing)[::-1][1:]
+        else:
+            raise RuntimeError(f"Unexpected number of dimensions: {len(shape)} in file {fname}")
+        # cheapest way to map the sitk pixel type to numpy is a dummy image
+        dtype = sitk.GetArrayViewFromImage(sitk.Image([1] * reader.GetDimension(), reader.GetPixelID(),
+                                                      reader.GetNumberOfComponents())).dtype
+        return {
+            'shape': shape,
+            'spacing': list(np.abs(spacing_for_nnunet)),
+            'origin': reader.GetOrigin(),
+            'direction': reader.GetDirection(),
+            'dtype': dtype
+        }
+
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         assert seg.ndim == 3, 'segmentation must be 3d. If you are exporting a 2d segmentation, please provide it as shape 1,x,y'
         output_dimension = len(properties['sitk_stuff']['spacing'])
@@ -126,4 +160,10 @@ class SimpleITKIO(BaseReaderWriter):
         itk_image.SetOrigin(properties['sitk_stuff']['origin'])
         itk_image.SetDirection(properties['sitk_stuff']['direction'])
 
-        sitk.WriteImage(itk_image, output_fname, True)
+        if self.num_compression_threads > 1 and output_fname.endswith('.nii.gz'):
+            # sitk compresses single threaded. Write uncompressed and gzip in parallel blocks instead
+            tmp_fname = output_fname[:-len('.nii.gz')] + '.tmp.nii'
+            sitk.WriteImage(itk_image, tmp_fname, False)
+            gzip_file_parallel(tmp_fname, output_fname, self.num_compression_threads)
+        else:
+            sitk.WriteImage(itk_image, output_fname, True)
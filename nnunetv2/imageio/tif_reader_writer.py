@@ -18,8 +18,10 @@ import numpy as np
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 import tifffile
 from batchgenerators.utilities.file_and_folder_operations import isfile, load_json, save_json, split_path, join
+from nnunetv2.utilities.find_class_by_name import register_class
 
 
+@register_class
 class Tiff3DIO(BaseReaderWriter):
     """
     reads and writes 3D tif(f) images. Uses tifffile package. Ignores metadata (for now)!
@@ -66,7 +68,7 @@ class Tiff3DIO(BaseReaderWriter):
             print(image_fnames)
             raise RuntimeError()
 
-        return np.vstack(images).astype(np.float32), {'spacing': spacing}
+        return self._to_output_dtype(np.vstack(images)), {'spacing': spacing}
 
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         # not ideal but I really have no clue how to set spacing/resolution information properly in tif files haha
@@ -97,4 +99,24 @@ class Tiff3DIO(BaseReaderWriter):
             print(f'WARNING no spacing file found for segmentation {seg_fname}\nAssuming spacing (1, 1, 1).')
             spacing = (1, 1, 1)
 
-        return seg.astype(np.float32), {'spacing': spacing}
\ No newline at end of file
+        return self._to_output_dtype(seg), {'spacing': spacing}
+
+    def read_header(self, fname: str, is_segmentation: bool = False) -> dict:
+        ending = '.' + fname.split('.')[-1]
+        assert ending.lower() in self.supported_file_endings, f'Ending {ending} not supported by {self.__class__.__name__}'
+        # only parses the tiff tags, pixel data is not read
+        with tifffile.TiffFile(fname) as tif:
+            series = tif.series[0]
+            shape, dtype = tuple(series.shape), series.dtype
+        if len(shape) != 3:
+            raise RuntimeError(f"Only 3D images are supported! File: {fname}")
+
+        # same aux file logic as in read_images/read_seg. Images have the channel identifier, segmentations don't
+        expected_aux_file = fname[:-len(ending)] + '.json' if is_segmentation else \
+            fname[:-(len(ending) + 5)] + '.json'
+        if isfile(expected_aux_file):
+            spacing = load_json(expected_aux_file)['spacing']
+            assert len(spacing) == 3, f'spacing must have 3 entries, one for each dimension of the image. File: {expected_aux_file}'
+        else:
+            spacing = (1, 1, 1)
+        return {'shape': (1, *shape), 'spacing': spacing, 'origin': None, 'direction': None, 'dtype': dtype}
\ No newline at end of file
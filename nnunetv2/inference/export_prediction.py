@@ -4,13 +4,14 @@ from typing import Union, List
 
 import numpy as np
 import torch
-import json
 from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
-from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
+from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle, save_json, join
 
 from nnunetv2.configuration import default_num_processes
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
+from nnunetv2.utilities.output_encoding import save_probabilities as save_probabilities_to_file
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.results_store import append_result, load_results, store_lock
 
 
 def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
@@ -74,7 +75,13 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
                                   save_probabilities: bool = False,
-                                  prediction_time: float = 0.0):
+                                  prediction_time: float = 0.0,
+                                  probabilities_format: str = 'npz',
+                                  num_compression_threads: int = 1):
+    """
+    probabilities_format: see nnunetv2.utilities.output_encoding. num_compression_threads is used for compressing
+    probabilities and segmentation
+    """
     # if isinstance(predicted_array_or_file, str):
     #     tmp = deepcopy(predicted_array_or_file)
     #     if predicted_array_or_file.endswith('.npy'):
@@ -96,32 +103,45 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
     # save
     if save_probabilities:
         segmentation_final, probabilities_final = ret
-        np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final.astype(np.float16))
+        save_probabilities_to_file(probabilities_final, output_file_truncated, probabilities_format,
+                                   num_compression_threads)
         save_pickle(properties_dict, output_file_truncated + '.pkl')
         del probabilities_final, ret
     else:
         segmentation_final = ret
         del ret
 
-    log_dir = os.path.join(os.path.dirname(output_file_truncated),'prediction_time.json')
-    if os.path.exists(log_dir):
-        with open(log_dir, 'r') as f:
-            time_log = json.load(f)
-    else:
-        time_log = {'detailed': {},
-                    'sum': 0.0}
-    
-    time_log['detailed'][output_file_truncated + dataset_json_dict_or_file['file_ending']] = prediction_time
-    time_log['sum'] = np.array([i for i in time_log['detailed'].values()]).sum()
-
-    with open(log_dir, 'w') as f:
-        json.dump(time_log, f, indent=4)
-            
-    rw = plans_manager.image_reader_writer_class()
+    # only append, the summary (prediction_time.json) is written by the parent process (write_prediction_time_summary)
+    append_result(join(os.path.dirname(output_file_truncated), 'prediction_time.jsonl'),
+                  output_file_truncated + dataset_json_dict_or_file['file_ending'], prediction_time)
+
+    rw = plans_manager.image_reader_writer_class(num_compression_threads=num_compression_threads)
     rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
                  properties_dict)
 
 
+def write_prediction_time_summary(output_folder: str) -> dict:
+    """
+    collects the prediction times appended by export_prediction_from_logits (prediction_time.jsonl) into
+    prediction_time.json ({'detailed': {file: seconds}, 'sum': total}). Entries of an existing prediction_time.json
+    (previous runs) are kept unless the case was predicted again.
+
+    Other processes (-num_parts, validation workers) may still be appending to prediction_time.jsonl, so the store
+    is only read. prediction_time.json is updated under the lock of the store and replaced atomically, so that
+    parts that finish at the same time don't overwrite each other
+    """
+    store_file = join(output_folder, 'prediction_time.jsonl')
+    summary_file = join(output_folder, 'prediction_time.json')
+    with store_lock(store_file):
+        detailed = load_json(summary_file)['detailed'] if isfile(summary_file) else {}
+        detailed.update(load_results(store_file))
+        time_log = {'detailed': detailed, 'sum': float(np.sum(list(detailed.values())))}
+        tmp_file = summary_file + f'.tmp{os.getpid()}'
+        save_json(time_log, tmp_file, sort_keys=False)
+        os.replace(tmp_file, summary_file)
+    return time_log
+
+
 def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
                       plans_manager: PlansManager, configuration_manager: ConfigurationManager, properties_dict: dict,
                       dataset_json_dict_or_file: Union[dict, str], num_threads_torch: int = default_num_processes) \
@@ -159,3 +179,26 @@ def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape:
         segmentation = segmentation.cpu().numpy()
     np.savez_compressed(output_file, seg=segmentation.astype(np.uint8))
     torch.set_num_threads(old_threads)
+
+
+def resample_and_save_for_next_stage(predicted: Union[torch.Tensor, np.ndarray], preprocessed_folder_next_stage: str,
+                                     identifier: str, output_file: str, plans_manager: PlansManager,
+                                     configuration_manager: ConfigurationManager, properties_dict: dict,
+                                     dataset_json_dict_or_file: Union[dict, str],
+                                     num_threads_torch: int = default_num_processes) -> None:
+    """
+    Same as resample_and_save but determines the target shape from the preprocessed data of the next stage. This is
+    meant to be run in a background worker so that reading the preprocessed data of the next stage does not block
+    the prediction of the following cases
+    """
+    from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+    try:
+        # we do this so that we can use load_case and do not have to hard code how loading training cases is implemented
+        tmp = nnUNetDataset(preprocessed_folder_next_stage, [identifier], num_images_properties_loading_threshold=0)
+        d, _, _ = tmp.load_case(identifier)
+    except FileNotFoundError:
+        print(f"Predicting next stage failed for case {identifier} because the preprocessed file is missing "
+              f"({preprocessed_folder_next_stage})! Run the preprocessing for this configuration first!")
+        return
+    resample_and_save(predicted, d.shape[1:], output_file, plans_manager, configuration_manager, properties_dict,
+                      dataset_json_dict_or_file, num_threads_torch)
@@ -24,7 +24,7 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
     preprocessing_iterator_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
-    convert_predicted_logits_to_segmentation_with_correct_shape
+    convert_predicted_logits_to_segmentation_with_correct_shape, write_prediction_time_summary
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
     compute_steps_for_sliding_window
 from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
@@ -32,6 +32,7 @@ from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.output_encoding import probability_file_ending, PROBABILITY_FORMATS
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
@@ -45,7 +46,18 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 tile_batch_size: int = 1,
+                 probabilities_format: str = 'npz',
+                 num_compression_threads: int = 1):
+        """
+        tile_batch_size > 1 makes the sliding window prediction run that many tiles at once through the network. This
+        uses the GPU much better, especially for small patch sizes, at the cost of more VRAM
+
+        probabilities_format: how probabilities are saved (if save_probabilities), see
+        nnunetv2.utilities.output_encoding. num_compression_threads is the number of threads each export worker uses
+        for compressing probabilities and segmentations (.nii.gz)
+        """
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -65,6 +77,11 @@ class nnUNetPredictor(object):
             perform_everything_on_gpu = False
         self.device = device
         self.perform_everything_on_gpu = perform_everything_on_gpu
+        self.tile_batch_size = tile_batch_size
+        # fail early on typos
+        probability_file_ending(probabilities_format)
+        self.probabilities_format = probabilities_format
+        self.num_compression_threads = num_compression_threads
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -236,7 +253,8 @@ class nnUNetPredictor(object):
         if not overwrite and output_filename_truncated is not None:
             tmp = [isfile(i + self.dataset_json['file_ending']) for i in output_filename_truncated]
             if save_probabilities:
-                tmp2 = [isfile(i + '.npz') for i in output_filename_truncated]
+                tmp2 = [isfile(i + probability_file_ending(self.probabilities_format)) for i in
+                        output_filename_truncated]
                 tmp = [i and j for i, j in zip(tmp, tmp2)]
             not_existing_indices = [i for i, j in enumerate(tmp) if not j]
 
@@ -400,6 +418,7 @@ class nnUNetPredictor(object):
             worker_list = [i for i in export_pool._pool]
             r = []
             total_predict_time = 0.0
+            output_folders = set()
             for preprocessed in data_iterator:
                 data = preprocessed['data']
                 if isinstance(data, str):
@@ -433,11 +452,13 @@ class nnUNetPredictor(object):
                     # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
                     #                               dataset_json, ofile, save_probabilities)
                     print('sending off prediction to background worker for resampling and export')
+                    output_folders.add(os.path.dirname(ofile))
                     r.append(
                         export_pool.starmap_async(
                             export_prediction_from_logits,
                             ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities, predict_time),)
+                              self.dataset_json, ofile, save_probabilities, predict_time,
+                              self.probabilities_format, self.num_compression_threads),)
                         )
                     )
                 else:
@@ -461,6 +482,10 @@ class nnUNetPredictor(object):
                     print(f'\nDone with image of shape {data.shape}:')
             ret = [i.get()[0] for i in r]
 
+        # the export workers only appended their prediction times
+        for output_folder in output_folders:
+            write_prediction_time_summary(output_folder)
+
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
 
@@ -494,7 +519,9 @@ class nnUNetPredictor(object):
         if output_file_truncated is not None:
             export_prediction_from_logits(predicted_logits, dct['data_properties'], self.configuration_manager,
                                           self.plans_manager, self.dataset_json, output_file_truncated,
-                                          save_or_return_probabilities)
+                                          save_or_return_probabilities, predict_time, self.probabilities_format,
+                                          self.num_compression_threads)
+            write_prediction_time_summary(os.path.dirname(output_file_truncated))
         else:
             ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
                                                                               self.configuration_manager,
@@ -634,6 +661,25 @@ class nnUNetPredictor(object):
             prediction /= num_predictons
         return prediction
 
+    def _internal_predict_tiles_batched(self, data: torch.Tensor, slicers: List[tuple], predicted_logits: torch.Tensor,
+                                        n_predictions: torch.Tensor, gaussian: Union[torch.Tensor, None],
+                                        results_device: torch.device) -> float:
+        """
+        Runs tile_batch_size tiles at once through the network and accumulates the predictions in place. Must be called
+        within no_grad (and autocast, if desired). Returns the time spent in the network
+        """
+        predict_time = 0
+        for b in tqdm(range(0, len(slicers), self.tile_batch_size), disable=not self.allow_tqdm):
+            batch_slicers = slicers[b:b + self.tile_batch_size]
+            workon = torch.stack([data[sl] for sl in batch_slicers]).to(self.device, non_blocking=False)
+            st = time.time()
+            prediction = self._internal_maybe_mirror_and_predict(workon).to(results_device)
+            predict_time += time.time() - st
+            for i, sl in enumerate(batch_slicers):
+                predicted_logits[sl] += (prediction[i] * gaussian if gaussian is not None else prediction[i])
+                n_predictions[sl[1:]] += (gaussian if gaussian is not None else 1)
+        return predict_time
+
     def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
             -> Union[np.ndarray, torch.Tensor]:
         assert isinstance(input_image, torch.Tensor)
@@ -694,6 +740,14 @@ class nnUNetPredictor(object):
                     empty_cache(self.device)
 
                 if self.verbose: print('running prediction')
+                if self.tile_batch_size > 1:
+                    predict_time = self._internal_predict_tiles_batched(data, slicers, predicted_logits, n_predictions,
+                                                                        gaussian if self.use_gaussian else None,
+                                                                        results_device)
+                    predicted_logits /= n_predictions
+                    empty_cache(self.device)
+                    return predict_time, predicted_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
+
                 predict_time = 0
                 workon = data[slicers[0]][None].to(self.device, non_blocking=False)
                 prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
@@ -758,6 +812,14 @@ def predict_entry_point_modelfolder():
                              'out-of-RAM issues. Default: 3')
     parser.add_argument('-prev_stage_predictions', type=str, required=False, default=None,
                         help='Folder containing the predictions of the previous stage. Required for cascaded models.')
+    parser.add_argument('-prob_format', type=str, required=False, default='npz',
+                        choices=list(PROBABILITY_FORMATS.keys()),
+                        help='Only relevant with --save_probabilities. How probabilities are stored. npz: compressed, '
+                             'single threaded (default). npy: uncompressed, fastest but large. blosc2: multithreaded '
+                             'zstd compression, requires blosc2 (pip install blosc2)')
+    parser.add_argument('-compression_threads', type=int, required=False, default=1,
+                        help='Number of threads each export process (-nps) uses for compressing probabilities '
+                             '(blosc2) and segmentations (.nii.gz). Default: 1')
     parser.add_argument('-device', type=str, default='cuda', required=False,
                         help="Use this to set the device the inference should run with. Available options are 'cuda' "
                              "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
@@ -796,7 +858,9 @@ def predict_entry_point_modelfolder():
                                 use_mirroring=not args.disable_tta,
                                 perform_everything_on_gpu=True,
                                 device=device,
-                                verbose=args.verbose)
+                                verbose=args.verbose,
+                                probabilities_format=args.prob_format,
+                                num_compression_threads=args.compression_threads)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predict_time, _ = predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
@@ -854,6 +918,14 @@ def predict_entry_point():
                              'out-of-RAM issues. Default: 3')
     parser.add_argument('-prev_stage_predictions', type=str, required=False, default=None,
                         help='Folder containing the predictions of the previous stage. Required for cascaded models.')
+    parser.add_argument('-prob_format', type=str, required=False, default='npz',
+                        choices=list(PROBABILITY_FORMATS.keys()),
+                        help='Only relevant with --save_probabilities. How probabilities are stored. npz: compressed, '
+                             'single threaded (default). npy: uncompressed, fastest but large. blosc2: multithreaded '
+                             'zstd compression, requires blosc2 (pip install blosc2)')
+    parser.add_argument('-compression_threads', type=int, required=False, default=1,
+                        help='Number of threads each export process (-nps) uses for compressing probabilities '
+                             '(blosc2) and segmentations (.nii.gz). Default: 1')
     parser.add_argument('-num_parts', type=int, required=False, default=1,
                         help='Number of separate nnUNetv2_predict call that you will be making. Default: 1 (= this one '
                              'call predicts everything)')
@@ -907,7 +979,9 @@ def predict_entry_point():
                                 perform_everything_on_gpu=True,
                                 device=device,
                                 verbose=args.verbose,
-                                verbose_preprocessing=False)
+                                verbose_preprocessing=False,
+                                probabilities_format=args.prob_format,
+                                num_compression_threads=args.compression_threads)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
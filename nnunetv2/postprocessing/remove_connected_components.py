@@ -5,13 +5,15 @@ from multiprocessing import Pool
 from typing import Union, Tuple, List, Callable
 
 import numpy as np
+from scipy import ndimage
 from acvl_utils.morphology.morphology_helper import remove_all_but_largest_component
 from batchgenerators.utilities.file_and_folder_operations import load_json, subfiles, maybe_mkdir_p, join, isfile, \
-    isdir, save_pickle, load_pickle, save_json
+    save_pickle, load_pickle, save_json
 from nnunetv2.configuration import default_num_processes
 from nnunetv2.evaluation.accumulate_cv_results import accumulate_cv_results
 from nnunetv2.evaluation.evaluate_predictions import region_or_label_to_mask, compute_metrics_on_folder, \
-    load_summary_json, label_or_region_to_key
+    load_summary_json, label_or_region_to_key, compute_confusion_matrix, metrics_from_confusion_matrix, \
+    summarize_results, save_summary_json
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.paths import nnUNet_raw
 from nnunetv2.utilities.file_path_utilities import folds_tuple_to_string
@@ -50,6 +52,105 @@ def load_postprocess_save(segmentation_file: str,
     image_reader_writer.write_seg(seg, output_fname, props)
 
 
+def collect_component_statistics(prediction_file: str,
+                                 reference_file: str,
+                                 image_reader_writer: BaseReaderWriter,
+                                 labels: List[int],
+                                 ignore_label: int = None) -> dict:
+    """
+    Everything determine_postprocessing needs to know about one case (label based datasets only), so that it never
+    has to look at the images again:
+
+    'confusion_matrix': of the prediction, see compute_confusion_matrix
+    'fg_component_sizes': sizes of the connected components of the foreground (all labels), index 0 is background
+    'components': {label: {'sizes', 'fg_component', 'ref_counts'}} for the connected components of each label.
+        fg_component is the foreground component that contains each component, ref_counts[c, i] is the number of
+        voxels of component c that have label i in the reference (ignored voxels are not counted)
+
+    Connected components use full connectivity, just like remove_all_but_largest_component
+    """
+    seg_pred = image_reader_writer.read_seg(prediction_file)[0][0]
+    seg_ref = image_reader_writer.read_seg(reference_file)[0][0]
+    confusion_matrix = compute_confusion_matrix(seg_ref, seg_pred, ignore_label)
+    num_classes = max(confusion_matrix.shape[0], max(labels) + 1)
+    structure = ndimage.generate_binary_structure(seg_pred.ndim, seg_pred.ndim)
+
+    fg_components, _ = ndimage.label(np.isin(seg_pred, labels), structure)
+    components = {}
+    for l in labels:
+        mask = seg_pred == l
+        label_components, num_components = ndimage.label(mask, structure)
+        ids = label_components[mask]
+        fg_component = np.zeros(num_components + 1, dtype=np.int64)
+        # a component of l can only ever be part of a single foreground component
+        fg_component[ids] = fg_components[mask]
+        ref_counts = np.bincount(ids * num_classes + seg_ref[mask].astype(np.intp),
+                                 minlength=(num_components + 1) * num_classes).reshape(-1, num_classes)
+        if ignore_label is not None and ignore_label < num_classes:
+            ref_counts[:, ignore_label] = 0
+        components[l] = {'sizes': np.bincount(ids, minlength=num_components + 1),
+                         'fg_component': fg_component,
+                         'ref_counts': ref_counts}
+    return {'confusion_matrix': _pad_confusion_matrix(confusion_matrix, num_classes),
+            'fg_component_sizes': np.bincount(fg_components.ravel()),
+            'components': components}
+
+
+def _pad_confusion_matrix(confusion_matrix: np.ndarray, num_classes: int) -> np.ndarray:
+    ret = np.zeros((num_classes, num_classes), dtype=confusion_matrix.dtype)
+    ret[:confusion_matrix.shape[0], :confusion_matrix.shape[1]] = confusion_matrix
+    return ret
+
+
+def _keep_largest(sizes: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """
+    which components survive remove_all_but_largest_component if only candidates are present. Ties are all kept.
+    Index 0 (background) is never kept
+    """
+    keep = np.zeros(len(sizes), dtype=bool)
+    candidates = candidates.copy()
+    candidates[0] = False
+    if np.any(candidates):
+        keep[candidates] = sizes[candidates] == sizes[candidates].max()
+    return keep
+
+
+def confusion_matrix_after_postprocessing(statistics: dict, keep_largest_fg: bool,
+                                          keep_largest_labels: List[int],
+                                          background_label: int = 0) -> np.ndarray:
+    """
+    Confusion matrix of a case (see collect_component_statistics) after removing all but the largest foreground
+    component (if keep_largest_fg) and then all but the largest component of each label in keep_largest_labels.
+    Removed voxels become background_label
+    """
+    confusion_matrix = statistics['confusion_matrix'].copy()
+    if keep_largest_fg:
+        fg_sizes = statistics['fg_component_sizes']
+        keep_fg = _keep_largest(fg_sizes, np.ones(len(fg_sizes), dtype=bool))
+    for l, c in statistics['components'].items():
+        alive = np.ones(len(c['sizes']), dtype=bool)
+        if keep_largest_fg:
+            alive = keep_fg[c['fg_component']]
+        if l in keep_largest_labels:
+            alive &= _keep_largest(c['sizes'], alive)
+        alive[0] = True
+        removed = c['ref_counts'][~alive].sum(0)
+        confusion_matrix[:, l] -= removed
+        confusion_matrix[:, background_label] += removed
+    return confusion_matrix
+
+
+def compute_confusion_matrix_after_postprocessing(prediction_file: str,
+                                                  reference_file: str,
+                                                  image_reader_writer: BaseReaderWriter,
+                                                  pp_fns: List[Callable],
+                                                  pp_fn_kwargs: List[dict],
+                                                  ignore_label: int = None) -> np.ndarray:
+    seg_pred = image_reader_writer.read_seg(prediction_file)[0][0]
+    seg_ref = image_reader_writer.read_seg(reference_file)[0][0]
+    return compute_confusion_matrix(seg_ref, apply_postprocessing(seg_pred, pp_fns, pp_fn_kwargs), ignore_label)
+
+
 def determine_postprocessing(folder_predictions: str,
                              folder_ref: str,
                              plans_file_or_dict: Union[str, dict],
@@ -60,9 +161,13 @@ def determine_postprocessing(folder_predictions: str,
     Determines nnUNet postprocessing. Its output is a postprocessing.pkl file in folder_predictions which can be
     used with apply_postprocessing_to_folder.
 
-    Postprocessed files are saved in folder_predictions/postprocessed. Set
-    keep_postprocessed_files=False to delete these files after this function is done (temp files will eb created
-    and deleted regardless).
+    Postprocessed files (only the final postprocessing) are saved in folder_predictions/postprocessed. Set
+    keep_postprocessed_files=False to not write them.
+
+    Candidates are evaluated in memory. For label based datasets each case is read and its connected components are
+    labeled once (collect_component_statistics) and all candidates are scored from these statistics. Regions can
+    overlap, so for region based datasets each candidate is applied to the predictions in memory and evaluated
+    right away (no temporary files).
 
     If plans_file_or_dict or dataset_json_file_or_dict are None, we will look for them in input_folder
     """
@@ -99,55 +204,74 @@ def determine_postprocessing(folder_predictions: str,
     if not all([i in predicted_files for i in ref_files]):
         print(f'WARNING: Not all files in folder_ref were found in folder_predictions. Determining postprocessing '
               f'should always be done on the entire dataset!')
-
-    # before we start we should evaluate the imaegs in the source folder
-    if not isfile(join(folder_predictions, 'summary.json')):
-        compute_metrics_on_folder(folder_ref,
-                                  folder_predictions,
-                                  join(folder_predictions, 'summary.json'),
-                                  rw,
-                                  dataset_json['file_ending'],
-                                  labels_or_regions,
-                                  label_manager.ignore_label,
-                                  num_processes)
-
-    # we save the postprocessing functions in here
-    pp_fns = []
-    pp_fn_kwargs = []
+    num_cases = len(predicted_files)
 
     # pool party!
     with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        if not label_manager.has_regions:
+            # one pass over the data. Everything else happens in here
+            statistics = pool.starmap(
+                collect_component_statistics,
+                zip(
+                    [join(folder_predictions, i) for i in predicted_files],
+                    [join(folder_ref, i) for i in predicted_files],
+                    [rw] * num_cases,
+                    [labels_or_regions] * num_cases,
+                    [label_manager.ignore_label] * num_cases
+                )
+            )
+            num_classes = max([s['confusion_matrix'].shape[0] for s in statistics])
+            for s in statistics:
+                s['confusion_matrix'] = _pad_confusion_matrix(s['confusion_matrix'], num_classes)
+                for c in s['components'].values():
+                    c['ref_counts'] = np.pad(c['ref_counts'], ((0, 0), (0, num_classes - c['ref_counts'].shape[1])))
+
+        def evaluate(pp_fns_here: List[Callable], pp_fn_kwargs_here: List[dict], prediction_folder: str) -> dict:
+            """summary (see summarize_results) of the predictions after applying pp_fns_here"""
+            if label_manager.has_regions:
+                confusion_matrices = pool.starmap(
+                    compute_confusion_matrix_after_postprocessing,
+                    zip(
+                        [join(folder_predictions, i) for i in predicted_files],
+                        [join(folder_ref, i) for i in predicted_files],
+                        [rw] * num_cases,
+                        [pp_fns_here] * num_cases,
+                        [pp_fn_kwargs_here] * num_cases,
+                        [label_manager.ignore_label] * num_cases
+                    )
+                )
+            else:
+                # the only postprocessing this function tries is all but largest component for all labels (foreground)
+                # followed by individual labels
+                keep_largest_fg = any([isinstance(k['labels_or_regions'], list) for k in pp_fn_kwargs_here])
+                keep_largest_labels = [k['labels_or_regions'] for k in pp_fn_kwargs_here
+                                       if not isinstance(k['labels_or_regions'], list)]
+                confusion_matrices = [confusion_matrix_after_postprocessing(s, keep_largest_fg, keep_largest_labels)
+                                      for s in statistics]
+            results = [{'reference_file': join(folder_ref, i),
+                        'prediction_file': join(prediction_folder, i),
+                        'metrics': metrics_from_confusion_matrix(cm, labels_or_regions)}
+                       for i, cm in zip(predicted_files, confusion_matrices)]
+            return summarize_results(results, labels_or_regions)
+
+        # before we start we should evaluate the images in the source folder
+        if not isfile(join(folder_predictions, 'summary.json')):
+            save_summary_json(evaluate([], [], folder_predictions), join(folder_predictions, 'summary.json'))
+        baseline_results = load_summary_json(join(folder_predictions, 'summary.json'))
+
+        # we save the postprocessing functions in here
+        pp_fns = []
+        pp_fn_kwargs = []
+
         # now let's see whether removing all but the largest foreground region improves the scores
-        output_here = join(output_folder, 'temp', 'keep_largest_fg')
-        maybe_mkdir_p(output_here)
         pp_fn = remove_all_but_largest_component_from_segmentation
         kwargs = {
             'labels_or_regions': label_manager.foreground_labels,
         }
-
-        pool.starmap(
-            load_postprocess_save,
-            zip(
-                [join(folder_predictions, i) for i in predicted_files],
-                [join(output_here, i) for i in predicted_files],
-                [rw] * len(predicted_files),
-                [[pp_fn]] * len(predicted_files),
-                [[kwargs]] * len(predicted_files)
-            )
-        )
-        compute_metrics_on_folder(folder_ref,
-                                  output_here,
-                                  join(output_here, 'summary.json'),
-                                  rw,
-                                  dataset_json['file_ending'],
-                                  labels_or_regions,
-                                  label_manager.ignore_label,
-                                  num_processes)
+        pp_results = evaluate([pp_fn], [kwargs], output_folder)
         # now we need to figure out if doing this improved the dice scores. We will implement that defensively in so far
         # that if a single class got worse as a result we won't do this. We can change this in the future but right now I
         # prefer to do it this way
-        baseline_results = load_summary_json(join(folder_predictions, 'summary.json'))
-        pp_results = load_summary_json(join(output_here, 'summary.json'))
         do_this = pp_results['foreground_mean']['Dice'] > baseline_results['foreground_mean']['Dice']
         if do_this:
             for class_id in pp_results['mean'].keys():
@@ -158,12 +282,12 @@ def determine_postprocessing(folder_predictions: str,
             print(f'Results were improved by removing all but the largest foreground region. '
                   f'Mean dice before: {round(baseline_results["foreground_mean"]["Dice"], 5)} '
                   f'after: {round(pp_results["foreground_mean"]["Dice"], 5)}')
-            source = output_here
+            current_results = pp_results
             pp_fns.append(pp_fn)
             pp_fn_kwargs.append(kwargs)
         else:
             print(f'Removing all but the largest foreground region did not improve results!')
-            source = folder_predictions
+            current_results = baseline_results
 
         # in the old nnU-Net we could just apply all-but-largest component removal to all classes at the same time and
         # then evaluate for each class whether this improved results. This is no longer possible because we now support
@@ -179,53 +303,43 @@ def determine_postprocessing(folder_predictions: str,
                 kwargs = {
                     'labels_or_regions': label_or_region,
                 }
-
-                output_here = join(output_folder, 'temp', 'keep_largest_perClassOrRegion')
-                maybe_mkdir_p(output_here)
-
-                pool.starmap(
-                    load_postprocess_save,
-                    zip(
-                        [join(source, i) for i in predicted_files],
-                        [join(output_here, i) for i in predicted_files],
-                        [rw] * len(predicted_files),
-                        [[pp_fn]] * len(predicted_files),
-                        [[kwargs]] * len(predicted_files)
-                    )
-                )
-                compute_metrics_on_folder(folder_ref,
-                                          output_here,
-                                          join(output_here, 'summary.json'),
-                                          rw,
-                                          dataset_json['file_ending'],
-                                          labels_or_regions,
-                                          label_manager.ignore_label,
-                                          num_processes)
-                baseline_results = load_summary_json(join(source, 'summary.json'))
-                pp_results = load_summary_json(join(output_here, 'summary.json'))
-                do_this = pp_results['mean'][label_or_region]['Dice'] > baseline_results['mean'][label_or_region]['Dice']
+                pp_results = evaluate(pp_fns + [pp_fn], pp_fn_kwargs + [kwargs], output_folder)
+                do_this = pp_results['mean'][label_or_region]['Dice'] > current_results['mean'][label_or_region]['Dice']
                 if do_this:
                     print(f'Results were improved by removing all but the largest component for {label_or_region}. '
-                          f'Dice before: {round(baseline_results["mean"][label_or_region]["Dice"], 5)} '
+                          f'Dice before: {round(current_results["mean"][label_or_region]["Dice"], 5)} '
                           f'after: {round(pp_results["mean"][label_or_region]["Dice"], 5)}')
-                    if isdir(join(output_folder, 'temp', 'keep_largest_perClassOrRegion_currentBest')):
-                        shutil.rmtree(join(output_folder, 'temp', 'keep_largest_perClassOrRegion_currentBest'))
-                    shutil.move(output_here, join(output_folder, 'temp', 'keep_largest_perClassOrRegion_currentBest'), )
-                    source = join(output_folder, 'temp', 'keep_largest_perClassOrRegion_currentBest')
+                    current_results = pp_results
                     pp_fns.append(pp_fn)
                     pp_fn_kwargs.append(kwargs)
                 else:
                     print(f'Removing all but the largest component for {label_or_region} did not improve results! '
-                          f'Dice before: {round(baseline_results["mean"][label_or_region]["Dice"], 5)} '
+                          f'Dice before: {round(current_results["mean"][label_or_region]["Dice"], 5)} '
                           f'after: {round(pp_results["mean"][label_or_region]["Dice"], 5)}')
-    [shutil.copy(join(source, i), join(output_folder, i)) for i in subfiles(source, join=False)]
+
+        if keep_postprocessed_files:
+            # only the final postprocessing is written
+            maybe_mkdir_p(output_folder)
+            pool.starmap(
+                load_postprocess_save,
+                zip(
+                    [join(folder_predictions, i) for i in predicted_files],
+                    [join(output_folder, i) for i in predicted_files],
+                    [rw] * num_cases,
+                    [pp_fns] * num_cases,
+                    [pp_fn_kwargs] * num_cases
+                )
+            )
+            if len(pp_fns) == 0:
+                # nothing changed, these are the baseline results
+                shutil.copy(join(folder_predictions, 'summary.json'), join(output_folder, 'summary.json'))
+            else:
+                save_summary_json(current_results, join(output_folder, 'summary.json'))
     save_pickle((pp_fns, pp_fn_kwargs), join(folder_predictions, 'postprocessing.pkl'))
 
-    baseline_results = load_summary_json(join(folder_predictions, 'summary.json'))
-    final_results = load_summary_json(join(output_folder, 'summary.json'))
     tmp = {
         'input_folder': {i: baseline_results[i] for i in ['foreground_mean', 'mean']},
-        'postprocessed': {i: final_results[i] for i in ['foreground_mean', 'mean']},
+        'postprocessed': {i: current_results[i] for i in ['foreground_mean', 'mean']},
         'postprocessing_fns': [i.__name__ for i in pp_fns],
         'postprocessing_kwargs': pp_fn_kwargs,
     }
@@ -237,11 +351,6 @@ def determine_postprocessing(folder_predictions: str,
     # did I already say that I hate json? "TypeError: Object of type int64 is not JSON serializable" You retarded bro?
     recursive_fix_for_json_export(tmp)
     save_json(tmp, join(folder_predictions, 'postprocessing.json'))
-
-    shutil.rmtree(join(output_folder, 'temp'))
-
-    if not keep_postprocessed_files:
-        shutil.rmtree(output_folder)
     return pp_fns, pp_fn_kwargs
 
 
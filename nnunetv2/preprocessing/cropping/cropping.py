@@ -37,6 +37,10 @@ def crop_to_nonzero(data, seg=None, nonzero_label=-1):
 
     if seg is not None:
         seg = seg[tuple([slice(None), *slicer])]
+        if np.issubdtype(seg.dtype, np.unsignedinteger):
+            # segmentations read in their native dtype (uint8) cannot hold nonzero_label. Only the cropped region is
+            # converted
+            seg = seg.astype(np.promote_types(seg.dtype, np.min_scalar_type(nonzero_label)))
 
     nonzero_mask = nonzero_mask[slicer][None]
     if seg is not None:
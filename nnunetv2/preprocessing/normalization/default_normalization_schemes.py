@@ -3,6 +3,7 @@ from typing import Type
 
 import numpy as np
 from numpy import number
+from nnunetv2.utilities.find_class_by_name import register_class
 
 
 class ImageNormalization(ABC):
@@ -24,6 +25,7 @@ class ImageNormalization(ABC):
         pass
 
 
+@register_class
 class ZScoreNormalization(ImageNormalization):
     leaves_pixels_outside_mask_at_zero_if_use_mask_for_norm_is_true = True
 
@@ -45,10 +47,13 @@ class ZScoreNormalization(ImageNormalization):
         else:
             mean = image.mean()
             std = image.std()
-            image = (image - mean) / (max(std, 1e-8))
+            # in place, image is our own copy (astype above)
+            image -= mean
+            image /= max(std, 1e-8)
         return image
 
 
+@register_class
 class CTNormalization(ImageNormalization):
     leaves_pixels_outside_mask_at_zero_if_use_mask_for_norm_is_true = False
 
@@ -59,11 +64,14 @@ class CTNormalization(ImageNormalization):
         std_intensity = self.intensityproperties['std']
         lower_bound = self.intensityproperties['percentile_00_5']
         upper_bound = self.intensityproperties['percentile_99_5']
-        image = np.clip(image, lower_bound, upper_bound)
-        image = (image - mean_intensity) / max(std_intensity, 1e-8)
+        # in place, image is our own copy (astype above)
+        np.clip(image, lower_bound, upper_bound, out=image)
+        image -= mean_intensity
+        image /= max(std_intensity, 1e-8)
         return image
 
 
+@register_class
 class NoNormalization(ImageNormalization):
     leaves_pixels_outside_mask_at_zero_if_use_mask_for_norm_is_true = False
 
@@ -71,6 +79,7 @@ class NoNormalization(ImageNormalization):
         return image.astype(self.target_dtype)
 
 
+@register_class
 class RescaleTo01Normalization(ImageNormalization):
     leaves_pixels_outside_mask_at_zero_if_use_mask_for_norm_is_true = False
 
@@ -81,6 +90,7 @@ class RescaleTo01Normalization(ImageNormalization):
         return image
 
 
+@register_class
 class RGBTo01Normalization(ImageNormalization):
     leaves_pixels_outside_mask_at_zero_if_use_mask_for_norm_is_true = False
 
@@ -11,7 +11,9 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import json
 import multiprocessing
+import os
 import shutil
 from time import sleep
 from typing import Union, Tuple
@@ -21,16 +23,37 @@ import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_raw
 from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
+from nnunetv2.preprocessing.preprocessors.preprocessing_manifest import load_manifest, save_manifest, \
+    get_input_signature, is_unchanged, garbage_collect_cases, remove_unpacked_case_files
 from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
+from nnunetv2.training.dataloading.utils import save_slice_indexed_case, build_slice_index
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
-from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+from nnunetv2.utilities.find_class_by_name import recursive_find_python_class, register_class
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folder, \
     create_lists_from_splitted_dataset_folder, get_filenames_of_train_images_and_targets
 from tqdm import tqdm
 
 
+def compact_seg_dtype(seg: np.ndarray) -> type:
+    """
+    smallest signed integer dtype that can hold all values of seg (int8, int16 or int32)
+    """
+    seg_min, seg_max = np.min(seg), np.max(seg)
+    if -128 <= seg_min and seg_max <= 127:
+        return np.int8
+    if -32768 <= seg_min and seg_max <= 32767:
+        return np.int16
+    return np.int32
+
+
+@register_class
 class DefaultPreprocessor(object):
+    # part of the preprocessing fingerprint. Increase whenever the code changes what is written for the same inputs and
+    # plans, so that incremental preprocessing redoes existing cases.
+    # 2: images are read in their native dtype, segmentations are stored as compact int8/int16/int32
+    preprocessing_format_version = 2
+
     def __init__(self, verbose: bool = True):
         self.verbose = verbose
         """
@@ -40,11 +63,12 @@ class DefaultPreprocessor(object):
     def run_case_npy(self, data: np.ndarray, seg: Union[np.ndarray, None], properties: dict,
                      plans_manager: PlansManager, configuration_manager: ConfigurationManager,
                      dataset_json: Union[dict, str]):
-        # let's not mess up the inputs!
-        data = np.copy(data)
+        # let's not mess up the inputs! data is never modified in place: cropping returns a view and normalization
+        # writes into a new float32 array, so no copy is needed. The seg is modified in place by crop_to_nonzero, so we
+        # need a copy. Might as well make it a compact one
         if seg is not None:
             assert data.shape[1:] == seg.shape[1:], "Shape mismatch between image and segmentation. Please fix your dataset and make use of the --verify_dataset_integrity flag to ensure everything is correct"
-            seg = np.copy(seg)
+            seg = seg.astype(compact_seg_dtype(seg))
 
         has_seg = seg is not None
 
@@ -106,10 +130,7 @@ class DefaultPreprocessor(object):
             properties['class_locations'] = self._sample_foreground_locations(seg, collect_for_this,
                                                                                    verbose=self.verbose)
             seg = self.modify_seg_fn(seg, plans_manager, dataset_json, configuration_manager)
-        if np.max(seg) > 127:
-            seg = seg.astype(np.int16)
-        else:
-            seg = seg.astype(np.int8)
+        seg = seg.astype(compact_seg_dtype(seg), copy=False)
         return data, seg
 
     def run_case(self, image_files: List[str], seg_file: Union[str, None], plans_manager: PlansManager,
@@ -125,7 +146,9 @@ class DefaultPreprocessor(object):
         if isinstance(dataset_json, str):
             dataset_json = load_json(dataset_json)
 
-        rw = plans_manager.image_reader_writer_class()
+        # native dtype (int16 for CT, uint8 for EM, ...) instead of float32 saves a lot of memory. Normalization
+        # converts to float32 anyway
+        rw = plans_manager.image_reader_writer_class(native_dtype=True)
 
         # load image(s)
         data, data_properties = rw.read_images(image_files)
@@ -145,26 +168,65 @@ class DefaultPreprocessor(object):
                       dataset_json: Union[dict, str]):
         data, seg, properties = self.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json)
         # print('dtypes', data.dtype, seg.dtype)
-        np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
-        write_pickle(properties, output_filename_truncated + '.pkl')
+        # write to temporary files first and rename afterwards so that an interrupted run never leaves a half written
+        # case behind (which would otherwise look like a valid one)
+        with open(output_filename_truncated + '.npz.tmp', 'wb') as f:
+            if len(configuration_manager.patch_size) == 2:
+                # 2d training only ever needs a single slice of a case. Store slice by slice and remember which slices
+                # contain which classes so that the dataloader does not have to decompress and scan the entire volume
+                if 'class_locations' in properties.keys():
+                    properties['slice_index'] = build_slice_index(properties['class_locations'], data.shape[1])
+                save_slice_indexed_case(f, data, seg)
+            else:
+                np.savez_compressed(f, data=data, seg=seg)
+        write_pickle(properties, output_filename_truncated + '.pkl.tmp')
+        os.replace(output_filename_truncated + '.npz.tmp', output_filename_truncated + '.npz')
+        os.replace(output_filename_truncated + '.pkl.tmp', output_filename_truncated + '.pkl')
 
     @staticmethod
     def _sample_foreground_locations(seg: np.ndarray, classes_or_regions: Union[List[int], List[Tuple[int, ...]]],
                                      seed: int = 1234, verbose: bool = False):
+        """
+        Single pass over seg, regardless of the number of classes: the (flat) indices of all voxels that can be
+        relevant are sorted by label once (stable sort, so within each label they remain in ascending order, just like
+        np.argwhere returns them). The voxels of each label are then a contiguous range in that order and regions are
+        just the union of the ranges of their labels. The random selection is identical to what we did before (one
+        np.argwhere per class/region), so the sampled locations do not change.
+        """
         num_samples = 10000
         min_percent_coverage = 0.01  # at least 1% of the class voxels need to be selected, otherwise it may be too
         # sparse
         rndst = np.random.RandomState(seed)
         class_locs = {}
+        if len(classes_or_regions) == 0:
+            return class_locs
+
+        seg_flat = seg.ravel()
+        if not np.issubdtype(seg_flat.dtype, np.integer):
+            seg_flat = seg_flat.astype(np.int16 if -32768 <= np.min(seg_flat) and np.max(seg_flat) <= 32767
+                                       else np.int32)
+        # usually we only care about the foreground, which is a small part of the image. No need to sort everything
+        min_label = min([min(c) if isinstance(c, (tuple, list)) else c for c in classes_or_regions])
+        if min_label > np.min(seg_flat):
+            candidates = np.flatnonzero(seg_flat >= min_label)
+        else:
+            candidates = np.arange(seg_flat.size)
+        candidate_labels = seg_flat[candidates]
+        order = np.argsort(candidate_labels, kind='stable')
+        sorted_indices = candidates[order]
+        sorted_labels = candidate_labels[order]
+        del candidates, candidate_labels, order
+
+        def _flat_indices_of_label(label):
+            start, end = np.searchsorted(sorted_labels, [label, label + 1], side='left')
+            return sorted_indices[start:end]
+
         for c in classes_or_regions:
             k = c if not isinstance(c, list) else tuple(c)
             if isinstance(c, (tuple, list)):
-                mask = seg == c[0]
-                for cc in c[1:]:
-                    mask = mask | (seg == cc)
-                all_locs = np.argwhere(mask)
+                all_locs = np.sort(np.concatenate([_flat_indices_of_label(cc) for cc in np.unique(c)]))
             else:
-                all_locs = np.argwhere(seg == c)
+                all_locs = _flat_indices_of_label(c)
             if len(all_locs) == 0:
                 class_locs[k] = []
                 continue
@@ -172,13 +234,16 @@ class DefaultPreprocessor(object):
             target_num_samples = max(target_num_samples, int(np.ceil(len(all_locs) * min_percent_coverage)))
 
             selected = all_locs[rndst.choice(len(all_locs), target_num_samples, replace=False)]
-            class_locs[k] = selected
+            class_locs[k] = np.stack(np.unravel_index(selected, seg.shape), axis=1)
             if verbose:
                 print(c, target_num_samples)
         return class_locs
 
     def _normalize(self, data: np.ndarray, seg: np.ndarray, configuration_manager: ConfigurationManager,
                    foreground_intensity_properties_per_channel: dict) -> np.ndarray:
+        # data may be in its native dtype (and may be a view of the input). The result always goes into a new float32
+        # array so that we only ever have one float copy of the image
+        normalized = np.empty(data.shape, dtype=np.float32)
         for c in range(data.shape[0]):
             scheme = configuration_manager.normalization_schemes[c]
             normalizer_class = recursive_find_python_class(join(nnunetv2.__path__[0], "preprocessing", "normalization"),
@@ -188,13 +253,40 @@ class DefaultPreprocessor(object):
                 raise RuntimeError(f'Unable to locate class \'{scheme}\' for normalization')
             normalizer = normalizer_class(use_mask_for_norm=configuration_manager.use_mask_for_norm[c],
                                           intensityproperties=foreground_intensity_properties_per_channel[str(c)])
-            data[c] = normalizer.run(data[c], seg[0])
-        return data
+            normalized[c] = normalizer.run(data[c], seg[0])
+        return normalized
+
+    def get_preprocessing_fingerprint(self, plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                                      dataset_json: dict) -> dict:
+        """
+        Everything the preprocessed data depends on (apart from the input files). If any of this changes, all cases
+        are preprocessed again. Fields like batch size or network topology are deliberately not in here: changing
+        them does not require new preprocessing. Subclasses that use additional information (for example in
+        modify_seg_fn) must add it here!
+        """
+        configuration = configuration_manager.configuration
+        return {
+            'preprocessor': self.__class__.__name__,
+            'preprocessing_format_version': self.preprocessing_format_version,
+            'dimensionality': len(configuration_manager.patch_size),
+            'configuration': {k: configuration.get(k) for k in (
+                'data_identifier', 'spacing', 'normalization_schemes', 'use_mask_for_norm', 'resampling_fn_data',
+                'resampling_fn_data_kwargs', 'resampling_fn_seg', 'resampling_fn_seg_kwargs')},
+            'plans': {k: plans_manager.plans.get(k) for k in (
+                'transpose_forward', 'foreground_intensity_properties_per_channel', 'image_reader_writer')},
+            'dataset_json': {k: dataset_json.get(k) for k in (
+                'channel_names', 'modality', 'labels', 'regions_class_order', 'file_ending',
+                'overwrite_image_reader_writer')},
+        }
 
     def run(self, dataset_name_or_id: Union[int, str], configuration_name: str, plans_identifier: str,
-            num_processes: int):
+            num_processes: int, overwrite_existing: bool = False):
         """
         data identifier = configuration name in plans. EZ.
+
+        Preprocessing is incremental: only cases whose input files changed (or that are new) are preprocessed. If
+        anything in get_preprocessing_fingerprint changed, all cases are done again. Output files of cases that no
+        longer exist in nnUNet_raw are removed. Use overwrite_existing=True to start from scratch.
         """
         dataset_name = maybe_convert_to_dataset_name(dataset_name_or_id)
 
@@ -217,29 +309,70 @@ class DefaultPreprocessor(object):
 
         output_directory = join(nnUNet_preprocessed, dataset_name, configuration_manager.data_identifier)
 
-        if isdir(output_directory):
+        if overwrite_existing and isdir(output_directory):
             shutil.rmtree(output_directory)
 
         maybe_mkdir_p(output_directory)
 
-        dataset = get_filenames_of_train_images_and_targets(join(nnUNet_raw, dataset_name), dataset_json)
+        raw_dataset_folder = join(nnUNet_raw, dataset_name)
+        dataset = get_filenames_of_train_images_and_targets(raw_dataset_folder, dataset_json)
 
         # identifiers = [os.path.basename(i[:-len(dataset_json['file_ending'])]) for i in seg_fnames]
         # output_filenames_truncated = [join(output_directory, i) for i in identifiers]
 
+        removed = garbage_collect_cases(output_directory, dataset.keys())
+        if len(removed) > 0:
+            print(f'Removed {len(removed)} files of cases that are no longer part of the dataset (or of interrupted '
+                  f'runs)')
+
+        manifest = load_manifest(output_directory)
+        fingerprint = self.get_preprocessing_fingerprint(plans_manager, configuration_manager, dataset_json)
+        # json roundtrip so that tuples vs lists etc don't make a difference
+        fingerprint = json.loads(json.dumps(fingerprint))
+        if manifest['fingerprint'] != fingerprint:
+            if len(manifest['cases']) > 0:
+                print('The plans changed in a way that affects preprocessing. All cases will be preprocessed again')
+            manifest = {'version': manifest['version'], 'fingerprint': fingerprint, 'cases': {}}
+
+        signatures = {}
+        keys_to_process = []
+        for k in dataset.keys():
+            input_files = dataset[k]['images'] + ([dataset[k]['label']] if dataset[k]['label'] is not None else [])
+            previous_signature = manifest['cases'].get(k)
+            signatures[k] = get_input_signature(input_files, raw_dataset_folder, previous_signature)
+            if is_unchanged(signatures[k], previous_signature) and isfile(join(output_directory, k + '.npz')) and \
+                    isfile(join(output_directory, k + '.pkl')):
+                # also stores new mtimes (if the files were touched) so that they don't have to be hashed again
+                manifest['cases'][k] = signatures[k]
+            else:
+                manifest['cases'].pop(k, None)
+                remove_unpacked_case_files(output_directory, k)
+                keys_to_process.append(k)
+        manifest['cases'] = {k: v for k, v in manifest['cases'].items() if k in dataset.keys()}
+        save_manifest(manifest, output_directory)
+
+        print(f'{len(keys_to_process)} of {len(dataset)} cases need preprocessing, the others are up to date')
+        if len(keys_to_process) == 0:
+            return
+        # largest cases first (only needs the image headers). Otherwise we may end up waiting for a single large case
+        # at the very end
+        rw = plans_manager.image_reader_writer_class()
+        keys_to_process.sort(key=lambda k: np.prod(rw.read_header(dataset[k]['images'][0])['shape'][1:]),
+                             reverse=True)
+
         # multiprocessing magic.
         r = []
         with multiprocessing.get_context("spawn").Pool(num_processes) as p:
-            for k in dataset.keys():
+            for k in keys_to_process:
                 r.append(p.starmap_async(self.run_case_save,
                                          ((join(output_directory, k), dataset[k]['images'], dataset[k]['label'],
                                            plans_manager, configuration_manager,
                                            dataset_json),)))
-            remaining = list(range(len(dataset)))
+            remaining = list(range(len(keys_to_process)))
             # p is pretty nifti. If we kill workers they just respawn but don't do any work.
             # So we need to store the original pool of workers.
             workers = [j for j in p._pool]
-            with tqdm(desc=None, total=len(dataset), disable=self.verbose) as pbar:
+            with tqdm(desc=None, total=len(keys_to_process), disable=self.verbose) as pbar:
                 while len(remaining) > 0:
                     all_alive = all([j.is_alive() for j in workers])
                     if not all_alive:
@@ -251,8 +384,14 @@ class DefaultPreprocessor(object):
                                            'an error message, out of RAM is likely the problem. In that case '
                                            'reducing the number of workers might help')
                     done = [i for i in remaining if r[i].ready()]
-                    for _ in done:
+                    for i in done:
+                        # raises the exception of the worker (if any). Failed cases never make it into the manifest
+                        r[i].get()
+                        manifest['cases'][keys_to_process[i]] = signatures[keys_to_process[i]]
                         pbar.update()
+                    if len(done) > 0:
+                        # so that an interrupted run doesn't have to start over
+                        save_manifest(manifest, output_directory)
                     remaining = [i for i in remaining if i not in done]
                     sleep(0.1)
 
@@ -0,0 +1,94 @@
+import os
+from typing import Iterable, List, Union
+
+from batchgenerators.utilities.file_and_folder_operations import isfile, join, load_json, save_json
+
+from nnunetv2.utilities.utils import hash_file
+
+"""
+Bookkeeping for incremental preprocessing. The manifest lives in the output folder of each configuration and
+remembers, for each case, the signature of its input files (size, mtime and content hash) together with the
+preprocessing fingerprint (the plans fields that influence the result, see
+DefaultPreprocessor.get_preprocessing_fingerprint). A case only needs to be preprocessed again if one of them changed.
+"""
+
+MANIFEST_FILE_NAME = 'preprocessing_manifest.json'
+MANIFEST_VERSION = 1
+
+# everything preprocessing (and unpacking for training) writes for a case. Order matters: longest suffix first
+CASE_FILE_SUFFIXES = ('_seg.npy', '.npz.tmp', '.pkl.tmp', '.npz', '.pkl', '.npy')
+
+
+def get_input_signature(files: Iterable[str], base_folder: str, previous_signature: Union[dict, None] = None) -> dict:
+    """
+    Returns {relative_path: [size, mtime_ns, sha1]} for the given files. Files are only hashed if they are new or if
+    size or mtime differ from previous_signature. Otherwise the stored hash is reused, so checking an unchanged dataset
+    does not need to read it. If only the mtime changed (file was touched or copied) the hash is identical and so is
+    the signature apart from the mtime, which is what is_unchanged compares.
+    """
+    previous_signature = previous_signature if previous_signature is not None else {}
+    signature = {}
+    for f in files:
+        rel = os.path.relpath(f, base_folder)
+        stat = os.stat(f)
+        prev = previous_signature.get(rel)
+        if prev is not None and prev[0] == stat.st_size and prev[1] == stat.st_mtime_ns:
+            file_hash = prev[2]
+        else:
+            file_hash = hash_file(f)
+        signature[rel] = [stat.st_size, stat.st_mtime_ns, file_hash]
+    return signature
+
+
+def is_unchanged(signature: dict, previous_signature: Union[dict, None]) -> bool:
+    if previous_signature is None or signature.keys() != previous_signature.keys():
+        return False
+    # size and hash decide. mtime is just what allows us to skip hashing
+    return all(signature[k][0] == previous_signature[k][0] and signature[k][2] == previous_signature[k][2]
+               for k in signature.keys())
+
+
+def load_manifest(folder: str) -> dict:
+    manifest_file = join(folder, MANIFEST_FILE_NAME)
+    if isfile(manifest_file):
+        try:
+            manifest = load_json(manifest_file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except ValueError:
+            # corrupt manifest. Not a problem, we just start from scratch
+            pass
+    return {'version': MANIFEST_VERSION, 'fingerprint': None, 'cases': {}}
+
+
+def save_manifest(manifest: dict, folder: str) -> None:
+    manifest_file = join(folder, MANIFEST_FILE_NAME)
+    tmp_file = manifest_file + f'.{os.getpid()}.tmp'
+    save_json(manifest, tmp_file, sort_keys=False)
+    os.replace(tmp_file, manifest_file)
+
+
+def remove_unpacked_case_files(folder: str, identifier: str) -> None:
+    """
+    The unpacked .npy files are not overwritten by unpack_dataset (overwrite_existing=False), so they must go when a
+    case is preprocessed again
+    """
+    for s in ('.npy', '_seg.npy'):
+        if isfile(join(folder, identifier + s)):
+            os.remove(join(folder, identifier + s))
+
+
+def garbage_collect_cases(folder: str, identifiers_to_keep: Iterable[str]) -> List[str]:
+    """
+    Removes all case files (see CASE_FILE_SUFFIXES) that don't belong to any of identifiers_to_keep as well as
+    leftover temporary files of interrupted runs. Returns the removed files
+    """
+    identifiers_to_keep = set(identifiers_to_keep)
+    removed = []
+    for f in os.listdir(folder):
+        candidates = [f[:-len(s)] for s in CASE_FILE_SUFFIXES if f.endswith(s)]
+        if not f.endswith('.tmp') and (len(candidates) == 0 or any(c in identifiers_to_keep for c in candidates)):
+            continue
+        os.remove(join(folder, f))
+        removed.append(f)
+    return removed
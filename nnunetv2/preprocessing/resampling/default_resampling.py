@@ -5,7 +5,7 @@ import numpy as np
 import pandas as pd
 import torch
 from batchgenerators.augmentations.utils import resize_segmentation
-from scipy.ndimage.interpolation import map_coordinates
+from scipy import ndimage
 from skimage.transform import resize
 from nnunetv2.configuration import ANISO_THRESHOLD
 
@@ -149,7 +149,13 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
     shape = np.array(data[0].shape)
     new_shape = np.array(new_shape)
     if np.any(shape != new_shape):
-        data = data.astype(float)
+        if not is_seg:
+            # float32 is plenty (the result is float32 anyway) and half the memory of float64. Segmentations keep
+            # their dtype, resize_segmentation handles each label separately
+            data = data.astype(np.promote_types(data.dtype, np.float32), copy=False)
+        # results are written into here directly (casting to dtype_data channel by channel) instead of stacking a
+        # list and converting the whole thing at the end (two more copies)
+        reshaped_final_data = np.empty((data.shape[0], *new_shape), dtype=dtype_data)
         if do_separate_z:
             # print("separate z, order in z is", order_z, "order inplane is", order)
             assert len(axis) == 1, "only one anisotropic axis supported"
@@ -161,7 +167,6 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
             else:
                 new_shape_2d = new_shape[:-1]
 
-            reshaped_final_data = []
             for c in range(data.shape[0]):
                 reshaped_data = []
                 for slice_id in range(shape[axis]):
@@ -173,44 +178,30 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
                         reshaped_data.append(resize_fn(data[c, :, :, slice_id], new_shape_2d, order, **kwargs))
                 reshaped_data = np.stack(reshaped_data, axis)
                 if shape[axis] != new_shape[axis]:
-
-                    # The following few lines are blatantly copied and modified from sklearn's resize()
-                    rows, cols, dim = new_shape[0], new_shape[1], new_shape[2]
-                    orig_rows, orig_cols, orig_dim = reshaped_data.shape
-
-                    row_scale = float(orig_rows) / rows
-                    col_scale = float(orig_cols) / cols
-                    dim_scale = float(orig_dim) / dim
-
-                    map_rows, map_cols, map_dims = np.mgrid[:rows, :cols, :dim]
-                    map_rows = row_scale * (map_rows + 0.5) - 0.5
-                    map_cols = col_scale * (map_cols + 0.5) - 0.5
-                    map_dims = dim_scale * (map_dims + 0.5) - 0.5
-
-                    coord_map = np.array([map_rows, map_cols, map_dims])
+                    # Only the out of plane axis still needs to be resampled. We used to build the full coordinate
+                    # grid for map_coordinates here (3 float64 arrays of the output size!). zoom with grid_mode=True
+                    # samples exactly the same coordinates ((i + 0.5) * scale - 0.5) without materializing them
+                    zoom_factors = [n / o for n, o in zip(new_shape, reshaped_data.shape)]
                     if not is_seg or order_z == 0:
-                        reshaped_final_data.append(map_coordinates(reshaped_data, coord_map, order=order_z,
-                                                                   mode='nearest')[None])
+                        reshaped_final_data[c] = ndimage.zoom(reshaped_data, zoom_factors, order=order_z,
+                                                              mode='nearest', grid_mode=True)
                     else:
                         unique_labels = np.sort(pd.unique(reshaped_data.ravel()))  # np.unique(reshaped_data)
                         reshaped = np.zeros(new_shape, dtype=dtype_data)
 
                         for i, cl in enumerate(unique_labels):
                             reshaped_multihot = np.round(
-                                map_coordinates((reshaped_data == cl).astype(float), coord_map, order=order_z,
-                                                mode='nearest'))
+                                ndimage.zoom((reshaped_data == cl).astype(float), zoom_factors, order=order_z,
+                                             mode='nearest', grid_mode=True))
                             reshaped[reshaped_multihot > 0.5] = cl
-                        reshaped_final_data.append(reshaped[None])
+                        reshaped_final_data[c] = reshaped
                 else:
-                    reshaped_final_data.append(reshaped_data[None])
-            reshaped_final_data = np.vstack(reshaped_final_data)
+                    reshaped_final_data[c] = reshaped_data
         else:
             # print("no separate z, order", order)
-            reshaped = []
             for c in range(data.shape[0]):
-                reshaped.append(resize_fn(data[c], new_shape, order, **kwargs)[None])
-            reshaped_final_data = np.vstack(reshaped)
-        return reshaped_final_data.astype(dtype_data)
+                reshaped_final_data[c] = resize_fn(data[c], new_shape, order, **kwargs)
+        return reshaped_final_data
     else:
         # print("no resampling necessary")
         return data
@@ -0,0 +1,426 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+import torch
+from scipy import ndimage
+
+from nnunetv2.configuration import ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape, get_do_separate_z, \
+    get_lowres_axis
+
+"""
+Drop-in replacement for resample_data_or_seg_to_shape/resample_data_or_seg_to_spacing (same arguments, same
+interpolation), made for speed:
+- everything is computed in float32 instead of float64
+- nearest neighbor and linear interpolation (the z axis in the separate z case, all segmentations with order <= 1 and
+  the probabilities at export) are done with separable numpy gathers on all channels (and slices) at once
+- higher spline orders use scipy.ndimage.zoom (which is what skimage's resize uses internally) on all slices/channels
+  in a thread pool. scipy releases the GIL, so the threads actually run in parallel
+- segmentations with order <= 1 are resampled in a single pass: each output voxel takes the label with the largest
+  summed interpolation weight among its neighbors. This gives the same result as interpolating each label's one hot
+  encoding separately and taking the argmax (ties go to the nearest neighbor), but the cost does not depend on the
+  number of labels
+
+Use it by setting resampling_fn_data/resampling_fn_seg/resampling_fn_probabilities in the plans to
+fast_resample_data_or_seg_to_shape (kwargs stay the same; num_threads can be added) or plan with
+ExperimentPlannerFastResampling. Run this file for a parity check against the default implementation.
+"""
+
+
+def get_default_num_threads_resampling() -> int:
+    # preprocessing and export already run several processes in parallel, so we don't want to go overboard here
+    if 'nnUNet_n_threads_resampling' in os.environ.keys():
+        return max(1, int(os.environ['nnUNet_n_threads_resampling']))
+    return max(1, min(4, os.cpu_count()))
+
+
+def _map(fn: Callable, items: List, num_threads: int) -> List:
+    if num_threads <= 1 or len(items) <= 1:
+        return [fn(i) for i in items]
+    with ThreadPoolExecutor(min(num_threads, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+def determine_do_separate_z_and_axis(current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                     new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                     force_separate_z: Union[bool, None] = False,
+                                     separate_z_anisotropy_threshold: float = ANISO_THRESHOLD) \
+        -> Tuple[bool, Union[None, int]]:
+    """
+    same logic as in resample_data_or_seg_to_shape. Returns (do_separate_z, axis). axis is an int (not an array)
+    """
+    if force_separate_z is not None:
+        do_separate_z = force_separate_z
+        axis = get_lowres_axis(current_spacing) if force_separate_z else None
+    elif get_do_separate_z(current_spacing, separate_z_anisotropy_threshold):
+        do_separate_z = True
+        axis = get_lowres_axis(current_spacing)
+    elif get_do_separate_z(new_spacing, separate_z_anisotropy_threshold):
+        do_separate_z = True
+        axis = get_lowres_axis(new_spacing)
+    else:
+        do_separate_z = False
+        axis = None
+
+    if axis is not None and len(axis) != 1:
+        # see resample_data_or_seg_to_shape: no single anisotropic axis, so no separate z
+        do_separate_z = False
+    if not do_separate_z:
+        return False, None
+    return True, int(axis[0])
+
+
+def _sample_coordinates(old_size: int, new_size: int) -> np.ndarray:
+    # same convention as skimage's resize (scipy.ndimage.zoom with grid_mode=True) and the map_coordinates call in
+    # resample_data_or_seg
+    scale = float(old_size) / new_size
+    return scale * (np.arange(new_size) + 0.5) - 0.5
+
+
+def _nearest_indices(old_size: int, new_size: int) -> np.ndarray:
+    # scipy rounds with floor(x + 0.5) for order 0, mode='nearest' clamps to the image
+    return np.clip(np.floor(_sample_coordinates(old_size, new_size) + 0.5).astype(np.int64), 0, old_size - 1)
+
+
+def _linear_indices_and_weights(old_size: int, new_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    coords = _sample_coordinates(old_size, new_size)
+    lo = np.floor(coords)
+    w_hi = (coords - lo).astype(np.float32)
+    lo = lo.astype(np.int64)
+    return np.clip(lo, 0, old_size - 1), np.clip(lo + 1, 0, old_size - 1), w_hi
+
+
+def _resample_nearest(data: np.ndarray, new_shape: Tuple[int, ...], axes: Tuple[int, ...]) -> np.ndarray:
+    """
+    data is c, x, y(, z). axes refers to the spatial axes (0 = first spatial axis)
+    """
+    for a in axes:
+        if data.shape[a + 1] != new_shape[a]:
+            data = np.take(data, _nearest_indices(data.shape[a + 1], new_shape[a]), axis=a + 1)
+    return data
+
+
+def _resample_linear(data: np.ndarray, new_shape: Tuple[int, ...], axes: Tuple[int, ...]) -> np.ndarray:
+    """
+    data is c, x, y(, z) and must be float. Linear interpolation is separable, so we do one axis after the other.
+    Linear interpolation cannot overshoot, so there is no need to clip like skimage does
+    """
+    for a in axes:
+        if data.shape[a + 1] != new_shape[a]:
+            lo, hi, w_hi = _linear_indices_and_weights(data.shape[a + 1], new_shape[a])
+            w_shape = [1] * data.ndim
+            w_shape[a + 1] = -1
+            w_hi = w_hi.reshape(w_shape)
+            lower = np.take(data, lo, axis=a + 1)
+            upper = np.take(data, hi, axis=a + 1)
+            upper -= lower
+            upper *= w_hi
+            upper += lower
+            data = upper
+    return data
+
+
+def _spline_zoom(image: np.ndarray, new_shape: Tuple[int, ...], order: int, clip: bool = True) -> np.ndarray:
+    """
+    This is what skimage's resize(image, new_shape, order, mode='edge', anti_aliasing=False) does, just in float32
+    """
+    zoom_factors = [n / o for n, o in zip(new_shape, image.shape)]
+    resized = ndimage.zoom(image, zoom_factors, order=order, mode='nearest', grid_mode=True, output=np.float32)
+    if clip:
+        np.clip(resized, image.min(), image.max(), out=resized)
+    return resized
+
+
+def _resample_spline(data: np.ndarray, new_shape: Tuple[int, ...], order: int, separate_axis: Union[None, int],
+                     num_threads: int) -> np.ndarray:
+    """
+    Resamples all axes except separate_axis (if given). Each channel (and each slice along separate_axis) is one job
+    for the thread pool
+    """
+    if separate_axis is None:
+        return np.stack(_map(lambda c: _spline_zoom(data[c], new_shape, order), list(range(data.shape[0])),
+                             num_threads))
+    new_shape_2d = [s for i, s in enumerate(new_shape) if i != separate_axis]
+    out_shape = list(new_shape)
+    out_shape[separate_axis] = data.shape[separate_axis + 1]
+    out = np.empty((data.shape[0], *out_shape), dtype=np.float32)
+
+    def _job(c_and_slice):
+        c, s = c_and_slice
+        slicer = [slice(None)] * len(new_shape)
+        slicer[separate_axis] = s
+        out[c][tuple(slicer)] = _spline_zoom(data[c][tuple(slicer)], new_shape_2d, order)
+
+    _map(_job, list(itertools.product(range(data.shape[0]), range(data.shape[separate_axis + 1]))), num_threads)
+    return out
+
+
+def _resample_along_axis_spline(data: np.ndarray, new_shape: Tuple[int, ...], order: int, axis: int,
+                                num_threads: int) -> np.ndarray:
+    """
+    Resamples only axis. Just like the map_coordinates call in resample_data_or_seg this does not clip
+    """
+    return np.stack(_map(lambda c: _spline_zoom(data[c], new_shape, order, clip=False), list(range(data.shape[0])),
+                         num_threads))
+
+
+def _resample_seg_one_pass(seg: np.ndarray, new_shape: Tuple[int, ...], axes: Tuple[int, ...],
+                           num_threads: int) -> np.ndarray:
+    """
+    seg is x, y(, z). Linear interpolation along axes (the other axes must already have the target shape).
+
+    Interpolating each label's one hot encoding linearly and taking the argmax is the same as letting each output
+    voxel pick the label that has the largest summed interpolation weight among its 2^len(axes) neighbors. That is
+    what we do here, so we never have to loop over the labels. Ties (for example a sample point exactly between two
+    labels) are resolved in favor of the nearest neighbor, just like batchgenerators' resize_segmentation does.
+
+    Work is split into slabs along the first axis (one job per slab) to keep memory in check.
+    """
+    axes = tuple(a for a in axes if seg.shape[a] != new_shape[a])
+    if len(axes) == 0:
+        return seg
+    per_axis = {a: _linear_indices_and_weights(seg.shape[a], new_shape[a]) for a in axes}
+    corners = list(itertools.product((0, 1), repeat=len(axes)))
+
+    def _job(out_slab: slice) -> np.ndarray:
+        index_arrays = []
+        weight_arrays = []
+        for a in range(seg.ndim):
+            if a in axes:
+                lo, hi, w_hi = per_axis[a]
+                if a == 0:
+                    lo, hi, w_hi = lo[out_slab], hi[out_slab], w_hi[out_slab]
+                index_arrays.append((lo, hi))
+                weight_arrays.append((1 - w_hi, w_hi))
+            else:
+                idx = np.arange(seg.shape[a])
+                if a == 0:
+                    idx = idx[out_slab]
+                index_arrays.append((idx, idx))
+                weight_arrays.append((np.ones(1, dtype=np.float32), np.ones(1, dtype=np.float32)))
+
+        def _corner_index(corner):
+            per_dim = []
+            for a in range(seg.ndim):
+                per_dim.append(index_arrays[a][corner[axes.index(a)]] if a in axes else index_arrays[a][0])
+            return np.ix_(*per_dim)
+
+        def _corner_weight(corner):
+            w = None
+            for a in axes:
+                shape = [1] * seg.ndim
+                shape[a] = -1
+                wa = weight_arrays[a][corner[axes.index(a)]].reshape(shape)
+                w = wa if w is None else w * wa
+            return w
+
+        labels = [seg[_corner_index(c)] for c in corners]
+        weights = [_corner_weight(c) for c in corners]
+
+        # summed weight of the label of each corner. Symmetric, so each pair is compared only once
+        scores = [np.broadcast_to(w, labels[0].shape).astype(np.float32) for w in weights]
+        for i, j in itertools.combinations(range(len(corners)), 2):
+            same = labels[i] == labels[j]
+            scores[i] += weights[j] * same
+            scores[j] += weights[i] * same
+
+        best_score = scores[0].copy()
+        result = labels[0].copy()
+        for i in range(1, len(corners)):
+            # smaller label wins among exact ties that don't involve the nearest neighbor (argmax semantics)
+            better = (scores[i] > best_score) | ((scores[i] == best_score) & (labels[i] < result))
+            np.copyto(result, labels[i], where=better)
+            np.maximum(best_score, scores[i], out=best_score)
+
+        # nearest neighbor: along each axis the upper neighbor if its weight is >= 0.5
+        nearest_corner_per_axis = [(weight_arrays[a][1] >= 0.5) for a in axes]
+        nearest_label = np.zeros_like(result)
+        nearest_score = np.zeros_like(best_score)
+        for i, c in enumerate(corners):
+            is_nearest = None
+            for k, a in enumerate(axes):
+                shape = [1] * seg.ndim
+                shape[a] = -1
+                m = nearest_corner_per_axis[k].reshape(shape) == bool(c[k])
+                is_nearest = m if is_nearest is None else is_nearest & m
+            is_nearest = np.broadcast_to(is_nearest, result.shape)
+            np.copyto(nearest_label, labels[i], where=is_nearest)
+            np.copyto(nearest_score, scores[i], where=is_nearest)
+        np.copyto(result, nearest_label, where=nearest_score >= best_score)
+        return result
+
+    slab_size = max(1, int(np.ceil(new_shape[0] / max(1, num_threads * 2))))
+    slabs = [slice(i, min(new_shape[0], i + slab_size)) for i in range(0, new_shape[0], slab_size)]
+    return np.concatenate(_map(_job, slabs, num_threads), axis=0)
+
+
+def _resample_seg_by_label(seg: np.ndarray, resample_fn: Callable[[np.ndarray], np.ndarray],
+                           num_threads: int) -> np.ndarray:
+    """
+    Fallback for spline orders > 1: interpolate the one hot encoding of each label (in parallel) and take the argmax
+    """
+    labels = np.sort(np.unique(seg))
+    if len(labels) == 1:
+        return np.full(resample_fn(np.zeros(seg.shape, dtype=np.float32)).shape, labels[0], dtype=seg.dtype)
+    scores = _map(lambda l: resample_fn((seg == l).astype(np.float32)), list(labels), num_threads)
+    best = scores[0]
+    result = np.full(best.shape, labels[0], dtype=seg.dtype)
+    for l, s in zip(labels[1:], scores[1:]):
+        better = s > best
+        result[better] = l
+        np.maximum(best, s, out=best)
+    return result
+
+
+def fast_resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                              is_seg: bool = False, axis: Union[None, int] = None, order: int = 3,
+                              do_separate_z: bool = False, order_z: int = 0,
+                              num_threads: int = None) -> np.ndarray:
+    """
+    Same as resample_data_or_seg (axis is an int here, not an array)
+    """
+    assert data.ndim == 4 or data.ndim == 3, "data must be (c, x, y(, z))"
+    assert len(new_shape) == data.ndim - 1
+    if num_threads is None:
+        num_threads = get_default_num_threads_resampling()
+    new_shape = tuple([int(i) for i in new_shape])
+    if tuple(data.shape[1:]) == new_shape:
+        return data
+    dtype_data = data.dtype
+    all_axes = tuple(range(len(new_shape)))
+    inplane_axes = tuple(a for a in all_axes if a != axis) if do_separate_z else all_axes
+
+    if is_seg:
+        def _resample_seg_channel(seg: np.ndarray) -> np.ndarray:
+            if order == 0:
+                seg = _resample_nearest(seg[None], new_shape, inplane_axes)[0]
+            elif order == 1:
+                intermediate_shape = tuple(new_shape[a] if a in inplane_axes else seg.shape[a] for a in all_axes)
+                seg = _resample_seg_one_pass(seg, intermediate_shape, inplane_axes, num_threads)
+            else:
+                seg = _resample_seg_by_label(
+                    seg, lambda x: _resample_spline(x[None], new_shape, order, axis if do_separate_z else None,
+                                                    1)[0], num_threads)
+            if do_separate_z and seg.shape[axis] != new_shape[axis]:
+                if order_z == 0:
+                    seg = _resample_nearest(seg[None], new_shape, (axis,))[0]
+                elif order_z == 1:
+                    seg = _resample_seg_one_pass(seg, new_shape, (axis,), num_threads)
+                else:
+                    seg = _resample_seg_by_label(
+                        seg, lambda x: _resample_along_axis_spline(x[None], new_shape, order_z, axis, 1)[0],
+                        num_threads)
+            return seg
+
+        return np.stack([_resample_seg_channel(data[c]) for c in range(data.shape[0])]).astype(dtype_data, copy=False)
+
+    data = data.astype(np.float32, copy=False)
+    if order == 0:
+        data = _resample_nearest(data, new_shape, inplane_axes)
+    elif order == 1:
+        data = _resample_linear(data, new_shape, inplane_axes)
+    else:
+        data = _resample_spline(data, new_shape, order, axis if do_separate_z else None, num_threads)
+    if do_separate_z and data.shape[axis + 1] != new_shape[axis]:
+        if order_z == 0:
+            data = _resample_nearest(data, new_shape, (axis,))
+        elif order_z == 1:
+            data = _resample_linear(data, new_shape, (axis,))
+        else:
+            data = _resample_along_axis_spline(data, new_shape, order_z, axis, num_threads)
+    return data.astype(dtype_data, copy=False)
+
+
+def fast_resample_data_or_seg_to_shape(data: Union[torch.Tensor, np.ndarray],
+                                       new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                                       current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                       new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                       is_seg: bool = False,
+                                       order: int = 3, order_z: int = 0,
+                                       force_separate_z: Union[bool, None] = False,
+                                       separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                       num_threads: int = None):
+    """
+    Fast version of resample_data_or_seg_to_shape. See top of this file
+    """
+    if isinstance(data, torch.Tensor):
+        data = data.cpu().numpy()
+    assert data.ndim == 4, "data must be c x y z"
+    do_separate_z, axis = determine_do_separate_z_and_axis(current_spacing, new_spacing, force_separate_z,
+                                                           separate_z_anisotropy_threshold)
+    return fast_resample_data_or_seg(data, new_shape, is_seg, axis, order, do_separate_z, order_z, num_threads)
+
+
+def fast_resample_data_or_seg_to_spacing(data: np.ndarray,
+                                         current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                         new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                         is_seg: bool = False,
+                                         order: int = 3, order_z: int = 0,
+                                         force_separate_z: Union[bool, None] = False,
+                                         separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                         num_threads: int = None):
+    """
+    Fast version of resample_data_or_seg_to_spacing. See top of this file
+    """
+    assert data.ndim == 4, "data must be c x y z"
+    new_shape = compute_new_shape(data.shape[1:], current_spacing, new_spacing)
+    return fast_resample_data_or_seg_to_shape(data, new_shape, current_spacing, new_spacing, is_seg, order, order_z,
+                                              force_separate_z, separate_z_anisotropy_threshold, num_threads)
+
+
+if __name__ == '__main__':
+    # parity check against the default implementation. Data should be (almost) identical (float32 vs float64),
+    # segmentations may only differ where the interpolated label scores are (almost) tied
+    from time import time
+    from nnunetv2.preprocessing.resampling.default_resampling import resample_data_or_seg_to_shape
+
+    rs = np.random.RandomState(1234)
+    image = ndimage.gaussian_filter(rs.normal(0, 1, size=(2, 24, 96, 80)), 2).astype(np.float32) * 100
+    seg = np.zeros((1, 24, 96, 80), dtype=np.uint8)
+    grid = np.ogrid[:24, :96, :80]
+    for label in range(1, 5):
+        center = rs.uniform(0.2, 0.8, size=3) * np.array([24, 96, 80])
+        seg[0][sum(((g - c) / (r * s)) ** 2 for g, c, r, s in zip(grid, center, rs.uniform(0.1, 0.3, size=3),
+                                                                   (24, 96, 80))) <= 1] = label
+    probabilities = np.exp(image[:1] / 50).astype(np.float32)
+    probabilities = np.concatenate((probabilities, 1 - probabilities / probabilities.max()))
+
+    cases = {
+        # name: (array, current spacing, new spacing, kwargs)
+        'data anisotropic (separate z)': (image, (5, 1, 1), (3, 0.8, 0.8),
+                                          {'is_seg': False, 'order': 3, 'order_z': 0, 'force_separate_z': None}),
+        'data isotropic': (image[:, :16, :48, :48], (1, 1, 1), (0.7, 0.7, 1.3),
+                           {'is_seg': False, 'order': 3, 'order_z': 0, 'force_separate_z': None}),
+        'probabilities anisotropic': (probabilities, (3, 0.8, 0.8), (5, 1, 1),
+                                      {'is_seg': False, 'order': 1, 'order_z': 0, 'force_separate_z': None}),
+        'seg anisotropic (separate z)': (seg, (5, 1, 1), (3, 0.8, 0.8),
+                                         {'is_seg': True, 'order': 1, 'order_z': 0, 'force_separate_z': None}),
+        'seg isotropic': (seg, (1, 1, 1), (0.7, 0.7, 1.3),
+                          {'is_seg': True, 'order': 1, 'order_z': 0, 'force_separate_z': None}),
+        'seg isotropic, order 0': (seg, (1, 1, 1), (0.7, 0.7, 1.3),
+                                   {'is_seg': True, 'order': 0, 'order_z': 0, 'force_separate_z': None}),
+        'seg anisotropic, order_z 1': (seg, (5, 1, 1), (3, 0.8, 0.8),
+                                       {'is_seg': True, 'order': 1, 'order_z': 1, 'force_separate_z': True}),
+    }
+    for name, (arr, current_spacing, new_spacing, kwargs) in cases.items():
+        new_shape = compute_new_shape(arr.shape[1:], current_spacing, new_spacing)
+        st = time()
+        ref = resample_data_or_seg_to_shape(arr, new_shape, current_spacing, new_spacing, **kwargs)
+        time_ref = time() - st
+        st = time()
+        fast = fast_resample_data_or_seg_to_shape(arr, new_shape, current_spacing, new_spacing, **kwargs)
+        time_fast = time() - st
+        assert ref.shape == fast.shape and ref.dtype == fast.dtype, (name, ref.shape, fast.shape, ref.dtype,
+                                                                     fast.dtype)
+        if kwargs['is_seg']:
+            agreement = np.mean(ref == fast)
+            print(f'{name}: {round(time_ref, 3)} s -> {round(time_fast, 3)} s, {agreement * 100} % identical voxels')
+            assert agreement > 0.999, name
+        else:
+            max_rel_diff = np.abs(ref - fast).max() / np.abs(ref).max()
+            print(f'{name}: {round(time_ref, 3)} s -> {round(time_fast, 3)} s, max relative difference '
+                  f'{max_rel_diff}')
+            assert max_rel_diff < 1e-4, name
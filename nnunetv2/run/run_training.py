@@ -10,6 +10,7 @@ from batchgenerators.utilities.file_and_folder_operations import join, isfile, l
 from nnunetv2.paths import nnUNet_preprocessed
 from nnunetv2.run.load_pretrained_weights import load_pretrained_weights
 from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+from nnunetv2.training.profiling.training_profiler import DEFAULT_PROFILING_WINDOW
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from torch.backends import cudnn
@@ -108,7 +109,7 @@ def cleanup_ddp():
 
 
 def run_ddp(rank, dataset_name_or_id, configuration, fold, tr, p, use_compressed, disable_checkpointing, c, val,
-            pretrained_weights, npz, val_with_best, world_size):
+            pretrained_weights, npz, val_with_best, world_size, profile=False, skip_val=False):
     setup_ddp(rank, world_size)
     torch.cuda.set_device(torch.device('cuda', dist.get_rank()))
 
@@ -118,6 +119,9 @@ def run_ddp(rank, dataset_name_or_id, configuration, fold, tr, p, use_compressed
     if disable_checkpointing:
         nnunet_trainer.disable_checkpointing = disable_checkpointing
 
+    if profile and nnunet_trainer.profiling_window is None:
+        nnunet_trainer.profiling_window = DEFAULT_PROFILING_WINDOW
+
     assert not (c and val), f'Cannot set --c and --val flag at the same time. Dummy.'
 
     maybe_load_checkpoint(nnunet_trainer, c, val, pretrained_weights)
@@ -129,9 +133,10 @@ def run_ddp(rank, dataset_name_or_id, configuration, fold, tr, p, use_compressed
     if not val:
         nnunet_trainer.run_training()
 
-    if val_with_best:
-        nnunet_trainer.load_checkpoint(join(nnunet_trainer.output_folder, 'checkpoint_best.pth'))
-    nnunet_trainer.perform_actual_validation(npz)
+    if not skip_val:
+        if val_with_best:
+            nnunet_trainer.load_checkpoint(join(nnunet_trainer.output_folder, 'checkpoint_best.pth'))
+        nnunet_trainer.perform_actual_validation(npz)
     cleanup_ddp()
 
 
@@ -147,7 +152,9 @@ def run_training(dataset_name_or_id: Union[str, int],
                  only_run_validation: bool = False,
                  disable_checkpointing: bool = False,
                  val_with_best: bool = False,
-                 device: torch.device = torch.device('cuda')):
+                 device: torch.device = torch.device('cuda'),
+                 profile: bool = False,
+                 skip_val: bool = False):
     if isinstance(fold, str):
         if fold != 'all':
             try:
@@ -182,7 +189,9 @@ def run_training(dataset_name_or_id: Union[str, int],
                      pretrained_weights,
                      export_validation_probabilities,
                      val_with_best,
-                     num_gpus),
+                     num_gpus,
+                     profile,
+                     skip_val),
                  nprocs=num_gpus,
                  join=True)
     else:
@@ -192,6 +201,9 @@ def run_training(dataset_name_or_id: Union[str, int],
         if disable_checkpointing:
             nnunet_trainer.disable_checkpointing = disable_checkpointing
 
+        if profile and nnunet_trainer.profiling_window is None:
+            nnunet_trainer.profiling_window = DEFAULT_PROFILING_WINDOW
+
         assert not (continue_training and only_run_validation), f'Cannot set --c and --val flag at the same time. Dummy.'
 
         maybe_load_checkpoint(nnunet_trainer, continue_training, only_run_validation, pretrained_weights)
@@ -203,6 +215,8 @@ def run_training(dataset_name_or_id: Union[str, int],
         if not only_run_validation:
             nnunet_trainer.run_training()
 
+        if skip_val:
+            return
         if val_with_best:
             nnunet_trainer.load_checkpoint(join(nnunet_trainer.output_folder, 'checkpoint_best.pth'))
         nnunet_trainer.perform_actual_validation(export_validation_probabilities)
@@ -245,6 +259,14 @@ def run_training_entry():
     parser.add_argument('--disable_checkpointing', action='store_true', required=False,
                         help='[OPTIONAL] Set this flag to disable checkpointing. Ideal for testing things out and '
                              'you dont want to flood your hard drive with checkpoints.')
+    parser.add_argument('--skip_val', action='store_true', required=False,
+                        help='[OPTIONAL] Do not run the final validation after training. Use nnUNetv2_validate to run '
+                             'it as a separate job (that can also be split across several GPUs/processes).')
+    parser.add_argument('--profile', action='store_true', required=False,
+                        help='[OPTIONAL] Capture a window of training iterations with torch.profiler. Writes a trace '
+                             'and a per-iteration time breakdown (data loading, H2D, forward, loss, backward, '
+                             'optimizer) to OUTPUT_FOLDER/profiling. Use the nnUNet_profile environment variable '
+                             '(SKIP,NUM) to control which iterations are captured.')
     parser.add_argument('-device', type=str, default='cuda', required=False,
                     help="Use this to set the device the training should run with. Available options are 'cuda' "
                          "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
@@ -267,7 +289,7 @@ def run_training_entry():
 
     run_training(args.dataset_name_or_id, args.configuration, args.fold, args.tr, args.p, args.pretrained_weights,
                  args.num_gpus, args.use_compressed, args.npz, args.c, args.val, args.disable_checkpointing, args.val_best,
-                 device=device)
+                 device=device, profile=args.profile, skip_val=args.skip_val)
 
 
 if __name__ == '__main__':
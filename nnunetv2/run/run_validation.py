@@ -0,0 +1,102 @@
+from typing import Union
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, isfile
+from torch.backends import cudnn
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.run.run_training import get_trainer_from_args
+
+
+def run_validation(dataset_name_or_id: Union[str, int],
+                   configuration: str, fold: Union[int, str],
+                   trainer_class_name: str = 'nnUNetTrainer',
+                   plans_identifier: str = 'nnUNetPlans',
+                   checkpoint_name: str = 'checkpoint_final.pth',
+                   export_validation_probabilities: bool = False,
+                   num_parts: int = 1,
+                   part_id: int = 0,
+                   tile_batch_size: int = 1,
+                   num_processes_export: int = default_num_processes,
+                   device: torch.device = torch.device('cuda')):
+    """
+    Runs the final validation of a finished training as a separate job. This is the same as nnUNetv2_train --val but
+    can be split into several jobs (num_parts/part_id, one per GPU for example) and predicts tile_batch_size tiles at
+    once. Use nnUNetv2_train --skip_val to not run the validation at the end of the training.
+    """
+    if isinstance(fold, str) and fold != 'all':
+        fold = int(fold)
+    assert 0 <= part_id < num_parts, f'part_id must be in [0, num_parts). Got part_id={part_id}, num_parts={num_parts}'
+
+    nnunet_trainer = get_trainer_from_args(str(dataset_name_or_id), configuration, fold, trainer_class_name,
+                                           plans_identifier, device=device)
+    expected_checkpoint_file = join(nnunet_trainer.output_folder, checkpoint_name)
+    if not isfile(expected_checkpoint_file):
+        raise RuntimeError(f"Cannot run validation because the checkpoint {expected_checkpoint_file} does not exist. "
+                           f"Is the training finished?")
+    nnunet_trainer.load_checkpoint(expected_checkpoint_file)
+
+    if torch.cuda.is_available():
+        cudnn.deterministic = False
+        cudnn.benchmark = True
+
+    nnunet_trainer.validation_tile_batch_size = tile_batch_size
+    nnunet_trainer.perform_actual_validation(export_validation_probabilities, num_parts=num_parts, part_id=part_id,
+                                             num_processes_export=num_processes_export)
+
+
+def run_validation_entry():
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs the final validation of a trained model (fold) as a separate '
+                                                 'job.')
+    parser.add_argument('dataset_name_or_id', type=str,
+                        help="Dataset name or ID")
+    parser.add_argument('configuration', type=str,
+                        help="Configuration")
+    parser.add_argument('fold', type=str,
+                        help='Fold of the 5-fold cross-validation. Should be an int between 0 and 4.')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='[OPTIONAL] Trainer class name. Default: nnUNetTrainer')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='[OPTIONAL] Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='[OPTIONAL] Name of the checkpoint to use. Default: checkpoint_final.pth')
+    parser.add_argument('--npz', action='store_true', required=False,
+                        help='[OPTIONAL] Save softmax predictions as npz files (in addition to predicted '
+                             'segmentations). Needed for finding the best ensemble.')
+    parser.add_argument('-num_parts', type=int, required=False, default=1,
+                        help='[OPTIONAL] Number of separate jobs the validation is split into. Default: 1')
+    parser.add_argument('-part_id', type=int, required=False, default=0,
+                        help='[OPTIONAL] Which part this job is (0 to num_parts - 1). The part that finishes last '
+                             'computes the metrics. Default: 0')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='[OPTIONAL] Number of sliding window tiles predicted at once. Larger values use the GPU '
+                             'better but need more VRAM. Default: 1')
+    parser.add_argument('-npp', type=int, required=False, default=default_num_processes,
+                        help=f'[OPTIONAL] Number of processes used for exporting the predictions. '
+                             f'Default: {default_num_processes}')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the validation should run with. Available options are "
+                             "'cuda' (GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
+                             "Use CUDA_VISIBLE_DEVICES=X nnUNetv2_validate [...] instead!")
+    args = parser.parse_args()
+
+    assert args.device in ['cpu', 'cuda', 'mps'], f'-device must be either cpu, mps or cuda. Other devices are not ' \
+                                                  f'tested/supported. Got: {args.device}.'
+    if args.device == 'cpu':
+        import multiprocessing
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    run_validation(args.dataset_name_or_id, args.configuration, args.fold, args.tr, args.p, args.chk, args.npz,
+                   args.num_parts, args.part_id, args.tile_batch_size, args.npp, device=device)
+
+
+if __name__ == '__main__':
+    run_validation_entry()
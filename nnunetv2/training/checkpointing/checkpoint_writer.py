@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Any, Union
+
+import torch
+
+
+def snapshot_to_cpu(obj: Any) -> Any:
+    """
+    Returns a copy of obj in which all tensors are detached copies on the CPU. Everything else is deepcopied. The
+    result no longer shares memory with the training state, so training can continue while it is being written.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        ret = obj.__class__((k, snapshot_to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # state dicts of nn.Modules carry version information that load_state_dict needs
+            ret._metadata = deepcopy(obj._metadata)
+        return ret
+    elif isinstance(obj, list):
+        return [snapshot_to_cpu(i) for i in obj]
+    elif isinstance(obj, tuple):
+        return tuple(snapshot_to_cpu(i) for i in obj)
+    else:
+        return deepcopy(obj)
+
+
+def atomic_torch_save(obj: Any, filename: str) -> None:
+    """
+    torch.save to a temporary file in the same folder, then rename. If we get killed while writing, filename is
+    either the old or the new checkpoint but never a truncated one.
+    """
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
+
+
+class AsyncCheckpointWriter(object):
+    def __init__(self):
+        """
+        Writes checkpoints in a background thread so that training does not wait for (potentially slow, network)
+        file systems. Checkpoints must be snapshotted (see snapshot_to_cpu) before they are submitted.
+
+        If a checkpoint is submitted for a file that still has a pending (not yet started) write, the pending one is
+        replaced. That way a quick succession of new best checkpoints only results in the last one being written.
+
+        Errors in the background thread are raised on the next call to submit or wait.
+        """
+        self._pending = OrderedDict()
+        self._busy = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+                filename, checkpoint = self._pending.popitem(last=False)
+                self._busy = True
+            try:
+                atomic_torch_save(checkpoint, filename)
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+            finally:
+                del checkpoint
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _maybe_raise(self):
+        # must be called with self._condition held
+        if self._error is not None:
+            e = self._error
+            self._error = None
+            raise RuntimeError('Writing a checkpoint in the background failed') from e
+
+    def submit(self, checkpoint: dict, filename: str) -> None:
+        with self._condition:
+            self._maybe_raise()
+            self._pending.pop(filename, None)
+            self._pending[filename] = checkpoint
+            self._condition.notify_all()
+
+    def wait(self, timeout: Union[float, None] = None) -> None:
+        """
+        Blocks until all submitted checkpoints are written
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._pending) == 0 and not self._busy, timeout)
+            self._maybe_raise()
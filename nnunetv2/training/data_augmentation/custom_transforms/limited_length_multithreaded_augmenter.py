@@ -8,3 +8,14 @@ class LimitedLenWrapper(NonDetMultiThreadedAugmenter):
 
     def __len__(self):
         return self.len
+
+    def reconfigure(self, num_processes: int, num_cached: int):
+        """
+        Restarts the background workers with a different number of processes and queue depth. Batches that are
+        currently in the queue are discarded
+        """
+        self._finish()
+        self.num_processes = num_processes
+        self.num_cached = num_cached
+        self.seeds = [None] * num_processes
+        self._start()
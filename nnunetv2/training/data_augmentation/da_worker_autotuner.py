@@ -0,0 +1,143 @@
+import os
+import socket
+from time import time
+from typing import Callable
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import isfile, load_json, save_json
+
+
+def get_num_cached_for_num_processes(num_processes: int) -> int:
+    # 12 processes -> 6 cached batches, which is what we have always used for training
+    return max(3, int(np.ceil(num_processes / 2)))
+
+
+def get_autotuning_key(trainer_name: str, plans_name: str, configuration_name: str, num_gpus: int) -> str:
+    return f'{socket.gethostname()}__{os.cpu_count()}cpus__{num_gpus}gpus__{trainer_name}__{plans_name}__' \
+           f'{configuration_name}'
+
+
+class DAWorkerAutoTuner(object):
+    def __init__(self, results_file: str, key: str, num_processes: int, max_num_processes: int,
+                 log_fn: Callable = print, max_tuning_epochs: int = 10, skip_iterations: int = 10,
+                 starved_threshold: float = 0.05, idle_threshold: float = 0.01, persist: bool = True):
+        """
+        Finds the number of data augmentation processes (and the depth of the queue they write to) for the training
+        dataloader. We measure how much of each training iteration is spent waiting for the next batch. If that
+        fraction is above starved_threshold we add workers. If it is below idle_threshold we try to remove some so
+        that we don't hog CPUs we don't need. Once we have settled (or after max_tuning_epochs) the result is stored
+        in results_file under key (machine + configuration, see get_autotuning_key) and reused by the next training.
+
+        Changes are only applied at the end of an epoch. The first skip_iterations iterations of each epoch are not
+        used for the measurement because the queue needs to fill up after a restart of the workers.
+        """
+        self.results_file = results_file
+        self.key = key
+        self.max_num_processes = max(1, max_num_processes)
+        self.log_fn = log_fn
+        self.max_tuning_epochs = max_tuning_epochs
+        self.skip_iterations = skip_iterations
+        self.starved_threshold = starved_threshold
+        self.idle_threshold = idle_threshold
+        self.persist = persist
+
+        self.num_processes = min(max(1, num_processes), self.max_num_processes)
+        self.num_cached = get_num_cached_for_num_processes(self.num_processes)
+        self.converged = False
+
+        stored = load_json(results_file) if isfile(results_file) else {}
+        if key in stored.keys():
+            self.num_processes = stored[key]['num_processes']
+            self.num_cached = stored[key]['num_cached']
+            self.converged = True
+            self.log_fn(f'DA auto tuning: using stored result for {key}: {self.num_processes} processes, '
+                        f'{self.num_cached} cached batches')
+        else:
+            self.log_fn(f'DA auto tuning: starting with {self.num_processes} processes, {self.num_cached} cached '
+                        f'batches')
+
+        self._wait_times = []
+        self._step_times = []
+        self._epochs_tuned = 0
+        # 'grow' or 'shrink'. We never change direction, that would just oscillate
+        self._direction = None
+        self._last_good = None
+        self.history = []
+
+    def record(self, wait_time: float, step_time: float) -> None:
+        if not self.converged:
+            self._wait_times.append(wait_time)
+            self._step_times.append(step_time)
+
+    def on_epoch_end(self, dataloader) -> None:
+        """
+        dataloader must be the LimitedLenWrapper used for training. It will be reconfigured if needed
+        """
+        if self.converged:
+            return
+        wait_times = self._wait_times[self.skip_iterations:]
+        step_times = self._step_times[self.skip_iterations:]
+        self._wait_times = []
+        self._step_times = []
+        if len(wait_times) == 0:
+            return
+        self._epochs_tuned += 1
+
+        wait_fraction = sum(wait_times) / (sum(wait_times) + sum(step_times))
+        self.history.append((self.num_processes, self.num_cached, wait_fraction))
+        self.log_fn(f'DA auto tuning: {self.num_processes} processes, {self.num_cached} cached batches. Mean wait for '
+                    f'batch: {np.round(np.mean(wait_times) * 1000, decimals=1)} ms, mean step: '
+                    f'{np.round(np.mean(step_times) * 1000, decimals=1)} ms ({np.round(wait_fraction * 100, 1)} % '
+                    f'waiting)')
+
+        new_num_processes = self.num_processes
+        if wait_fraction > self.starved_threshold:
+            if self._direction == 'shrink':
+                # we removed one step too many
+                new_num_processes = self._last_good
+                self.converged = True
+            elif self.num_processes < self.max_num_processes:
+                self._direction = 'grow'
+                new_num_processes = min(self.max_num_processes,
+                                        max(self.num_processes + 1, int(round(self.num_processes * 1.5))))
+            else:
+                self.log_fn('DA auto tuning: the GPU is still waiting for data but we are already using all CPUs')
+                self.converged = True
+        elif wait_fraction < self.idle_threshold and self._direction != 'grow' and self.num_processes > 1:
+            self._direction = 'shrink'
+            self._last_good = self.num_processes
+            new_num_processes = max(1, self.num_processes - max(1, self.num_processes // 4))
+        else:
+            self.converged = True
+
+        if not self.converged and self._epochs_tuned >= self.max_tuning_epochs:
+            # out of time. Growing is always safe, shrinking without measuring the result is not
+            if self._direction == 'shrink':
+                new_num_processes = self._last_good
+            self.converged = True
+
+        if new_num_processes != self.num_processes:
+            self.num_processes = new_num_processes
+            self.num_cached = get_num_cached_for_num_processes(new_num_processes)
+            dataloader.reconfigure(self.num_processes, self.num_cached)
+
+        if self.converged:
+            self.log_fn(f'DA auto tuning done: {self.num_processes} processes, {self.num_cached} cached batches')
+            if self.persist:
+                self._save()
+        else:
+            self.log_fn(f'DA auto tuning: next epoch uses {self.num_processes} processes, {self.num_cached} cached '
+                        f'batches')
+
+    def _save(self) -> None:
+        # other trainings (folds) may write to the same file. Read as late as possible and replace atomically
+        stored = load_json(self.results_file) if isfile(self.results_file) else {}
+        stored[self.key] = {
+            'num_processes': self.num_processes,
+            'num_cached': self.num_cached,
+            'history': [list(i) for i in self.history],
+            'timestamp': time()
+        }
+        tmp_file = self.results_file + f'.{os.getpid()}.tmp'
+        save_json(stored, tmp_file)
+        os.replace(tmp_file, self.results_file)
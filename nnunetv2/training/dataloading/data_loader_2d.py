@@ -15,7 +15,7 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
             # oversampling foreground will improve stability of model training, especially if many patches are empty
             # (Lung for example)
             force_fg = self.get_do_oversample(j)
-            data, seg, properties = self._data.load_case(current_key)
+            properties = self._data.load_properties(current_key)
             case_properties.append(properties)
 
             # select a class/region first, then a slice where this class is present, then crop to that area
@@ -38,24 +38,47 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
 
                 selected_class_or_region = eligible_classes_or_regions[np.random.choice(len(eligible_classes_or_regions))] if \
                     len(eligible_classes_or_regions) > 0 else None
-            if selected_class_or_region is not None:
-                selected_slice = np.random.choice(properties['class_locations'][selected_class_or_region][:, 1])
-            else:
-                selected_slice = np.random.choice(len(data[0]))
 
-            data = data[:, selected_slice]
-            seg = seg[:, selected_slice]
+            # 2d preprocessing stores a slice index (see build_slice_index). With it we only need to read the selected
+            # slice. Data that was preprocessed without it needs to be loaded entirely
+            slice_index = properties.get('slice_index')
+            if slice_index is None:
+                data, seg, _ = self._data.load_case(current_key)
+                num_slices = data.shape[1]
+            else:
+                data = seg = None
+                num_slices = slice_index['num_slices']
 
             # the line of death lol
-            # this needs to be a separate variable because we could otherwise permanently overwrite
+            # class_locations needs to be a separate variable because we could otherwise permanently overwrite
             # properties['class_locations']
             # selected_class_or_region is:
             # - None if we do not have an ignore label and force_fg is False OR if force_fg is True but there is no foreground in the image
             # - A tuple of all (non-ignore) labels if there is an ignore label and force_fg is False
             # - a class or region if force_fg is True
-            class_locations = {
-                selected_class_or_region: properties['class_locations'][selected_class_or_region][properties['class_locations'][selected_class_or_region][:, 1] == selected_slice][:, (0, 2, 3)]
-            } if (selected_class_or_region is not None) else None
+            if selected_class_or_region is not None:
+                locations = properties['class_locations'][selected_class_or_region]
+                if slice_index is not None:
+                    # locations are sorted by slice. We draw a random location (and not a random slice) so that
+                    # slices with more foreground are more likely to be selected, just like in the unindexed case
+                    slice_ids, ptr = slice_index['slice_ptr'][selected_class_or_region]
+                    s = np.searchsorted(ptr, np.random.choice(len(locations)), side='right') - 1
+                    selected_slice = slice_ids[s]
+                    class_locations = {selected_class_or_region: locations[ptr[s]:ptr[s + 1]][:, (0, 2, 3)]}
+                else:
+                    selected_slice = np.random.choice(locations[:, 1])
+                    class_locations = {
+                        selected_class_or_region: locations[locations[:, 1] == selected_slice][:, (0, 2, 3)]
+                    }
+            else:
+                selected_slice = np.random.choice(num_slices)
+                class_locations = None
+
+            if data is None:
+                data, seg = self._data.load_slice(current_key, selected_slice)
+            else:
+                data = data[:, selected_slice]
+                seg = seg[:, selected_slice]
 
             # print(properties)
             shape = data.shape[1:]
@@ -5,13 +5,15 @@ import numpy as np
 import shutil
 
 from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, isfile
-from nnunetv2.training.dataloading.utils import get_case_identifiers
+from nnunetv2.training.dataloading.shared_memory_cache import SharedMemoryDatasetCache
+from nnunetv2.training.dataloading.utils import get_case_identifiers, load_array_from_npz, load_slice_from_npz
 
 
 class nnUNetDataset(object):
     def __init__(self, folder: str, case_identifiers: List[str] = None,
                  num_images_properties_loading_threshold: int = 0,
-                 folder_with_segs_from_previous_stage: str = None):
+                 folder_with_segs_from_previous_stage: str = None,
+                 shared_memory_cache: SharedMemoryDatasetCache = None):
         """
         This does not actually load the dataset. It merely creates a dictionary where the keys are training case names and
         the values are dictionaries containing the relevant information for that case.
@@ -29,6 +31,9 @@ class nnUNetDataset(object):
         If properties are loaded into the RAM, the info dicts each will have an additional entry:
         - dataset[case_identifier]['properties'] -> pkl file content
 
+        If a shared_memory_cache is given, load_case will first look for the case in there and put cases that are not
+        yet present into it (see SharedMemoryDatasetCache). The arrays returned by load_case are then read-only.
+
         IMPORTANT! THIS CLASS ITSELF IS READ-ONLY. YOU CANNOT ADD KEY:VALUE PAIRS WITH nnUNetDataset[key] = value
         USE THIS INSTEAD:
         nnUNetDataset.dataset[key] = value
@@ -55,6 +60,7 @@ class nnUNetDataset(object):
         self.keep_files_open = ('nnUNet_keep_files_open' in os.environ.keys()) and \
                                (os.environ['nnUNet_keep_files_open'].lower() in ('true', '1', 't'))
         # print(f'nnUNetDataset.keep_files_open: {self.keep_files_open}')
+        self.shared_memory_cache = shared_memory_cache
 
     def __getitem__(self, key):
         ret = {**self.dataset[key]}
@@ -78,6 +84,16 @@ class nnUNetDataset(object):
         return self.dataset.values()
 
     def load_case(self, key):
+        if self.shared_memory_cache is not None:
+            cached = self.shared_memory_cache.get(key)
+            if cached is not None:
+                return cached
+            data, seg, properties = self._load_case_from_disk(key)
+            self.shared_memory_cache.put(key, data, seg, properties)
+            return data, seg, properties
+        return self._load_case_from_disk(key)
+
+    def _load_case_from_disk(self, key):
         entry = self[key]
         if 'open_data_file' in entry.keys():
             data = entry['open_data_file']
@@ -88,7 +104,7 @@ class nnUNetDataset(object):
                 self.dataset[key]['open_data_file'] = data
                 # print('saving open data file')
         else:
-            data = np.load(entry['data_file'])['data']
+            data = load_array_from_npz(entry['data_file'], 'data')
 
         if 'open_seg_file' in entry.keys():
             seg = entry['open_seg_file']
@@ -99,7 +115,7 @@ class nnUNetDataset(object):
                 self.dataset[key]['open_seg_file'] = seg
                 # print('saving open seg file')
         else:
-            seg = np.load(entry['data_file'])['seg']
+            seg = load_array_from_npz(entry['data_file'], 'seg')
 
         if 'seg_from_prev_stage_file' in entry.keys():
             if isfile(entry['seg_from_prev_stage_file'][:-4] + ".npy"):
@@ -110,6 +126,48 @@ class nnUNetDataset(object):
 
         return data, seg, entry['properties']
 
+    def load_properties(self, key):
+        if self.shared_memory_cache is not None:
+            cached = self.shared_memory_cache.get(key)
+            if cached is not None:
+                return cached[2]
+        return self[key]['properties']
+
+    def load_slice(self, key, slice_idx: int):
+        """
+        returns data[:, slice_idx], seg[:, slice_idx] of the case. Unlike load_case this does not need to read the
+        entire volume: unpacked npy files are memory mapped and npz files written by 2d preprocessing (see
+        save_slice_indexed_case) only decompress the requested slice.
+        """
+        entry = self.dataset[key]
+        if self.shared_memory_cache is not None or 'seg_from_prev_stage_file' in entry.keys():
+            # the cache needs the entire case anyway. Cascades are not a thing in 2d, so we don't optimize for them
+            data, seg, _ = self.load_case(key)
+            return data[:, slice_idx], seg[:, slice_idx]
+
+        npz = None
+        if 'open_data_file' in entry.keys():
+            data = entry['open_data_file'][:, slice_idx]
+        elif isfile(entry['data_file'][:-4] + ".npy"):
+            data_file = np.load(entry['data_file'][:-4] + ".npy", 'r')
+            if self.keep_files_open:
+                self.dataset[key]['open_data_file'] = data_file
+            data = data_file[:, slice_idx]
+        else:
+            npz = np.load(entry['data_file'])
+            data = load_slice_from_npz(npz, 'data', slice_idx)
+
+        if 'open_seg_file' in entry.keys():
+            seg = entry['open_seg_file'][:, slice_idx]
+        elif isfile(entry['data_file'][:-4] + "_seg.npy"):
+            seg_file = np.load(entry['data_file'][:-4] + "_seg.npy", 'r')
+            if self.keep_files_open:
+                self.dataset[key]['open_seg_file'] = seg_file
+            seg = seg_file[:, slice_idx]
+        else:
+            seg = load_slice_from_npz(npz if npz is not None else entry['data_file'], 'seg', slice_idx)
+        return data, seg
+
 
 if __name__ == '__main__':
     # this is a mini test. Todo: We can move this to tests in the future (requires simulated dataset)
@@ -0,0 +1,211 @@
+import multiprocessing
+import os
+import pickle
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from time import time
+from typing import Tuple, Union
+
+import numpy as np
+
+
+def get_shared_memory_cache_budget_from_env() -> int:
+    """
+    Returns the budget (in bytes) of the shared memory dataset cache as requested by the environment variable
+    nnUNet_shared_memory_cache_gb. 0 means that the cache is disabled (this is the default).
+    """
+    if 'nnUNet_shared_memory_cache_gb' not in os.environ.keys():
+        return 0
+    return max(0, int(float(os.environ['nnUNet_shared_memory_cache_gb']) * 1024 ** 3))
+
+
+def _aligned(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _try_close(shm: shared_memory.SharedMemory) -> bool:
+    # closing fails if there are still arrays around that point into the buffer
+    try:
+        shm.close()
+        return True
+    except BufferError:
+        return False
+
+
+class SharedMemoryDatasetCache(object):
+    def __init__(self, budget_in_bytes: int):
+        """
+        RAM cache for preprocessed training cases that is shared between all data augmentation workers (training
+        and validation). Each case (data, seg and the pickled properties including class_locations) is stored in one
+        POSIX shared memory block. The first process that needs a case loads it from disk and puts it into the
+        cache, all other processes attach to the existing block without copying anything.
+
+        The total size of all blocks is limited to budget_in_bytes. If a new case does not fit we evict the cases
+        that were sampled least recently. Processes that are still holding an evicted case keep their mapping
+        alive until they are done with it, so eviction is always safe.
+
+        The instance must be created in the main process BEFORE the data augmentation workers are started. The main
+        process owns all blocks and must call close() at the end (the trainer does that in on_train_end).
+
+        The arrays returned by get() are read-only views into shared memory. Do not attempt to modify them.
+        """
+        self.budget_in_bytes = budget_in_bytes
+        self.namespace = f'nnUNet_{os.getpid()}_{uuid.uuid4().hex[:8]}'
+        self._owner_pid = os.getpid()
+
+        # all workers must share our resource tracker. If each of them started their own, that tracker would unlink
+        # the blocks created by that worker as soon as it exits (it would consider them leaked). With a shared tracker
+        # blocks only get cleaned up automatically if the main process dies without calling close()
+        resource_tracker.ensure_running()
+
+        self._manager = multiprocessing.Manager()
+        # key -> (shm_name, data_shape, data_dtype, seg_shape, seg_dtype, seg_offset, properties_offset,
+        # properties_nbytes, total_nbytes)
+        self._index = self._manager.dict()
+        # key -> timestamp of the last time this case was sampled. Needed for least-recently-sampled eviction
+        self._last_access = self._manager.dict()
+        self._lock = multiprocessing.Lock()
+
+        # process local: shm_name -> SharedMemory. This is what keeps the attached mappings alive
+        self._attached = {}
+        # process local: handles of evicted blocks that could not be closed yet because arrays still use them
+        self._retired = []
+        self._attached_pid = os.getpid()
+
+    def __getstate__(self):
+        # the manager itself cannot be pickled (and workers don't need it). Proxies and lock are fine to pass on
+        # when the workers are started
+        state = self.__dict__.copy()
+        state['_manager'] = None
+        state['_attached'] = {}
+        state['_retired'] = []
+        return state
+
+    def _get_attached(self):
+        # forked workers inherit our dict of attached blocks. They need their own handles
+        if self._attached_pid != os.getpid():
+            self._attached = {}
+            self._retired = []
+            self._attached_pid = os.getpid()
+        return self._attached
+
+    def _release_stale_handles(self) -> None:
+        # blocks that were evicted by other processes stay mapped in this process until we close them
+        attached = self._get_attached()
+        valid_names = set([i[0] for i in self._index.values()])
+        for shm_name in [i for i in attached.keys() if i not in valid_names]:
+            self._retired.append(attached.pop(shm_name))
+        self._retired = [i for i in self._retired if not _try_close(i)]
+
+    @property
+    def used_bytes(self) -> int:
+        return sum([i[-1] for i in self._index.values()])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def get(self, key: str) -> Union[None, Tuple[np.ndarray, np.ndarray, dict]]:
+        """
+        returns (data, seg, properties) or None if the case is not in the cache
+        """
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        shm_name, data_shape, data_dtype, seg_shape, seg_dtype, seg_offset, properties_offset, properties_nbytes, \
+            _ = entry
+
+        attached = self._get_attached()
+        if shm_name not in attached.keys():
+            self._release_stale_handles()
+            try:
+                attached[shm_name] = shared_memory.SharedMemory(name=shm_name, create=False)
+            except FileNotFoundError:
+                # evicted by some other process between reading the index and attaching
+                return None
+        shm = attached[shm_name]
+        self._last_access[key] = time()
+
+        data = np.ndarray(data_shape, dtype=data_dtype, buffer=shm.buf, offset=0)
+        seg = np.ndarray(seg_shape, dtype=seg_dtype, buffer=shm.buf, offset=seg_offset)
+        data.flags.writeable = False
+        seg.flags.writeable = False
+        properties = pickle.loads(shm.buf[properties_offset:properties_offset + properties_nbytes])
+        return data, seg, properties
+
+    def put(self, key: str, data: np.ndarray, seg: np.ndarray, properties: dict) -> bool:
+        """
+        Adds a case to the cache. Returns False if the case could not be added because it is larger than the entire
+        budget. Adding a case that is already present is a no-op.
+        """
+        if key in self._index:
+            return True
+        properties_bytes = pickle.dumps(properties, protocol=pickle.HIGHEST_PROTOCOL)
+        seg_offset = _aligned(data.nbytes)
+        properties_offset = _aligned(seg_offset + seg.nbytes)
+        total_nbytes = properties_offset + len(properties_bytes)
+        if total_nbytes > self.budget_in_bytes:
+            return False
+
+        # copying happens outside the lock so that other workers are not blocked by us
+        shm_name = f'{self.namespace}_{uuid.uuid4().hex[:12]}'
+        shm = shared_memory.SharedMemory(name=shm_name, create=True, size=max(1, total_nbytes))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf, offset=0)[:] = data
+        np.ndarray(seg.shape, dtype=seg.dtype, buffer=shm.buf, offset=seg_offset)[:] = seg
+        shm.buf[properties_offset:total_nbytes] = properties_bytes
+
+        with self._lock:
+            if key in self._index:
+                # some other worker was faster
+                shm.close()
+                shm.unlink()
+                return True
+            self._evict_until_fits(total_nbytes)
+            self._index[key] = (shm_name, data.shape, data.dtype.str, seg.shape, seg.dtype.str, seg_offset,
+                                properties_offset, len(properties_bytes), total_nbytes)
+            self._last_access[key] = time()
+        self._get_attached()[shm_name] = shm
+        return True
+
+    def _evict_until_fits(self, nbytes: int) -> None:
+        # must be called with self._lock held
+        index = self._index.copy()
+        used = sum([i[-1] for i in index.values()])
+        if used + nbytes <= self.budget_in_bytes:
+            return
+        last_access = self._last_access.copy()
+        for k in sorted(index.keys(), key=lambda x: last_access.get(x, 0)):
+            self._remove(k, index[k][0])
+            used -= index[k][-1]
+            if used + nbytes <= self.budget_in_bytes:
+                break
+
+    def _remove(self, key: str, shm_name: str) -> None:
+        self._index.pop(key, None)
+        self._last_access.pop(key, None)
+        attached = self._get_attached()
+        shm = attached.pop(shm_name, None)
+        try:
+            if shm is None:
+                shm = shared_memory.SharedMemory(name=shm_name, create=False)
+            shm.unlink()
+        except FileNotFoundError:
+            return
+        # unlinking only removes the name. The memory is released once the last process has closed its handle
+        if not _try_close(shm):
+            self._retired.append(shm)
+
+    def close(self) -> None:
+        """
+        Frees all shared memory. Only the owner (the process that created this object) is allowed to do that
+        """
+        if os.getpid() != self._owner_pid or self._manager is None:
+            return
+        with self._lock:
+            for k, v in self._index.copy().items():
+                self._remove(k, v[0])
+        for shm in list(self._get_attached().values()) + self._retired:
+            _try_close(shm)
+        self._attached = {}
+        self._retired = []
+        self._manager.shutdown()
+        self._manager = None
@@ -1,20 +1,77 @@
 import multiprocessing
 import os
 from multiprocessing import Pool
-from typing import List
+from typing import List, Union
 
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import isfile, subfiles
 from nnunetv2.configuration import default_num_processes
 
 
+def save_slice_indexed_case(output_file: str, data: np.ndarray, seg: np.ndarray) -> None:
+    """
+    Used for 2d configurations. Instead of one 'data' and one 'seg' array we store each slice (axis 1) as a separate
+    (compressed) member of the npz file. The 2d dataloader can then read (and decompress) exactly the slice it needs
+    instead of the entire volume. Use load_array_from_npz/load_slice_from_npz to read these files.
+    """
+    assert data.shape[1] == seg.shape[1]
+    arrays = {'num_slices': np.array(data.shape[1])}
+    for i in range(data.shape[1]):
+        arrays[f'data_{i}'] = data[:, i]
+        arrays[f'seg_{i}'] = seg[:, i]
+    np.savez_compressed(output_file, **arrays)
+
+
+def load_array_from_npz(npz: Union[str, np.lib.npyio.NpzFile], key: str) -> np.ndarray:
+    """
+    key is 'data' or 'seg'. Works with both the regular and the slice indexed (see save_slice_indexed_case) layout
+    """
+    if isinstance(npz, str):
+        npz = np.load(npz)
+    if key in npz.files:
+        return npz[key]
+    return np.stack([npz[f'{key}_{i}'] for i in range(int(npz['num_slices']))], axis=1)
+
+
+def load_slice_from_npz(npz: Union[str, np.lib.npyio.NpzFile], key: str, slice_idx: int) -> np.ndarray:
+    """
+    Returns array[:, slice_idx] of the requested key ('data' or 'seg'). Only decompresses that slice if the file uses
+    the slice indexed layout.
+    """
+    if isinstance(npz, str):
+        npz = np.load(npz)
+    if key in npz.files:
+        return npz[key][:, slice_idx]
+    return npz[f'{key}_{slice_idx}']
+
+
+def build_slice_index(class_locations: dict, num_slices: int) -> dict:
+    """
+    Sorts the class_locations of each class/region by slice (IN PLACE!) and returns an index that lets the 2d
+    dataloader find all locations of a given slice without scanning the entire list:
+    slice_index['slice_ptr'][k] = (slice_ids, ptr) where the locations of slice slice_ids[j] are
+    class_locations[k][ptr[j]:ptr[j + 1]]
+    """
+    slice_ptr = {}
+    for k in class_locations.keys():
+        locs = class_locations[k]
+        if len(locs) == 0:
+            slice_ptr[k] = (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64))
+            continue
+        locs = locs[np.argsort(locs[:, 1], kind='stable')]
+        class_locations[k] = locs
+        slice_ids, starts = np.unique(locs[:, 1], return_index=True)
+        slice_ptr[k] = (slice_ids, np.append(starts, len(locs)))
+    return {'num_slices': num_slices, 'slice_ptr': slice_ptr}
+
+
 def _convert_to_npy(npz_file: str, unpack_segmentation: bool = True, overwrite_existing: bool = False) -> None:
     try:
         a = np.load(npz_file)  # inexpensive, no compression is done here. This just reads metadata
         if overwrite_existing or not isfile(npz_file[:-3] + "npy"):
-            np.save(npz_file[:-3] + "npy", a['data'])
+            np.save(npz_file[:-3] + "npy", load_array_from_npz(a, 'data'))
         if unpack_segmentation and (overwrite_existing or not isfile(npz_file[:-4] + "_seg.npy")):
-            np.save(npz_file[:-4] + "_seg.npy", a['seg'])
+            np.save(npz_file[:-4] + "_seg.npy", load_array_from_npz(a, 'seg'))
     except KeyboardInterrupt:
         if isfile(npz_file[:-3] + "npy"):
             os.remove(npz_file[:-3] + "npy")
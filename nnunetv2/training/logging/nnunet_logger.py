@@ -1,4 +1,10 @@
+import json
+import multiprocessing
+from queue import Empty
+from time import time
+
 import matplotlib
+import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import join
 
 matplotlib.use('agg')
@@ -6,6 +12,73 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 
 
+def render_progress_png(my_fantastic_logging: dict, output_folder: str):
+    # we infer the epoch form our internal logging
+    epoch = min([len(i) for i in my_fantastic_logging.values()]) - 1  # lists of epoch 0 have len 1
+    sns.set(font_scale=2.5)
+    fig, ax_all = plt.subplots(3, 1, figsize=(30, 54))
+    # regular progress.png as we are used to from previous nnU-Net versions
+    ax = ax_all[0]
+    ax2 = ax.twinx()
+    x_values = list(range(epoch + 1))
+    ax.plot(x_values, my_fantastic_logging['train_losses'][:epoch + 1], color='b', ls='-', label="loss_tr", linewidth=4)
+    ax.plot(x_values, my_fantastic_logging['val_losses'][:epoch + 1], color='r', ls='-', label="loss_val", linewidth=4)
+    ax2.plot(x_values, my_fantastic_logging['mean_fg_dice'][:epoch + 1], color='g', ls='dotted', label="pseudo dice",
+             linewidth=3)
+    ax2.plot(x_values, my_fantastic_logging['ema_fg_dice'][:epoch + 1], color='g', ls='-', label="pseudo dice (mov. avg.)",
+             linewidth=4)
+    ax.set_xlabel("epoch")
+    ax.set_ylabel("loss")
+    ax2.set_ylabel("pseudo dice")
+    ax.legend(loc=(0, 1))
+    ax2.legend(loc=(0.2, 1))
+
+    # epoch times to see whether the training speed is consistent (inconsistent means there are other jobs
+    # clogging up the system)
+    ax = ax_all[1]
+    ax.plot(x_values, [i - j for i, j in zip(my_fantastic_logging['epoch_end_timestamps'][:epoch + 1],
+                                             my_fantastic_logging['epoch_start_timestamps'])][:epoch + 1], color='b',
+            ls='-', label="epoch duration", linewidth=4)
+    ylim = [0] + [ax.get_ylim()[1]]
+    ax.set(ylim=ylim)
+    ax.set_xlabel("epoch")
+    ax.set_ylabel("time [s]")
+    ax.legend(loc=(0, 1))
+
+    # learning rate
+    ax = ax_all[2]
+    ax.plot(x_values, my_fantastic_logging['lrs'][:epoch + 1], color='b', ls='-', label="learning rate", linewidth=4)
+    ax.set_xlabel("epoch")
+    ax.set_ylabel("learning rate")
+    ax.legend(loc=(0, 1))
+
+    plt.tight_layout()
+
+    fig.savefig(join(output_folder, "progress.png"))
+    plt.close()
+
+
+def _progress_plot_worker(queue: multiprocessing.Queue):
+    # renders progress.png for whatever the most recent request is. Requests that arrive while we are busy rendering
+    # are coalesced. None means: render what's left, then exit
+    while True:
+        items = [queue.get()]
+        while True:
+            try:
+                items.append(queue.get_nowait())
+            except Empty:
+                break
+        stop = any([i is None for i in items])
+        plot_requests = [i for i in items if i is not None]
+        if len(plot_requests) > 0:
+            try:
+                render_progress_png(*plot_requests[-1])
+            except Exception as e:
+                print('Unable to plot progress.png:', e)
+        if stop:
+            return
+
+
 class nnUNetLogger(object):
     """
     This class is really trivial. Don't expect cool functionality here. This is my makeshift solution to problems
@@ -28,6 +101,14 @@ class nnUNetLogger(object):
         self.verbose = verbose
         # shut up, this logging is great
 
+        # throttling of plot_progress_png_in_background
+        self.min_epochs_between_plots = 1
+        self.min_seconds_between_plots = 30
+        self._last_plot_epoch = None
+        self._last_plot_time = None
+        self._plot_process = None
+        self._plot_queue = None
+
     def log(self, key, value, epoch: int):
         """
         sometimes shit gets messed up. We try to catch that here
@@ -52,49 +133,61 @@ class nnUNetLogger(object):
             self.log('ema_fg_dice', new_ema_pseudo_dice, epoch)
 
     def plot_progress_png(self, output_folder):
-        # we infer the epoch form our internal logging
-        epoch = min([len(i) for i in self.my_fantastic_logging.values()]) - 1  # lists of epoch 0 have len 1
-        sns.set(font_scale=2.5)
-        fig, ax_all = plt.subplots(3, 1, figsize=(30, 54))
-        # regular progress.png as we are used to from previous nnU-Net versions
-        ax = ax_all[0]
-        ax2 = ax.twinx()
-        x_values = list(range(epoch + 1))
-        ax.plot(x_values, self.my_fantastic_logging['train_losses'][:epoch + 1], color='b', ls='-', label="loss_tr", linewidth=4)
-        ax.plot(x_values, self.my_fantastic_logging['val_losses'][:epoch + 1], color='r', ls='-', label="loss_val", linewidth=4)
-        ax2.plot(x_values, self.my_fantastic_logging['mean_fg_dice'][:epoch + 1], color='g', ls='dotted', label="pseudo dice",
-                 linewidth=3)
-        ax2.plot(x_values, self.my_fantastic_logging['ema_fg_dice'][:epoch + 1], color='g', ls='-', label="pseudo dice (mov. avg.)",
-                 linewidth=4)
-        ax.set_xlabel("epoch")
-        ax.set_ylabel("loss")
-        ax2.set_ylabel("pseudo dice")
-        ax.legend(loc=(0, 1))
-        ax2.legend(loc=(0.2, 1))
-
-        # epoch times to see whether the training speed is consistent (inconsistent means there are other jobs
-        # clogging up the system)
-        ax = ax_all[1]
-        ax.plot(x_values, [i - j for i, j in zip(self.my_fantastic_logging['epoch_end_timestamps'][:epoch + 1],
-                                                 self.my_fantastic_logging['epoch_start_timestamps'])][:epoch + 1], color='b',
-                ls='-', label="epoch duration", linewidth=4)
-        ylim = [0] + [ax.get_ylim()[1]]
-        ax.set(ylim=ylim)
-        ax.set_xlabel("epoch")
-        ax.set_ylabel("time [s]")
-        ax.legend(loc=(0, 1))
-
-        # learning rate
-        ax = ax_all[2]
-        ax.plot(x_values, self.my_fantastic_logging['lrs'][:epoch + 1], color='b', ls='-', label="learning rate", linewidth=4)
-        ax.set_xlabel("epoch")
-        ax.set_ylabel("learning rate")
-        ax.legend(loc=(0, 1))
-
-        plt.tight_layout()
-
-        fig.savefig(join(output_folder, "progress.png"))
-        plt.close()
+        render_progress_png(self.my_fantastic_logging, output_folder)
+
+    def plot_progress_png_in_background(self, output_folder: str, force: bool = False):
+        """
+        Plotting takes a while. This hands the plotting over to a background process so that training can continue.
+        Renders are throttled: we only plot if at least min_epochs_between_plots epochs and min_seconds_between_plots
+        seconds have passed since the last plot (unless force=True). Call finish_plotting at the end of training to
+        make sure the last plot is written.
+        """
+        epoch = min([len(i) for i in self.my_fantastic_logging.values()]) - 1
+        if not force and self._last_plot_epoch is not None and \
+                (epoch - self._last_plot_epoch < self.min_epochs_between_plots or
+                 time() - self._last_plot_time < self.min_seconds_between_plots):
+            return
+        if self._plot_process is None or not self._plot_process.is_alive():
+            # spawn, because a forked process would inherit the CUDA context (and much more) of the trainer
+            ctx = multiprocessing.get_context('spawn')
+            self._plot_queue = ctx.Queue()
+            self._plot_process = ctx.Process(target=_progress_plot_worker, args=(self._plot_queue,), daemon=True)
+            self._plot_process.start()
+        # copy so that logging further values does not interfere with what is sent to the background process
+        self._plot_queue.put(({k: list(v) for k, v in self.my_fantastic_logging.items()}, output_folder))
+        self._last_plot_epoch = epoch
+        self._last_plot_time = time()
+
+    def finish_plotting(self, timeout: float = 300):
+        """
+        waits for the background process to render the outstanding plot (if any) and shuts it down
+        """
+        if self._plot_process is not None:
+            self._plot_queue.put(None)
+            self._plot_process.join(timeout)
+            if self._plot_process.is_alive():
+                self._plot_process.terminate()
+            self._plot_process = self._plot_queue = None
+
+    def get_epoch_record(self, epoch: int) -> dict:
+        """
+        All values logged for the given epoch as a flat, json serializable dict
+        """
+        record = {'epoch': epoch}
+        for k, v in self.my_fantastic_logging.items():
+            if len(v) > epoch:
+                value = v[epoch]
+                record[k] = [float(i) for i in value] if isinstance(value, (list, tuple, np.ndarray)) else float(value)
+        if 'epoch_start_timestamps' in record.keys() and 'epoch_end_timestamps' in record.keys():
+            record['epoch_time'] = record['epoch_end_timestamps'] - record['epoch_start_timestamps']
+        return record
+
+    def append_epoch_record_to_jsonl(self, filename: str, epoch: int):
+        """
+        Appends one line with all values of the given epoch to filename. Much easier to parse than the text log
+        """
+        with open(filename, 'a') as f:
+            f.write(json.dumps(self.get_epoch_record(epoch)) + "\n")
 
     def get_checkpoint(self):
         return self.my_fantastic_logging
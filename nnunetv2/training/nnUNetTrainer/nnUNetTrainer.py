@@ -1,9 +1,11 @@
+import hashlib
 import inspect
 import multiprocessing
 import os
 import shutil
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 from time import time, sleep
@@ -19,20 +21,25 @@ from batchgenerators.transforms.noise_transforms import GaussianNoiseTransform,
 from batchgenerators.transforms.resample_transforms import SimulateLowResolutionTransform
 from batchgenerators.transforms.spatial_transforms import SpatialTransform, MirrorTransform
 from batchgenerators.transforms.utility_transforms import RemoveLabelTransform, RenameTransform, NumpyToTensor
-from batchgenerators.utilities.file_and_folder_operations import join, load_json, isfile, save_json, maybe_mkdir_p
+from batchgenerators.utilities.file_and_folder_operations import join, load_json, isfile, save_json, maybe_mkdir_p, \
+    subfiles
 from torch._dynamo import OptimizedModule
 
 from nnunetv2.configuration import ANISO_THRESHOLD, default_num_processes
 from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder
-from nnunetv2.inference.export_prediction import export_prediction_from_logits, resample_and_save
+from nnunetv2.inference.export_prediction import export_prediction_from_logits, resample_and_save_for_next_stage, \
+    write_prediction_time_summary
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_results
+from nnunetv2.training.checkpointing.checkpoint_writer import AsyncCheckpointWriter, atomic_torch_save, \
+    snapshot_to_cpu
 from nnunetv2.training.data_augmentation.compute_initial_patch_size import get_patch_size
+from nnunetv2.training.data_augmentation.da_worker_autotuner import DAWorkerAutoTuner, get_autotuning_key
 from nnunetv2.training.data_augmentation.custom_transforms.cascade_transforms import MoveSegAsOneHotToData, \
     ApplyRandomBinaryOperatorTransform, RemoveRandomConnectedComponentFromOneHotEncodingTransform
 from nnunetv2.training.data_augmentation.custom_transforms.deep_supervision_donwsampling import \
-    DownsampleSegForDSTransform2
+    DownsampleSegForDSTransform2, downsample_seg_for_ds_torch
 from nnunetv2.training.data_augmentation.custom_transforms.limited_length_multithreaded_augmenter import \
     LimitedLenWrapper
 from nnunetv2.training.data_augmentation.custom_transforms.masking import MaskTransform
@@ -43,19 +50,25 @@ from nnunetv2.training.data_augmentation.custom_transforms.transforms_for_dummy_
 from nnunetv2.training.dataloading.data_loader_2d import nnUNetDataLoader2D
 from nnunetv2.training.dataloading.data_loader_3d import nnUNetDataLoader3D
 from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+from nnunetv2.training.dataloading.shared_memory_cache import SharedMemoryDatasetCache, \
+    get_shared_memory_cache_budget_from_env
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.logging.nnunet_logger import nnUNetLogger
 from nnunetv2.training.loss.compound_losses import DC_and_CE_loss, DC_and_BCE_loss
 from nnunetv2.training.loss.deep_supervision import DeepSupervisionWrapper
 from nnunetv2.training.loss.dice import get_tp_fp_fn_tn, MemoryEfficientSoftDiceLoss
 from nnunetv2.training.lr_scheduler.polylr import PolyLRScheduler
+from nnunetv2.training.profiling.training_profiler import TrainingProfiler, get_profiling_window_from_env
+from nnunetv2.utilities.activation_checkpointing import enable_activation_checkpointing
 from nnunetv2.utilities.collate_outputs import collate_outputs
-from nnunetv2.utilities.default_n_proc_DA import get_allowed_n_proc_DA
+from nnunetv2.utilities.default_n_proc_DA import get_allowed_n_proc_DA, autotuning_of_n_proc_DA_requested
 from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
 from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot, determine_num_input_channels
+from nnunetv2.utilities.output_encoding import PROBABILITY_FORMATS
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.results_store import store_lock
 from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
 
 import random
@@ -65,8 +78,10 @@ from torch import distributed as dist
 from torch.cuda import device_count
 from torch.cuda.amp import GradScaler
 from torch.nn.parallel import DistributedDataParallel as DDP
+from nnunetv2.utilities.find_class_by_name import register_class
 
 
+@register_class
 class nnUNetTrainer(object):
     def __init__(self, plans: dict, configuration: str, fold: int, dataset_json: dict, unpack_dataset: bool = True,
                  device: torch.device = torch.device('cuda')):
@@ -149,6 +164,18 @@ class nnUNetTrainer(object):
         self.num_val_iterations_per_epoch = 50
         self.num_epochs = 1000
         self.current_epoch = 0
+        # if True, the data augmentation workers only provide the full resolution target and the downsampled deep
+        # supervision targets are computed on self.device in train_step/validation_step. This saves CPU time in the
+        # workers and the separate host to device copies for each resolution. Results are identical.
+        self.deep_supervision_targets_on_device = False
+        # trade compute for memory. Both are set by the planner (see ExperimentPlannerMemoryEfficient) but can of course
+        # be overwritten here. gradient_accumulation_steps splits each batch into this many micro batches (the
+        # optimizer still steps once per batch). activation_checkpointing recomputes the activations of the
+        # encoder/decoder stages during the backward pass instead of storing them
+        self.gradient_accumulation_steps = self.configuration_manager.gradient_accumulation_steps
+        self.activation_checkpointing = self.configuration_manager.activation_checkpointing
+        # number of sliding window tiles that are predicted at once in perform_actual_validation
+        self.validation_tile_batch_size = 1
         
         # self.initial_lr = 3.3e-3
         # self.num_epochs = 1850        
@@ -172,10 +199,16 @@ class nnUNetTrainer(object):
         self.log_file = join(self.output_folder, "training_log_%d_%d_%d_%02.0d_%02.0d_%02.0d.txt" %
                              (timestamp.year, timestamp.month, timestamp.day, timestamp.hour, timestamp.minute,
                               timestamp.second))
+        # one json record per epoch with everything the logger knows. Same name as the text log so that the two can
+        # be matched when training is continued
+        self.metrics_file = self.log_file[:-4] + '.jsonl'
+        self._log_file_handle = None  # kept open by print_to_log_file, closed in on_train_end
         self.logger = nnUNetLogger()
 
         ### placeholders
         self.dataloader_train = self.dataloader_val = None  # see on_train_start
+        self.shared_memory_cache = None  # see on_train_start. Opt-in via nnUNet_shared_memory_cache_gb
+        self.da_autotuner = None  # see get_dataloaders. Opt-in via nnUNet_n_proc_DA=auto
 
         ### initializing stuff for remembering things and such
         self._best_ema = None
@@ -187,6 +220,16 @@ class nnUNetTrainer(object):
         ### checkpoint saving stuff
         self.save_every = 50
         self.disable_checkpointing = False
+        # checkpoints are copied to CPU and then written by a background thread so that training does not have to
+        # wait for the file system. Set to False to write them synchronously (they are written atomically either way)
+        self.async_checkpointing = True
+        self._checkpoint_writer = None
+
+        ### profiling
+        # (skip_iterations, num_iterations) or None. Set via nnUNet_profile or nnUNetv2_train --profile. The profiler
+        # is created in on_train_start, this placeholder does nothing
+        self.profiling_window = get_profiling_window_from_env()
+        self.training_profiler = TrainingProfiler(None, self.device)
 
         ## DDP batch size and oversampling can differ between workers and needs adaptation
         # we need to change the batch size in DDP because we don't use any of those distributed samplers
@@ -211,6 +254,12 @@ class nnUNetTrainer(object):
                                                            self.configuration_manager,
                                                            self.num_input_channels,
                                                            enable_deep_supervision=True).to(self.device)
+            if self.activation_checkpointing:
+                num_checkpointed = enable_activation_checkpointing(self.network)
+                self.print_to_log_file(f'Activation checkpointing enabled for {num_checkpointed} stages')
+                if num_checkpointed == 0:
+                    self.print_to_log_file('WARNING: activation checkpointing is not supported for this network '
+                                           'architecture. Training will use the regular amount of VRAM')
             # compile network for free speedup
             if self._do_i_compile():
                 self.print_to_log_file('Compiling network...')
@@ -299,6 +348,16 @@ class nnUNetTrainer(object):
             self.configuration_manager.pool_op_kernel_sizes), axis=0))[:-1]
         return deep_supervision_scales
 
+    def _compute_deep_supervision_targets(self, target: torch.Tensor) -> Union[torch.Tensor, List[torch.Tensor]]:
+        """
+        Only used if self.deep_supervision_targets_on_device. Turns the full resolution target into the list of
+        targets the deep supervision loss expects (same as DownsampleSegForDSTransform2 would have done)
+        """
+        deep_supervision_scales = self._get_deep_supervision_scales()
+        if deep_supervision_scales is None:
+            return target
+        return downsample_seg_for_ds_torch(target, deep_supervision_scales)
+
     def _set_batch_size_and_oversample(self):
         if not self.is_ddp:
             # set batch size to what the plan says, leave oversample untouched
@@ -443,14 +502,17 @@ class nnUNetTrainer(object):
             ctr = 0
             while not successful and ctr < max_attempts:
                 try:
-                    with open(self.log_file, 'a+') as f:
-                        for a in args:
-                            f.write(str(a))
-                            f.write(" ")
-                        f.write("\n")
+                    # opening the file for every line is slow on network file systems, so we keep it open
+                    if self._log_file_handle is None or self._log_file_handle.name != self.log_file:
+                        self._close_log_file()
+                        self._log_file_handle = open(self.log_file, 'a+')
+                    f = self._log_file_handle
+                    f.write(" ".join([str(a) for a in args]) + " \n")
+                    f.flush()
                     successful = True
                 except IOError:
                     print(f"{datetime.fromtimestamp(timestamp)}: failed to log: ", sys.exc_info())
+                    self._close_log_file()
                     sleep(0.5)
                     ctr += 1
             if also_print_to_console:
@@ -458,6 +520,14 @@ class nnUNetTrainer(object):
         elif also_print_to_console:
             print(*args)
 
+    def _close_log_file(self):
+        if self._log_file_handle is not None:
+            try:
+                self._log_file_handle.close()
+            except IOError:
+                pass
+            self._log_file_handle = None
+
     def print_plans(self):
         if self.local_rank == 0:
             dct = deepcopy(self.plans_manager.plans)
@@ -583,10 +653,12 @@ class nnUNetTrainer(object):
         # care about distributing training cases across GPUs.
         dataset_tr = nnUNetDataset(self.preprocessed_dataset_folder, tr_keys,
                                    folder_with_segs_from_previous_stage=self.folder_with_segs_from_previous_stage,
-                                   num_images_properties_loading_threshold=0)
+                                   num_images_properties_loading_threshold=0,
+                                   shared_memory_cache=self.shared_memory_cache)
         dataset_val = nnUNetDataset(self.preprocessed_dataset_folder, val_keys,
                                     folder_with_segs_from_previous_stage=self.folder_with_segs_from_previous_stage,
-                                    num_images_properties_loading_threshold=0)
+                                    num_images_properties_loading_threshold=0,
+                                    shared_memory_cache=self.shared_memory_cache)
         return dataset_tr, dataset_val
 
     def get_dataloaders(self):
@@ -596,8 +668,9 @@ class nnUNetTrainer(object):
         dim = len(patch_size)
 
         # needed for deep supervision: how much do we need to downscale the segmentation targets for the different
-        # outputs?
-        deep_supervision_scales = self._get_deep_supervision_scales()
+        # outputs? If the targets are downsampled on the device, the transforms must not do it
+        deep_supervision_scales = self._get_deep_supervision_scales() if not self.deep_supervision_targets_on_device \
+            else None
 
         rotation_for_DA, do_dummy_2d_data_aug, initial_patch_size, mirror_axes = \
             self.configure_rotation_dummyDA_mirroring_and_inital_patch_size()
@@ -622,12 +695,25 @@ class nnUNetTrainer(object):
         dl_tr, dl_val = self.get_plain_dataloaders(initial_patch_size, dim)
 
         allowed_num_processes = get_allowed_n_proc_DA()
+        num_cached_train = 6
+        if autotuning_of_n_proc_DA_requested() and allowed_num_processes > 0:
+            num_gpus = dist.get_world_size() if self.is_ddp else 1
+            self.da_autotuner = DAWorkerAutoTuner(
+                join(self.preprocessed_dataset_folder_base, 'da_autotuning.json'),
+                get_autotuning_key(self.__class__.__name__, self.plans_manager.plans_name, self.configuration_name,
+                                   num_gpus),
+                allowed_num_processes, max_num_processes=max(1, os.cpu_count() // num_gpus - 1),
+                log_fn=self.print_to_log_file, persist=self.local_rank == 0)
+            allowed_num_processes = self.da_autotuner.num_processes
+            num_cached_train = self.da_autotuner.num_cached
+
         if allowed_num_processes == 0:
             mt_gen_train = SingleThreadedAugmenter(dl_tr, tr_transforms)
             mt_gen_val = SingleThreadedAugmenter(dl_val, val_transforms)
         else:
             mt_gen_train = LimitedLenWrapper(self.num_iterations_per_epoch, data_loader=dl_tr, transform=tr_transforms,
-                                             num_processes=allowed_num_processes, num_cached=6, seeds=None,
+                                             num_processes=allowed_num_processes, num_cached=num_cached_train,
+                                             seeds=None,
                                              pin_memory=self.device.type == 'cuda', wait_time=0.02)
             mt_gen_val = LimitedLenWrapper(self.num_val_iterations_per_epoch, data_loader=dl_val,
                                            transform=val_transforms, num_processes=max(1, allowed_num_processes // 2),
@@ -818,6 +904,14 @@ class nnUNetTrainer(object):
         if self.is_ddp:
             dist.barrier()
 
+        # the shared memory cache must exist before the data augmentation workers are started so that they can all
+        # attach to it. Training and validation workers share the same cache
+        shared_memory_cache_budget = get_shared_memory_cache_budget_from_env()
+        if shared_memory_cache_budget > 0:
+            self.print_to_log_file(f'Using shared memory dataset cache with a budget of '
+                                   f'{np.round(shared_memory_cache_budget / 1024 ** 3, decimals=2)} GB')
+            self.shared_memory_cache = SharedMemoryDatasetCache(shared_memory_cache_budget)
+
         # dataloaders must be instantiated here because they need access to the training data which may not be present
         # when doing inference
         self.dataloader_train, self.dataloader_val = self.get_dataloaders()
@@ -835,6 +929,13 @@ class nnUNetTrainer(object):
 
         self._save_debug_information()
 
+        if self.profiling_window is not None:
+            self.print_to_log_file(f'Profiling {self.profiling_window[1]} training iterations after skipping the first '
+                                   f'{self.profiling_window[0]}')
+            self.training_profiler = TrainingProfiler(join(self.output_folder, 'profiling'), self.device,
+                                                      *self.profiling_window, log_fn=self.print_to_log_file,
+                                                      rank=self.local_rank)
+
         # print(f"batch size: {self.batch_size}")
         # print(f"oversample: {self.oversample_foreground_percent}")
 
@@ -844,6 +945,10 @@ class nnUNetTrainer(object):
         self.current_epoch -= 1
         self.save_checkpoint(join(self.output_folder, "checkpoint_final.pth"))
         self.current_epoch += 1
+        # all checkpoints must be on disk before we continue. Otherwise a pending write of checkpoint_latest could
+        # recreate the file we are about to delete
+        self.wait_for_checkpoints()
+        self.training_profiler.finish()
 
         # now we can delete latest
         if self.local_rank == 0 and isfile(join(self.output_folder, "checkpoint_latest.pth")):
@@ -859,8 +964,19 @@ class nnUNetTrainer(object):
                 self.dataloader_val._finish()
             sys.stdout = old_stdout
 
+        # only after the workers are gone can we free the shared memory
+        if self.shared_memory_cache is not None:
+            self.shared_memory_cache.close()
+            self.shared_memory_cache = None
+
+        # the last progress.png must show all epochs, regardless of throttling
+        if self.local_rank == 0:
+            self.logger.plot_progress_png_in_background(self.output_folder, force=True)
+            self.logger.finish_plotting()
+
         empty_cache(self.device)
         self.print_to_log_file("Training done.")
+        self._close_log_file()
 
     def on_train_epoch_start(self):
         self.network.train()
@@ -884,33 +1000,69 @@ class nnUNetTrainer(object):
         # data = self.configuration_manager.resampling_fn_data(data, new_shape, original_spacing, target_spacing)
         # target = self.configuration_manager.resampling_fn_seg(target, new_shape, original_spacing, target_spacing)
 
-        data = data.to(self.device, non_blocking=True)
-        if isinstance(target, list):
-            target = [i.to(self.device, non_blocking=True) for i in target]
-        else:
-            target = target.to(self.device, non_blocking=True)
+        # the profiler sections do nothing unless we are within the profiling window, see TrainingProfiler
+        profiler = self.training_profiler
+        with profiler.section('h2d'):
+            data = data.to(self.device, non_blocking=True)
+            if isinstance(target, list):
+                target = [i.to(self.device, non_blocking=True) for i in target]
+            else:
+                target = target.to(self.device, non_blocking=True)
+                if self.deep_supervision_targets_on_device:
+                    target = self._compute_deep_supervision_targets(target)
 
         self.optimizer.zero_grad(set_to_none=True)
-        # Autocast is a little bitch.
-        # If the device_type is 'cpu' then it's slow as heck and needs to be disabled.
-        # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
-        # So autocast will only be active if we have a cuda device.
-        with autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
-            output = self.network(data)
-            # del data
-            l = self.loss(output, target)
-            
+        # gradient accumulation: the batch is processed in micro batches. The loss of each micro batch is weighted by
+        # its share of the batch, so the accumulated gradients (and the returned loss) correspond to the entire batch.
+        # Only batch_dice differs because the dice is now aggregated over the micro batch only
+        num_micro_batches = min(self.gradient_accumulation_steps, data.shape[0])
+        micro_batches = zip(torch.tensor_split(data, num_micro_batches),
+                            self._split_target_into_micro_batches(target, num_micro_batches))
+        l = 0
+        for m, (data_m, target_m) in enumerate(micro_batches):
+            # in DDP the gradients only need to be synchronized after the last micro batch
+            with self.network.no_sync() if self.is_ddp and m < num_micro_batches - 1 else dummy_context():
+                # Autocast is a little bitch.
+                # If the device_type is 'cpu' then it's slow as heck and needs to be disabled.
+                # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
+                # So autocast will only be active if we have a cuda device.
+                with autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+                    with profiler.section('forward'):
+                        output = self.network(data_m)
+                    # del data
+                    with profiler.section('loss'):
+                        l_m = self.loss(output, target_m)
+                        if num_micro_batches > 1:
+                            l_m = l_m * (data_m.shape[0] / data.shape[0])
+
+                with profiler.section('backward'):
+                    if self.grad_scaler is not None:
+                        self.grad_scaler.scale(l_m).backward()
+                    else:
+                        l_m.backward()
+            l = l + l_m.detach()
+
         if self.grad_scaler is not None:
-            self.grad_scaler.scale(l).backward()
-            self.grad_scaler.unscale_(self.optimizer)
-            torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
-            self.grad_scaler.step(self.optimizer)
-            self.grad_scaler.update()
+            with profiler.section('grad_scaler'):
+                self.grad_scaler.unscale_(self.optimizer)
+            with profiler.section('optimizer_step'):
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.grad_scaler.step(self.optimizer)
+            with profiler.section('grad_scaler'):
+                self.grad_scaler.update()
         else:
-            l.backward()
-            torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
-            self.optimizer.step()
-        return {'loss': l.detach().cpu().numpy()}
+            with profiler.section('optimizer_step'):
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.optimizer.step()
+        return {'loss': l.cpu().numpy()}
+
+    @staticmethod
+    def _split_target_into_micro_batches(target: Union[torch.Tensor, List[torch.Tensor]], num_micro_batches: int) \
+            -> List[Union[torch.Tensor, List[torch.Tensor]]]:
+        if isinstance(target, list):
+            # deep supervision: list of resolutions -> list of micro batches, each with all resolutions
+            return [list(i) for i in zip(*[torch.tensor_split(t, num_micro_batches) for t in target])]
+        return list(torch.tensor_split(target, num_micro_batches))
 
     def on_train_epoch_end(self, train_outputs: List[dict]):
         outputs = collate_outputs(train_outputs)
@@ -924,6 +1076,10 @@ class nnUNetTrainer(object):
 
         self.logger.log('train_losses', loss_here, self.current_epoch)
 
+        # the training workers restart while we do validation, so the restart doesn't cost us much
+        if self.da_autotuner is not None and isinstance(self.dataloader_train, LimitedLenWrapper):
+            self.da_autotuner.on_epoch_end(self.dataloader_train)
+
     def on_validation_epoch_start(self):
         self.network.eval()
 
@@ -936,6 +1092,8 @@ class nnUNetTrainer(object):
             target = [i.to(self.device, non_blocking=True) for i in target]
         else:
             target = target.to(self.device, non_blocking=True)
+            if self.deep_supervision_targets_on_device:
+                target = self._compute_deep_supervision_targets(target)
 
         # Autocast is a little bitch.
         # If the device_type is 'cpu' then it's slow as heck and needs to be disabled.
@@ -1050,7 +1208,9 @@ class nnUNetTrainer(object):
             self.save_checkpoint(join(self.output_folder, 'checkpoint_best.pth'))
 
         if self.local_rank == 0:
-            self.logger.plot_progress_png(self.output_folder)
+            self.logger.append_epoch_record_to_jsonl(self.metrics_file, current_epoch)
+            # rendering happens in a background process and is throttled, see nnUNetLogger
+            self.logger.plot_progress_png_in_background(self.output_folder)
 
         self.current_epoch += 1
 
@@ -1075,14 +1235,29 @@ class nnUNetTrainer(object):
                     'trainer_name': self.__class__.__name__,
                     'inference_allowed_mirroring_axes': self.inference_allowed_mirroring_axes,
                 }
-                torch.save(checkpoint, filename)
+                if self.async_checkpointing:
+                    if self._checkpoint_writer is None:
+                        self._checkpoint_writer = AsyncCheckpointWriter()
+                    self._checkpoint_writer.submit(snapshot_to_cpu(checkpoint), filename)
+                else:
+                    atomic_torch_save(checkpoint, filename)
             else:
                 self.print_to_log_file('No checkpoint written, checkpointing is disabled')
 
+    def wait_for_checkpoints(self) -> None:
+        """
+        Blocks until all checkpoints submitted by save_checkpoint are written to disk
+        """
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
+
     def load_checkpoint(self, filename_or_checkpoint: Union[dict, str]) -> None:
         if not self.was_initialized:
             self.initialize()
 
+        # we may be about to load a checkpoint that is still being written
+        self.wait_for_checkpoints()
+
         if isinstance(filename_or_checkpoint, str):
             checkpoint = torch.load(filename_or_checkpoint, map_location=self.device)
         # if state dict comes from nn.DataParallel but we use non-parallel model here then the state dict keys do not
@@ -1117,27 +1292,103 @@ class nnUNetTrainer(object):
             if checkpoint['grad_scaler_state'] is not None:
                 self.grad_scaler.load_state_dict(checkpoint['grad_scaler_state'])
 
-    def perform_actual_validation(self, save_probabilities: bool = False):
+    def _load_case_for_validation(self, dataset_val: nnUNetDataset, k: str) -> Tuple[torch.Tensor, dict]:
+        data, seg, properties = dataset_val.load_case(k)
+
+        if self.is_cascaded:
+            data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
+                                                                output_dtype=data.dtype)))
+        with warnings.catch_warnings():
+            # ignore 'The given NumPy array is not writable' warning
+            warnings.simplefilter("ignore")
+            data = torch.from_numpy(data)
+        return data, properties
+
+    def _validation_fingerprint(self) -> str:
+        """
+        identifies the weights the validation is run with. Validation parts that were run with other weights are stale
+        """
+        h = hashlib.sha1()
+        for v in self.network.state_dict().values():
+            h.update(v.detach().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+        return h.hexdigest()
+
+    def _remove_validation_outputs(self, validation_output_folder: str, keys: List[str]) -> None:
+        for k in keys:
+            for ending in [self.dataset_json['file_ending'], '.pkl'] + list(PROBABILITY_FORMATS.values()):
+                if isfile(join(validation_output_folder, k + ending)):
+                    os.remove(join(validation_output_folder, k + ending))
+
+    def _finish_validation_part(self, validation_output_folder: str, all_val_keys: List[str], part_id: int,
+                                num_parts: int) -> bool:
+        """
+        Writes the completion marker of this validation part (call once its export has finished). Returns True if
+        this part completes the validation and has to compute the metrics: all parts have their marker, with the
+        same weights and the same split. Markers are written and checked under a lock, and the part that completes
+        them consumes them, so exactly one part gets True
+        """
+        parts_folder = join(validation_output_folder, 'validation_parts')
+        maybe_mkdir_p(parts_folder)
+        fingerprint = self._validation_fingerprint()
+        with store_lock(join(parts_folder, 'parts')):
+            save_json({'fingerprint': fingerprint, 'keys': list(all_val_keys[part_id::num_parts])},
+                      join(parts_folder, f'part_{part_id}_of_{num_parts}.json'))
+            markers = [join(parts_folder, f'part_{i}_of_{num_parts}.json') for i in range(num_parts)]
+            if not all([isfile(m) for m in markers]):
+                return False
+            for i, m in enumerate(markers):
+                marker = load_json(m)
+                if marker['fingerprint'] != fingerprint or marker['keys'] != list(all_val_keys[i::num_parts]):
+                    # that part is left over from another model or split and has to be run again
+                    return False
+            for m in markers:
+                os.remove(m)
+        return True
+
+    def perform_actual_validation(self, save_probabilities: bool = False, num_parts: int = 1, part_id: int = 0,
+                                  num_processes_export: int = default_num_processes):
+        """
+        num_parts/part_id allow running the validation in several independent jobs (for example
+        nnUNetv2_validate ... -num_parts 4 -part_id X). Each part removes old outputs of its cases before predicting
+        them and writes a completion marker once its export is done. The part that completes the markers computes the
+        metrics (see _finish_validation_part).
+
+        Loading the next case and exporting (including the next stage of the cascade) happen in the background while
+        the current case is predicted. Set self.validation_tile_batch_size > 1 to predict several tiles at once.
+        """
         self.set_deep_supervision_enabled(False)
         self.network.eval()
 
         predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True,
                                     perform_everything_on_gpu=True, device=self.device, verbose=False,
-                                    verbose_preprocessing=False, allow_tqdm=False)
+                                    verbose_preprocessing=False, allow_tqdm=False,
+                                    tile_batch_size=self.validation_tile_batch_size)
         predictor.manual_initialization(self.network, self.plans_manager, self.configuration_manager, None,
                                         self.dataset_json, self.__class__.__name__,
                                         self.inference_allowed_mirroring_axes)
 
-        with multiprocessing.get_context("spawn").Pool(default_num_processes) as segmentation_export_pool:
+        validation_output_folder = join(self.output_folder, 'validation')
+        # we cannot use self.get_tr_and_val_datasets() here because we might be DDP and then we have to distribute
+        # the validation keys across the workers.
+        _, all_val_keys = self.do_split()
+
+        with multiprocessing.get_context("spawn").Pool(num_processes_export) as segmentation_export_pool, \
+                ThreadPoolExecutor(max_workers=1) as case_loader:
             worker_list = [i for i in segmentation_export_pool._pool]
-            validation_output_folder = join(self.output_folder, 'validation')
             maybe_mkdir_p(validation_output_folder)
 
-            # we cannot use self.get_tr_and_val_datasets() here because we might be DDP and then we have to distribute
-            # the validation keys across the workers.
-            _, val_keys = self.do_split()
+            val_keys = all_val_keys[part_id::num_parts]
+            if self.local_rank == 0:
+                # this part is not done (anymore)
+                maybe_mkdir_p(join(validation_output_folder, 'validation_parts'))
+                marker = join(validation_output_folder, 'validation_parts', f'part_{part_id}_of_{num_parts}.json')
+                with store_lock(join(validation_output_folder, 'validation_parts', 'parts')):
+                    if isfile(marker):
+                        os.remove(marker)
             if self.is_ddp:
                 val_keys = val_keys[self.local_rank:: dist.get_world_size()]
+            # outputs of a previous run must not end up in the metrics
+            self._remove_validation_outputs(validation_output_folder, val_keys)
 
             dataset_val = nnUNetDataset(self.preprocessed_dataset_folder, val_keys,
                                         folder_with_segs_from_previous_stage=self.folder_with_segs_from_previous_stage,
@@ -1150,7 +1401,11 @@ class nnUNetTrainer(object):
 
             results = []
 
-            for k in dataset_val.keys():
+            keys = list(dataset_val.keys())
+            # the next case is loaded while the current one is predicted
+            next_case = case_loader.submit(self._load_case_for_validation, dataset_val, keys[0]) \
+                if len(keys) > 0 else None
+            for i, k in enumerate(keys):
                 proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
                                                  allowed_num_queued=2)
                 while not proceed:
@@ -1159,15 +1414,9 @@ class nnUNetTrainer(object):
                                                      allowed_num_queued=2)
 
                 self.print_to_log_file(f"predicting {k}")
-                data, seg, properties = dataset_val.load_case(k)
-
-                if self.is_cascaded:
-                    data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
-                                                                        output_dtype=data.dtype)))
-                with warnings.catch_warnings():
-                    # ignore 'The given NumPy array is not writable' warning
-                    warnings.simplefilter("ignore")
-                    data = torch.from_numpy(data)
+                data, properties = next_case.result()
+                if i + 1 < len(keys):
+                    next_case = case_loader.submit(self._load_case_for_validation, dataset_val, keys[i + 1])
 
                 output_filename_truncated = join(validation_output_folder, k)
 
@@ -1193,33 +1442,19 @@ class nnUNetTrainer(object):
                 # export_prediction(prediction_for_export, properties, self.configuration, self.plans, self.dataset_json,
                 #              output_filename_truncated, save_probabilities)
 
-                # if needed, export the softmax prediction for the next stage
+                # if needed, export the softmax prediction for the next stage. The background worker reads the
+                # preprocessed data of the next stage to get the target shape, so we can continue with the next case
                 if next_stages is not None:
                     for n in next_stages:
                         next_stage_config_manager = self.plans_manager.get_configuration(n)
                         expected_preprocessed_folder = join(nnUNet_preprocessed, self.plans_manager.dataset_name,
                                                             next_stage_config_manager.data_identifier)
-
-                        try:
-                            # we do this so that we can use load_case and do not have to hard code how loading training cases is implemented
-                            tmp = nnUNetDataset(expected_preprocessed_folder, [k],
-                                                num_images_properties_loading_threshold=0)
-                            d, s, p = tmp.load_case(k)
-                        except FileNotFoundError:
-                            self.print_to_log_file(
-                                f"Predicting next stage {n} failed for case {k} because the preprocessed file is missing! "
-                                f"Run the preprocessing for this configuration first!")
-                            continue
-
-                        target_shape = d.shape[1:]
                         output_folder = join(self.output_folder_base, 'predicted_next_stage', n)
                         output_file = join(output_folder, k + '.npz')
 
-                        # resample_and_save(prediction, target_shape, output_file, self.plans_manager, self.configuration_manager, properties,
-                        #                   self.dataset_json)
                         results.append(segmentation_export_pool.starmap_async(
-                            resample_and_save, (
-                                (prediction, target_shape, output_file, self.plans_manager,
+                            resample_and_save_for_next_stage, (
+                                (prediction, expected_preprocessed_folder, k, output_file, self.plans_manager,
                                  self.configuration_manager,
                                  properties,
                                  self.dataset_json),
@@ -1231,7 +1466,21 @@ class nnUNetTrainer(object):
         if self.is_ddp:
             dist.barrier()
 
-        if self.local_rank == 0:
+        # if the validation is split into several jobs, only the one that completes it can evaluate
+        if self.local_rank == 0 and not self._finish_validation_part(validation_output_folder, all_val_keys, part_id,
+                                                                     num_parts):
+            self.print_to_log_file(f"Validation part {part_id} of {num_parts} is done. Metrics will be computed by "
+                                   f"the last part that finishes", also_print_to_console=True)
+        elif self.local_rank == 0:
+            # predictions of cases that are not in this split (anymore) are stale
+            file_ending = self.dataset_json['file_ending']
+            stale = [i[:-len(file_ending)] for i in subfiles(validation_output_folder, suffix=file_ending, join=False)
+                     if i[:-len(file_ending)] not in all_val_keys]
+            if len(stale) > 0:
+                self.print_to_log_file(f"Removing {len(stale)} predictions of cases that are not in the validation "
+                                       f"set: {stale}")
+                self._remove_validation_outputs(validation_output_folder, stale)
+            write_prediction_time_summary(validation_output_folder)
             metrics = compute_metrics_on_folder(join(self.preprocessed_dataset_folder_base, 'gt_segmentations'),
                                                 validation_output_folder,
                                                 join(validation_output_folder, 'summary.json'),
@@ -1255,7 +1504,14 @@ class nnUNetTrainer(object):
             self.on_train_epoch_start()
             train_outputs = []
             for batch_id in range(self.num_iterations_per_epoch):
-                train_outputs.append(self.train_step(next(self.dataloader_train)))
+                with self.training_profiler.iteration():
+                    start = time()
+                    with self.training_profiler.section('data_wait'):
+                        batch = next(self.dataloader_train)
+                    batch_received = time()
+                    train_outputs.append(self.train_step(batch))
+                    if self.da_autotuner is not None:
+                        self.da_autotuner.record(batch_received - start, time() - batch_received)
             self.on_train_epoch_end(train_outputs)
 
             with torch.no_grad():
@@ -1,6 +1,7 @@
 import torch
 from batchgenerators.utilities.file_and_folder_operations import save_json, join, isfile, load_json
 
+from nnunetv2.configuration import default_num_processes
 from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
 from torch import distributed as dist
 
@@ -15,7 +16,8 @@ class nnUNetTrainerBenchmark_5epochs(nnUNetTrainer):
         assert torch.cuda.is_available(), "This only works on GPU"
         self.crashed_with_runtime_error = False
 
-    def perform_actual_validation(self, save_probabilities: bool = False):
+    def perform_actual_validation(self, save_probabilities: bool = False, num_parts: int = 1, part_id: int = 0,
+                                  num_processes_export: int = default_num_processes):
         pass
 
     def save_checkpoint(self, filename: str) -> None:
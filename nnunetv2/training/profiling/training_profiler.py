@@ -0,0 +1,174 @@
+import os
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Tuple, Union
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, save_json
+
+from nnunetv2.utilities.helpers import dummy_context
+
+# in the order in which they happen during a training iteration
+PROFILED_SECTIONS = ('data_wait', 'h2d', 'forward', 'loss', 'backward', 'grad_scaler', 'optimizer_step')
+
+DEFAULT_PROFILING_WINDOW = (20, 20)
+
+
+def get_profiling_window_from_env() -> Union[None, Tuple[int, int]]:
+    """
+    nnUNet_profile enables profiling. It can either be a boolean (true/1/t, uses DEFAULT_PROFILING_WINDOW) or
+    'SKIP,NUM': skip the first SKIP training iterations (warmup, cudnn benchmarking, worker startup) and then profile
+    the next NUM iterations.
+    """
+    if 'nnUNet_profile' not in os.environ.keys():
+        return None
+    value = os.environ['nnUNet_profile'].lower()
+    if value in ('true', '1', 't'):
+        return DEFAULT_PROFILING_WINDOW
+    if value in ('false', '0', 'f', ''):
+        return None
+    skip, num = value.split(',')
+    return int(skip), int(num)
+
+
+class TrainingProfiler(object):
+    def __init__(self, output_folder: Union[str, None], device: torch.device, skip_iterations: int = 0,
+                 num_iterations: int = 0, log_fn: Callable = print, rank: int = 0):
+        """
+        Captures a window of num_iterations training iterations (after skipping the first skip_iterations) with
+        torch.profiler and measures how long each section (see PROFILED_SECTIONS) of these iterations takes. The
+        trace (viewable in chrome://tracing or perfetto) and a summary are written to output_folder.
+
+        Within the window we synchronize the device after each section so that the measured times are actually
+        attributed to the right section. This slows training down a little, but only for the profiled iterations.
+        Outside the window everything is a no-op.
+
+        num_iterations=0 disables profiling.
+        """
+        self.output_folder = output_folder
+        self.device = device
+        self.skip_iterations = skip_iterations
+        self.num_iterations = num_iterations
+        self.log_fn = log_fn
+        self.rank = rank
+
+        self._iteration = 0
+        self._profiler = None
+        self._in_window = False
+        self._current = None
+        self._records = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.num_iterations > 0 and self.output_folder is not None
+
+    def _synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        elif self.device.type == 'mps':
+            torch.mps.synchronize()
+
+    def _start(self):
+        maybe_mkdir_p(self.output_folder)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=False, profile_memory=False,
+                                                with_stack=False)
+        self._profiler.start()
+        self._in_window = True
+
+    def _stop(self):
+        self._profiler.stop()
+        self._in_window = False
+        self._profiler.export_chrome_trace(join(self.output_folder, f'trace_rank{self.rank}.json'))
+        with open(join(self.output_folder, f'key_averages_rank{self.rank}.txt'), 'w') as f:
+            sort_by = 'self_cuda_time_total' if self.device.type == 'cuda' else 'self_cpu_time_total'
+            f.write(self._profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        self._profiler = None
+        self._report()
+
+    @contextmanager
+    def _iteration_context(self):
+        if self._iteration == self.skip_iterations:
+            self._start()
+        self._current = {}
+        self._synchronize()
+        start = perf_counter()
+        with torch.profiler.record_function('train_iteration'):
+            yield
+        self._synchronize()
+        self._current['total'] = perf_counter() - start
+        self._records.append(self._current)
+        self._current = None
+        self._iteration += 1
+        if self._iteration == self.skip_iterations + self.num_iterations:
+            self._stop()
+
+    def iteration(self):
+        """
+        Wrap an entire training iteration (including fetching the batch) in this
+        """
+        if not self.enabled:
+            return dummy_context()
+        if self._iteration < self.skip_iterations or self._iteration >= self.skip_iterations + self.num_iterations:
+            self._iteration += 1
+            return dummy_context()
+        return self._iteration_context()
+
+    def finish(self):
+        """
+        In case training ended before the profiling window was complete
+        """
+        if self._in_window:
+            self._stop()
+
+    @contextmanager
+    def _section_context(self, name: str):
+        self._synchronize()
+        start = perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self._synchronize()
+        # sections can be entered more than once per iteration
+        self._current[name] = self._current.get(name, 0) + perf_counter() - start
+
+    def section(self, name: str):
+        """
+        Wrap parts of a training iteration in this. name should be one of PROFILED_SECTIONS (but doesn't have to be)
+        """
+        if not self._in_window or self._current is None:
+            return dummy_context()
+        return self._section_context(name)
+
+    def _report(self):
+        sections = list(PROFILED_SECTIONS) + sorted(set([k for r in self._records for k in r.keys()
+                                                          if k not in PROFILED_SECTIONS and k != 'total']))
+        per_iteration = {k: [r.get(k, 0) for r in self._records] for k in sections}
+        total = [r['total'] for r in self._records]
+        per_iteration['other'] = [t - sum([per_iteration[k][i] for k in sections]) for i, t in enumerate(total)]
+        per_iteration['total'] = total
+
+        summary = {
+            'device': str(self.device),
+            'skip_iterations': self.skip_iterations,
+            'num_iterations': len(self._records),
+            'mean_seconds': {k: float(np.mean(v)) for k, v in per_iteration.items()},
+            'median_seconds': {k: float(np.median(v)) for k, v in per_iteration.items()},
+            'per_iteration_seconds': {k: [float(i) for i in v] for k, v in per_iteration.items()},
+        }
+        save_json(summary, join(self.output_folder, f'profiling_summary_rank{self.rank}.json'), sort_keys=False)
+
+        mean_total = summary['mean_seconds']['total']
+        self.log_fn(f'Profiled {len(self._records)} training iterations. Mean time per iteration: '
+                    f'{np.round(mean_total * 1000, decimals=1)} ms')
+        for k in sections + ['other']:
+            self.log_fn(f'    {k}: {np.round(summary["mean_seconds"][k] * 1000, decimals=1)} ms '
+                        f'({np.round(summary["mean_seconds"][k] / mean_total * 100, decimals=1)} %)')
+        if summary['mean_seconds']['data_wait'] / mean_total > 0.1:
+            self.log_fn('Training is data bound: a substantial amount of time is spent waiting for the data '
+                        'augmentation. Consider more workers (nnUNet_n_proc_DA) or faster storage/CPUs.')
+        else:
+            self.log_fn('Training is compute bound: the data augmentation keeps up with the GPU.')
+        self.log_fn(f'Profiling results (trace + summary) were written to {self.output_folder}')
@@ -0,0 +1,39 @@
+from functools import partial
+from typing import Callable
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+def _checkpointed_forward(original_forward: Callable, *args, **kwargs):
+    # no point in checkpointing if there is no backward pass (validation, inference)
+    if torch.is_grad_enabled():
+        return checkpoint(original_forward, *args, use_reentrant=False, **kwargs)
+    return original_forward(*args, **kwargs)
+
+
+def enable_activation_checkpointing(network: nn.Module) -> int:
+    """
+    Activation checkpointing for the encoder and decoder stages of the networks from dynamic_network_architectures
+    (PlainConvUNet, ResidualEncoderUNet, ...). The activations within a stage are no longer kept for the backward
+    pass but recomputed when they are needed. Saves a good chunk of VRAM at the cost of roughly one additional forward
+    pass.
+
+    We replace the forward of the stage instances instead of wrapping the stages in another module so that the
+    state_dict (and thus all checkpoints) remain unchanged.
+
+    Returns the number of stages that are now checkpointed (0 if the architecture is not supported)
+    """
+    num_stages = 0
+    for part in ('encoder', 'decoder'):
+        stages = getattr(getattr(network, part, None), 'stages', None)
+        if stages is None:
+            continue
+        for stage in stages:
+            if getattr(stage, '_nnUNet_activation_checkpointing', False):
+                continue
+            stage.forward = partial(_checkpointed_forward, stage.forward)
+            stage._nnUNet_activation_checkpointing = True
+            num_stages += 1
+    return num_stages
@@ -8,7 +8,8 @@ def get_allowed_n_proc_DA():
     infrastructure at DKFZ. You can modify it to suit your needs. Everything is allowed.
 
     IMPORTANT: if the environment variable nnUNet_n_proc_DA is set it will overwrite anything in this script
-    (see first line).
+    (see first line). nnUNet_n_proc_DA=auto enables auto tuning of the number of processes during training (see
+    DAWorkerAutoTuner). The values below are then only used as a starting point.
 
     Interpret the output as the number of processes used for data augmentation PER GPU.
 
@@ -17,7 +18,7 @@ def get_allowed_n_proc_DA():
     GPU without overloading the CPU (technically 11 because we have a main process as well), so that's what we use.
     """
 
-    if 'nnUNet_n_proc_DA' in os.environ.keys():
+    if 'nnUNet_n_proc_DA' in os.environ.keys() and not autotuning_of_n_proc_DA_requested():
         use_this = int(os.environ['nnUNet_n_proc_DA'])
     else:
         hostname = subprocess.getoutput(['hostname'])
@@ -42,3 +43,7 @@ def get_allowed_n_proc_DA():
 
     use_this = min(use_this, os.cpu_count())
     return use_this
+
+
+def autotuning_of_n_proc_DA_requested() -> bool:
+    return os.environ.get('nnUNet_n_proc_DA', '').lower() == 'auto'
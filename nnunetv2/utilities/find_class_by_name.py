@@ -1,10 +1,59 @@
 import importlib
 import pkgutil
+from functools import lru_cache
+from importlib.metadata import entry_points
 
 from batchgenerators.utilities.file_and_folder_operations import *
 
+# class name -> classes registered under that name. Filled by @register_class as modules are imported
+_CLASS_REGISTRY = {}
 
-def recursive_find_python_class(folder: str, class_name: str, current_module: str):
+
+def register_class(cls):
+    """
+    Decorator. Makes a class known to recursive_find_python_class so that looking it up does not need to import
+    every module of the package it lives in. Classes that are not registered are still found (by scanning the
+    package, just like before), it's just slower the first time.
+
+    Classes from other packages (plugins) can be made available without scanning through entry points. The group is
+    the module nnU-Net searches in (current_module of recursive_find_python_class), the name is the class name.
+    Example (pyproject.toml):
+
+    [project.entry-points."nnunetv2.training.nnUNetTrainer"]
+    MyTrainer = "my_package.my_trainer:MyTrainer"
+    """
+    registered = _CLASS_REGISTRY.setdefault(cls.__name__, [])
+    if cls not in registered:
+        registered.append(cls)
+    return cls
+
+
+def _find_registered_class(class_name: str, current_module: str):
+    for cls in _CLASS_REGISTRY.get(class_name, []):
+        if cls.__module__ == current_module or cls.__module__.startswith(current_module + '.'):
+            return cls
+    return None
+
+
+@lru_cache(maxsize=None)
+def _get_entry_points(group: str) -> dict:
+    eps = entry_points()
+    # python < 3.10 returns a dict
+    eps = eps.select(group=group) if hasattr(eps, 'select') else eps.get(group, [])
+    return {ep.name: ep for ep in eps}
+
+
+def _find_class_from_entry_points(class_name: str, current_module: str):
+    ep = _get_entry_points(current_module).get(class_name)
+    return ep.load() if ep is not None else None
+
+
+@lru_cache(maxsize=None)
+def _scan_for_python_class(folder: str, class_name: str, current_module: str):
+    """
+    Imports the modules in folder (and then its subpackages) one by one until one of them has class_name. Cached,
+    so each lookup only ever scans once per process
+    """
     tr = None
     for importer, modname, ispkg in pkgutil.iter_modules([folder]):
         # print(modname, ispkg)
@@ -18,7 +67,21 @@ def recursive_find_python_class(folder: str, class_name: str, current_module: st
         for importer, modname, ispkg in pkgutil.iter_modules([folder]):
             if ispkg:
                 next_current_module = current_module + "." + modname
-                tr = recursive_find_python_class(join(folder, modname), class_name, current_module=next_current_module)
+                tr = _scan_for_python_class(join(folder, modname), class_name, current_module=next_current_module)
             if tr is not None:
                 break
-    return tr
\ No newline at end of file
+    return tr
+
+
+def recursive_find_python_class(folder: str, class_name: str, current_module: str):
+    """
+    Finds class_name in current_module (located at folder) or any of its submodules. Looks in the registry
+    (@register_class) first, then in the entry points and only then scans the package. Returns None if nothing
+    was found.
+    """
+    tr = _find_registered_class(class_name, current_module)
+    if tr is None:
+        tr = _find_class_from_entry_points(class_name, current_module)
+    if tr is None:
+        tr = _scan_for_python_class(folder, class_name, current_module)
+    return tr
@@ -0,0 +1,216 @@
+"""
+How predicted probabilities (and compressed segmentations) are written to disk. Compression used to dominate the
+export workers' time for large multi-class outputs because np.savez_compressed and .nii.gz are single threaded zlib.
+
+Probability formats:
+- 'npz': np.savez_compressed (float16). Default, compatible with everything that was predicted before
+- 'npy': uncompressed float16 .npy. Fastest to write, large files. Read back as memmap, so consumers only load what
+they touch
+- 'blosc2': multithreaded zstd (with byte shuffle) via blosc2 (pip install blosc2). About as small as npz but much
+faster to write and read
+
+open_probabilities and ProbabilityWriter read/write probabilities piece by piece (see ensembling), so that no full
+float32 volume has to be held in memory.
+"""
+
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import subfiles
+
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
+
+
+PROBABILITY_FORMATS = {
+    'npz': '.npz',
+    'npy': '.npy',
+    'blosc2': '.b2nd',
+}
+
+
+def probability_file_ending(probabilities_format: str) -> str:
+    if probabilities_format not in PROBABILITY_FORMATS.keys():
+        raise ValueError(f'Unknown probabilities format {probabilities_format}. Choose from '
+                         f'{list(PROBABILITY_FORMATS.keys())}')
+    return PROBABILITY_FORMATS[probabilities_format]
+
+
+def save_probabilities(probabilities: np.ndarray, output_file_truncated: str, probabilities_format: str = 'npz',
+                       num_threads: int = 1) -> str:
+    """
+    saves probabilities (as float16) to output_file_truncated + the file ending of probabilities_format. Returns the
+    name of the written file
+    """
+    output_file = output_file_truncated + probability_file_ending(probabilities_format)
+    probabilities = probabilities.astype(np.float16, copy=False)
+    if probabilities_format == 'npz':
+        np.savez_compressed(output_file, probabilities=probabilities)
+    elif probabilities_format == 'npy':
+        np.save(output_file, probabilities)
+    elif probabilities_format == 'blosc2':
+        assert blosc2 is not None, "probabilities_format 'blosc2' requires blosc2. Install with 'pip install blosc2'"
+        cparams = {'codec': blosc2.Codec.ZSTD, 'clevel': 3, 'filters': [blosc2.Filter.SHUFFLE],
+                   'nthreads': num_threads}
+        blosc2.asarray(np.ascontiguousarray(probabilities), urlpath=output_file, mode='w', cparams=cparams)
+    return output_file
+
+
+def load_probabilities(filename: str, num_threads: int = 1) -> np.ndarray:
+    """
+    The format is determined by the file ending. '.npy' files are opened as memmap (read only!)
+    """
+    if filename.endswith('.npz'):
+        return np.load(filename)['probabilities']
+    elif filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    elif filename.endswith('.b2nd'):
+        assert blosc2 is not None, f"reading {filename} requires blosc2. Install with 'pip install blosc2'"
+        return blosc2.open(filename, mode='r', dparams={'nthreads': num_threads})[:]
+    raise ValueError(f'Unknown probabilities file ending: {filename}')
+
+
+def open_probabilities(filename: str, num_threads: int = 1) -> Union[np.ndarray, np.memmap, 'blosc2.NDArray']:
+    """
+    Like load_probabilities, but nothing is decompressed until the returned array is sliced, and then only what is
+    needed. '.npy' -> read only memmap, '.b2nd' -> blosc2.NDArray (slicing returns numpy arrays and only decompresses
+    the chunks that are touched).
+
+    Members of '.npz' files cannot be read partially. They are decompressed block wise into an (anonymous) temporary
+    file in tempfile.gettempdir() (set TMPDIR to change that) and returned as read only memmap, so memory does not
+    depend on their size either. The temporary file is gone once the memmap is deleted
+    """
+    if filename.endswith('.npz'):
+        with zipfile.ZipFile(filename, 'r') as zf, zf.open('probabilities.npy', 'r') as member:
+            version = np.lib.format.read_magic(member)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+            tmp = tempfile.TemporaryFile()
+            shutil.copyfileobj(member, tmp, 1048576)
+        tmp.flush()
+        # the memmap keeps the mapping (and thereby the unlinked file) alive
+        ret = np.memmap(tmp, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C')
+        tmp.close()
+        return ret
+    elif filename.endswith('.b2nd'):
+        assert blosc2 is not None, f"reading {filename} requires blosc2. Install with 'pip install blosc2'"
+        return blosc2.open(filename, mode='r', dparams={'nthreads': num_threads})
+    return load_probabilities(filename, num_threads)
+
+
+class ProbabilityWriter(object):
+    """
+    Writes probabilities of known shape piece by piece: writer[slicer] = probabilities (float16 like
+    save_probabilities). close() (or leaving the with block) finishes the file. The result is the same file
+    save_probabilities would have written.
+
+    'npy' and 'blosc2' are written in place. 'npz' cannot be written partially, so the probabilities are collected
+    in a temporary .npy next to the output file and compressed (streamed, block wise) on close()
+    """
+    def __init__(self, output_file_truncated: str, shape: Tuple[int, ...], probabilities_format: str = 'npz',
+                 num_threads: int = 1):
+        self.output_file = output_file_truncated + probability_file_ending(probabilities_format)
+        self.probabilities_format = probabilities_format
+        if probabilities_format == 'blosc2':
+            assert blosc2 is not None, "probabilities_format 'blosc2' requires blosc2. Install with 'pip install blosc2'"
+            cparams = {'codec': blosc2.Codec.ZSTD, 'clevel': 3, 'filters': [blosc2.Filter.SHUFFLE],
+                       'nthreads': num_threads}
+            self.array = blosc2.empty(tuple(shape), dtype=np.float16, urlpath=self.output_file, mode='w',
+                                      cparams=cparams)
+        else:
+            self.npy_file = self.output_file if probabilities_format == 'npy' else \
+                output_file_truncated + f'_tmp{os.getpid()}.npy'
+            self.array = np.lib.format.open_memmap(self.npy_file, mode='w+', dtype=np.float16, shape=tuple(shape))
+
+    def __setitem__(self, key, value: np.ndarray):
+        self.array[key] = np.asarray(value).astype(np.float16, copy=False)
+
+    def close(self) -> str:
+        """returns the name of the written file"""
+        if self.array is None:
+            return self.output_file
+        if self.probabilities_format != 'blosc2':
+            self.array.flush()
+        if self.probabilities_format == 'npz':
+            # same as np.savez_compressed, which would copy the entire array in one go
+            with zipfile.ZipFile(self.output_file, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf, \
+                    zf.open('probabilities.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array_header_1_0(member, np.lib.format.header_data_from_array_1_0(self.array))
+                flat = self.array.reshape(-1)
+                for start in range(0, flat.size, 1048576):
+                    member.write(flat[start:start + 1048576].tobytes())
+            os.remove(self.npy_file)
+        self.array = None
+        return self.output_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't leave a temporary file behind. An unfinished npy/blosc2 file is left as it is
+            self.array = None
+            if self.probabilities_format == 'npz' and os.path.isfile(self.npy_file):
+                os.remove(self.npy_file)
+
+
+def strip_probability_file_ending(filename: str) -> str:
+    for ending in PROBABILITY_FORMATS.values():
+        if filename.endswith(ending):
+            return filename[:-len(ending)]
+    raise ValueError(f'Unknown probabilities file ending: {filename}')
+
+
+def find_probability_files(folder: str, join: bool = True) -> List[str]:
+    """
+    all probability files (of any format) in folder
+    """
+    return [i for ending in PROBABILITY_FORMATS.values() for i in subfiles(folder, suffix=ending, join=join)]
+
+
+def gzip_compress_parallel(data: bytes, num_threads: int = 1, compresslevel: int = 6,
+                           block_size: int = 1048576) -> bytes:
+    """
+    Same result as gzip.compress (a valid single member gzip stream that any gzip reader can decompress), but the
+    data is split into blocks that are deflated independently in num_threads threads (zlib releases the GIL). Like
+    pigz. Files are marginally larger than with gzip.compress because blocks cannot reference each other.
+    """
+    view = memoryview(data)
+    blocks = [view[i:i + block_size] for i in range(0, len(view), block_size)] or [view]
+
+    def _deflate(idx: int) -> bytes:
+        c = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # every block but the last ends with a sync flush (byte aligned, not final). The last one finishes the stream
+        return c.compress(blocks[idx]) + c.flush(zlib.Z_FINISH if idx == len(blocks) - 1 else zlib.Z_SYNC_FLUSH)
+
+    if num_threads > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            deflated = list(executor.map(_deflate, range(len(blocks))))
+    else:
+        deflated = [_deflate(i) for i in range(len(blocks))]
+
+    # gzip header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+    header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+    trailer = (zlib.crc32(view) & 0xffffffff).to_bytes(4, 'little') + (len(view) & 0xffffffff).to_bytes(4, 'little')
+    return b''.join([header, *deflated, trailer])
+
+
+def gzip_file_parallel(source_file: str, target_file: str, num_threads: int = 1, remove_source: bool = True) -> None:
+    with open(source_file, 'rb') as f:
+        data = f.read()
+    with open(target_file, 'wb') as f:
+        f.write(gzip_compress_parallel(data, num_threads))
+    if remove_source:
+        os.remove(source_file)
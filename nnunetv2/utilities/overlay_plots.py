@@ -22,6 +22,7 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
 from nnunetv2.paths import nnUNet_raw, nnUNet_preprocessed
+from nnunetv2.training.dataloading.utils import load_array_from_npz
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
 from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folder, \
     get_filenames_of_train_images_and_targets
@@ -151,8 +152,9 @@ def plot_overlay(image_file: str, segmentation_file: str, image_reader_writer: B
 
 def plot_overlay_preprocessed(case_file: str, output_file: str, overlay_intensity: float = 0.6, channel_idx=0):
     import matplotlib.pyplot as plt
-    data = np.load(case_file)['data']
-    seg = np.load(case_file)['seg'][0]
+    npz = np.load(case_file)
+    data = load_array_from_npz(npz, 'data')
+    seg = load_array_from_npz(npz, 'seg')[0]
 
     assert channel_idx < (data.shape[0]), 'This dataset only supports channel index up to %d' % (data.shape[0] - 1)
 
@@ -164,6 +164,15 @@ class ConfigurationManager(object):
     def batch_dice(self) -> bool:
         return self.configuration['batch_dice']
 
+    @property
+    def gradient_accumulation_steps(self) -> int:
+        # older plans don't have this
+        return self.configuration.get('gradient_accumulation_steps', 1)
+
+    @property
+    def activation_checkpointing(self) -> bool:
+        return self.configuration.get('activation_checkpointing', False)
+
     @property
     def next_stage_names(self) -> Union[List[str], None]:
         ret = self.configuration.get('next_stage')
@@ -0,0 +1,92 @@
+"""
+Append-only result store (one json record per line) for results that are produced by several worker processes, for
+example per case prediction times or evaluation metrics.
+
+Workers only ever append a single line per result (O_APPEND), so no worker has to read what the others wrote. The
+parent process reads the store at the end and writes whatever summary it needs. Later records overwrite earlier ones
+with the same key, so a case can be evaluated again without cleaning up first. compact_results rewrites the store
+with only the latest record per key.
+
+Everything that modifies a store (append_result, compact_results and whoever else uses store_lock, for example to
+update a summary file) holds an exclusive lock on store_file + '.lock' (where fcntl is available). The lock file is
+never replaced, so compacting while other processes are still appending loses nothing.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+from typing import Any
+
+from nnunetv2.utilities.json_export import recursive_fix_for_json_export
+
+try:
+    import fcntl
+except ImportError:
+    # windows. Appends of a single line are still fine in practice
+    fcntl = None
+
+
+@contextmanager
+def store_lock(store_file: str):
+    """
+    exclusive lock of store_file (see module docstring). Not reentrant!
+    """
+    fd = os.open(store_file + '.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+def append_result(store_file: str, key: str, value: Any) -> None:
+    record = {'key': key, 'value': value}
+    recursive_fix_for_json_export(record)
+    line = (json.dumps(record) + '\n').encode('utf-8')
+    with store_lock(store_file):
+        fd = os.open(store_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+                # a writer was killed in the middle of a line. Don't glue this record to its remains
+                line = b'\n' + line
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def load_results(store_file: str) -> dict:
+    """
+    returns {key: value} with the latest value of each key, ordered by when the key was first written. Empty dict if
+    store_file does not exist. Incomplete lines (a worker that was killed while writing) are ignored
+    """
+    results = {}
+    if not os.path.isfile(store_file):
+        return results
+    with open(store_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[record['key']] = record['value']
+    return results
+
+
+def compact_results(store_file: str) -> dict:
+    """
+    rewrites store_file so that it only contains the latest record of each key. Safe while others are appending
+    (they wait for the lock). Returns the results (see load_results)
+    """
+    if not os.path.isfile(store_file):
+        return {}
+    with store_lock(store_file):
+        results = load_results(store_file)
+        tmp_file = store_file + f'.tmp{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            for k, v in results.items():
+                f.write(json.dumps({'key': k, 'value': v}) + '\n')
+        os.replace(tmp_file, store_file)
+    return results
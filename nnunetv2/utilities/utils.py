@@ -12,6 +12,7 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import hashlib
 import os.path
 from functools import lru_cache
 from typing import Union
@@ -23,6 +24,20 @@ import re
 from nnunetv2.paths import nnUNet_raw
 
 
+def hash_file(filename: str, chunk_size: int = 2 ** 22) -> str:
+    """
+    sha1 (hex) of the content of filename, read in chunks of chunk_size bytes
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def get_identifiers_from_splitted_dataset_folder(folder: str, file_ending: str):
     files = subfiles(folder, suffix=file_ending, join=False)
     # all files have a 4 digit channel index (_XXXX)